@@ -9,12 +9,18 @@ import mimetypes
 from dotenv import load_dotenv
 import os
 
+from share.api_limiter import ApiLimiter, estimate_tokens
+
 MODEL_NAME = "gemini-2.5-flash-image-preview"
 
 load_dotenv()
 api_key = os.getenv('GEMINI_API_KEY')
 genai.configure(api_key=api_key)
 
+# 429/5xx 재시도. 분당 요청/토큰 제한은 GEMINI_RPM / GEMINI_TPM 환경변수를 줄 때만 적용
+LIMITER = ApiLimiter(rpm=float(os.getenv("GEMINI_RPM", "0")) or None, tpm=float(os.getenv("GEMINI_TPM", "0")) or None,
+                     concurrency=1, max_concurrency=1)
+
 # 이미지 파일을 base64로 인코딩
 def encode_image_to_base64(image_path):
     with open(image_path, "rb") as image_file:
@@ -63,7 +69,8 @@ def analyze_product(product_name: str, base64_image: str, image_path: str) -> di
             genai.types.Content.Part(text=prompt),
             genai.types.Content.Part(inline_data=genai.types.Blob(mime_type=mime_type, data=base64.b64decode(base64_image)))
         ]
-        response = model.generate_content(content)
+        response = LIMITER.call("analyze_product", model.generate_content, content,
+                                tokens=estimate_tokens(content))
         json_output = response.text.replace('```json', '').replace('```', '').strip()
         print("\n---1단계: 제품 분석 결과 및 페르소나 추론---")
         print(json_output)
@@ -98,7 +105,7 @@ def generate_ad_copies(analysis_data: dict) -> list:
     """
 
     try:
-        response = model.generate_content(prompt)
+        response = LIMITER.call("generate_ad_copies", model.generate_content, prompt, tokens=estimate_tokens(prompt))
         json_output = response.text.replace('```json', '').replace('```', '').strip()
         print("\n---2단계: 광고 문구 제안---")
         print(json.loads(json_output))
@@ -142,7 +149,8 @@ def generate_detail_page_content(analysis_data: dict, selected_copy: str) -> dic
     """
     
     try:
-        response = model.generate_content(prompt)
+        response = LIMITER.call("generate_detail_page_content", model.generate_content, prompt,
+                                tokens=estimate_tokens(prompt))
         json_output = response.text.replace('```json', '').replace('```', '').strip()
         print("\n---3단계: 최종 상세 페이지 콘텐츠 생성---")
         print(json_output)
@@ -0,0 +1,428 @@
+import time, math, random, asyncio, threading, email.utils
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, Optional
+
+"""
+Rate limiting / retry wrapper for the generative API calls (Gemini) in share/ and the root scripts
+-----------------------------------------------------------------------------------------------
+- TokenBucket: requests/min and tokens/min budgets; reserve(n) takes the tokens now and returns the wait
+  (reservations queue up instead of racing)
+- a 429 with Retry-After pauses the whole limiter (hold()), with or without an rpm/tpm budget: every
+  call/acall/stream waits until then before sending, also callers already queued for a concurrency slot
+- AIMDConcurrency: in-flight limit shared by threads and asyncio tasks; +1 per window of successes,
+  x0.5 on a 429 or when the recent 5xx/timeout rate passes error_threshold (at most once per cooldown)
+- retries: jittered exponential backoff (random in [delay/2, delay]), Retry-After header or the
+  RetryInfo.retryDelay of the error body wins when present; 408/429/5xx and connection errors only
+- LatencyHistogram: per-endpoint log-spaced buckets -> count / mean / p50 / p90 / p99
+- ApiLimiter.call(endpoint, fn, ...) / await acall(...) / stream(...) (retries until the first chunk)
+"""
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+_TRANSIENT_EXC = {"ConnectionError", "TimeoutError", "TransportError", "TimeoutException", "ConnectError",
+                  "ReadError", "RemoteProtocolError", "ClientConnectionError", "ServerDisconnectedError"}
+
+
+# -----------------------------
+# Error classification
+# -----------------------------
+
+def status_of(exc: BaseException) -> Optional[int]:
+    """HTTP status of an SDK error (google-genai APIError.code, api_core .code, response.status_code)."""
+    for v in (getattr(exc, "code", None), getattr(exc, "status_code", None),
+              getattr(getattr(exc, "response", None), "status_code", None),
+              getattr(getattr(exc, "response", None), "status", None)):
+        if isinstance(v, int) and not isinstance(v, bool) and 100 <= v < 600:
+            return int(v)
+    return None
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds the server asked us to wait: Retry-After header (seconds or HTTP date) or RetryInfo.retryDelay."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    value = None
+    if headers is not None:
+        try:
+            value = headers.get("retry-after") or headers.get("Retry-After")
+        except Exception:
+            value = None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    # google.rpc.RetryInfo in the JSON error body: {"error": {"details": [{"retryDelay": "31s"}]}}
+    details = getattr(exc, "details", None)
+    err = details.get("error", details) if isinstance(details, dict) else None
+    for d in (err or {}).get("details", []) if isinstance(err, dict) else []:
+        delay = d.get("retryDelay") if isinstance(d, dict) else None
+        if isinstance(delay, str) and delay.endswith("s"):
+            try:
+                return max(0.0, float(delay[:-1]))
+            except ValueError:
+                pass
+    return None
+
+
+def is_transient(exc: BaseException) -> bool:
+    return any(c.__name__ in _TRANSIENT_EXC for c in type(exc).__mro__)
+
+
+def estimate_tokens(contents: Any) -> int:
+    """Rough prompt size: ~4 chars per text token, 258 tokens per image / blob part."""
+    if contents is None:
+        return 1
+    items = contents if isinstance(contents, (list, tuple)) else [contents]
+    n = 0
+    for c in items:
+        n += max(1, len(c) // 4) if isinstance(c, str) else 258
+    return n
+
+
+def usage_tokens(resp: Any) -> Optional[int]:
+    usage = getattr(resp, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", None)
+    return int(total) if isinstance(total, int) else None
+
+
+# -----------------------------
+# Token bucket
+# -----------------------------
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1.0, per_minute / 6.0)   # ~10 s worth by default
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, n: float = 1.0) -> float:
+        """Take n tokens (may go into debt) and return the seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def adjust(self, n: float) -> None:
+        """Correct a reservation once the real cost is known (n > 0 charges more, n < 0 refunds)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - n)
+
+
+# -----------------------------
+# AIMD concurrency limit
+# -----------------------------
+
+class AIMDConcurrency:
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: Optional[int] = None,
+                 decrease: float = 0.5, cooldown: float = 2.0, window: int = 20, error_threshold: float = 0.2):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit or max(initial, 1) * 4
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.error_threshold = error_threshold
+        self.inflight = 0
+        self.increases = self.decreases = 0
+        self._recent = deque(maxlen=window)   # 1 = 5xx / timeout, 0 = success
+        self._last_decrease = 0.0
+        self._waiters = deque()               # threading.Event or (loop, future)
+        self._lock = threading.Lock()
+
+    def _free(self) -> bool:
+        return self.inflight < max(self.min_limit, int(self.limit))
+
+    def acquire(self) -> None:
+        with self._lock:
+            if not self._waiters and self._free():
+                self.inflight += 1
+                return
+            ev = threading.Event()
+            self._waiters.append(ev)
+        ev.wait()
+
+    async def acquire_async(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self._free():
+                self.inflight += 1
+                return
+            entry = (loop, loop.create_future())
+            self._waiters.append(entry)
+        try:
+            await entry[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+            raise   # if the slot was already granted, _grant() sees the cancelled future and frees it
+
+    def _grant(self, fut) -> None:
+        if fut.cancelled():
+            self.release(None)
+        else:
+            fut.set_result(True)
+
+    def release(self, outcome: Optional[str]) -> None:
+        """outcome: "ok" | "throttle" (429) | "error" (5xx/timeout) | None (no signal, e.g. a 400)"""
+        with self._lock:
+            self.inflight -= 1
+            now = time.monotonic()
+            if outcome in ("ok", "error"):
+                self._recent.append(outcome == "error")
+            if outcome == "ok":
+                if self.limit < self.max_limit:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                    self.increases += 1
+            elif outcome in ("throttle", "error") and now - self._last_decrease > self.cooldown:
+                rate = sum(self._recent) / len(self._recent) if self._recent else 1.0
+                if outcome == "throttle" or rate > self.error_threshold:
+                    self.limit = max(float(self.min_limit), self.limit * self.decrease)
+                    self._last_decrease = now
+                    self.decreases += 1
+            while self._waiters and self._free():
+                w = self._waiters.popleft()
+                self.inflight += 1
+                if isinstance(w, threading.Event):
+                    w.set()
+                else:
+                    w[0].call_soon_threadsafe(self._grant, w[1])
+
+    def stats(self) -> dict:
+        return {"limit": round(self.limit, 2), "inflight": self.inflight, "waiting": len(self._waiters),
+                "increases": self.increases, "decreases": self.decreases,
+                "recent_error_rate": round(sum(self._recent) / len(self._recent), 3) if self._recent else None}
+
+
+# -----------------------------
+# Latency histogram
+# -----------------------------
+
+class LatencyHistogram:
+    BOUNDS = [0.05 * 2 ** (i / 2) for i in range(24)]   # 50 ms .. ~145 s, sqrt(2) steps
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        i = 0
+        while i < len(self.BOUNDS) and seconds > self.BOUNDS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.n += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.n:
+            return None
+        rank, seen = math.ceil(q * self.n), 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return round(min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max, 3)
+        return round(self.max, 3)
+
+    def snapshot(self) -> dict:
+        buckets = {(f"<={self.BOUNDS[i]:.3g}s" if i < len(self.BOUNDS) else "inf"): c
+                   for i, c in enumerate(self.counts) if c}
+        return {"count": self.n, "mean_s": round(self.total / self.n, 3) if self.n else None,
+                "p50_s": self.quantile(0.5), "p90_s": self.quantile(0.9), "p99_s": self.quantile(0.99),
+                "max_s": round(self.max, 3), "buckets": buckets}
+
+
+# -----------------------------
+# Limiter
+# -----------------------------
+
+class _Endpoint:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.calls = self.ok = self.retries = self.throttled = self.failed = 0
+        self.rate_wait = 0.0
+
+
+class ApiLimiter:
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None, concurrency: int = 4,
+                 max_concurrency: Optional[int] = None, max_retries: int = 5, base_delay: float = 1.0,
+                 max_delay: float = 60.0, seed: Optional[int] = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.concurrency = AIMDConcurrency(concurrency, max_limit=max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = random.Random(seed)
+        self._endpoints: Dict[str, _Endpoint] = {}
+        self._lock = threading.Lock()
+        self.hold_until = 0.0   # monotonic time before which no call is sent (server Retry-After on a 429)
+        self.holds = 0
+
+    def _ep(self, name: str) -> _Endpoint:
+        with self._lock:
+            return self._endpoints.setdefault(name, _Endpoint())
+
+    def hold(self, seconds: float) -> None:
+        with self._lock:
+            self.hold_until = max(self.hold_until, time.monotonic() + seconds)
+            self.holds += 1
+
+    def _hold_wait(self) -> float:
+        return max(0.0, self.hold_until - time.monotonic())
+
+    def _rate_wait(self, ep: _Endpoint, tokens: int) -> float:
+        wait = self._hold_wait()
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        ep.rate_wait += wait
+        return wait
+
+    def _settle(self, resp: Any, tokens: int) -> None:
+        used = usage_tokens(resp)
+        if self.tokens and used is not None:
+            self.tokens.adjust(used - tokens)
+
+    def _on_error(self, ep: _Endpoint, exc: BaseException, attempt: int):
+        """-> (outcome for AIMD, backoff seconds or None to give up)"""
+        status = status_of(exc)
+        if status is None and not is_transient(exc):
+            return None, None
+        if status is not None and status not in RETRYABLE_STATUS:
+            return None, None
+        outcome = "throttle" if status == 429 else "error"
+        ep.throttled += status == 429
+        if attempt >= self.max_retries:
+            return outcome, None
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = delay / 2 + self._rng.uniform(0, delay / 2)
+        server = retry_after(exc)
+        if server is not None:
+            delay = max(delay, server)
+            # quota hit: every caller holds off, not just this one (no retry storm after a 429)
+            if status == 429:
+                self.hold(server)
+        return outcome, delay
+
+    def _prepare(self, endpoint: str, tokens: Optional[int], kwargs: dict):
+        ep = self._ep(endpoint)
+        ep.calls += 1
+        return ep, tokens if tokens is not None else estimate_tokens(kwargs.get("contents"))
+
+    def call(self, endpoint: str, fn: Callable, *args, tokens: Optional[int] = None, **kwargs):
+        ep, tokens = self._prepare(endpoint, tokens, kwargs)
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._rate_wait(ep, tokens))
+            self.concurrency.acquire()
+            while self._hold_wait() > 0:   # a 429 arrived while this caller was queued for a slot
+                time.sleep(self._hold_wait())
+            t0, outcome = time.perf_counter(), None
+            try:
+                resp = fn(*args, **kwargs)
+                outcome = "ok"
+            except Exception as e:
+                outcome, delay = self._on_error(ep, e, attempt)
+                if delay is None:
+                    ep.failed += 1
+                    raise
+            finally:
+                ep.latency.add(time.perf_counter() - t0)
+                self.concurrency.release(outcome)
+            if outcome == "ok":
+                ep.ok += 1
+                self._settle(resp, tokens)
+                return resp
+            ep.retries += 1
+            time.sleep(delay)
+
+    async def acall(self, endpoint: str, fn: Callable, *args, tokens: Optional[int] = None, **kwargs):
+        ep, tokens = self._prepare(endpoint, tokens, kwargs)
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._rate_wait(ep, tokens))
+            await self.concurrency.acquire_async()
+            try:
+                while self._hold_wait() > 0:   # a 429 arrived while this task was queued for a slot
+                    await asyncio.sleep(self._hold_wait())
+            except asyncio.CancelledError:
+                self.concurrency.release(None)
+                raise
+            t0, outcome = time.perf_counter(), None
+            try:
+                resp = await fn(*args, **kwargs)
+                outcome = "ok"
+            except Exception as e:
+                outcome, delay = self._on_error(ep, e, attempt)
+                if delay is None:
+                    ep.failed += 1
+                    raise
+            finally:
+                ep.latency.add(time.perf_counter() - t0)
+                self.concurrency.release(outcome)
+            if outcome == "ok":
+                ep.ok += 1
+                self._settle(resp, tokens)
+                return resp
+            ep.retries += 1
+            await asyncio.sleep(delay)
+
+    def stream(self, endpoint: str, fn: Callable, *args, tokens: Optional[int] = None, **kwargs) -> Iterator:
+        """Streaming call: retried until the first chunk arrives; errors after that are raised as-is."""
+        ep, tokens = self._prepare(endpoint, tokens, kwargs)
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._rate_wait(ep, tokens))
+            self.concurrency.acquire()
+            while self._hold_wait() > 0:   # a 429 arrived while this caller was queued for a slot
+                time.sleep(self._hold_wait())
+            t0, outcome, it, first = time.perf_counter(), None, None, None
+            try:
+                it = iter(fn(*args, **kwargs))
+                first = next(it, StopIteration)
+                outcome = "ok"
+            except Exception as e:
+                outcome, delay = self._on_error(ep, e, attempt)
+                ep.latency.add(time.perf_counter() - t0)
+                self.concurrency.release(outcome)
+                if delay is None:
+                    ep.failed += 1
+                    raise
+            if outcome == "ok":
+                break
+            ep.retries += 1
+            time.sleep(delay)
+        last = first
+        try:
+            if first is not StopIteration:
+                yield first
+                for last in it:
+                    yield last
+            ep.ok += 1
+        except Exception as e:
+            outcome = self._on_error(ep, e, self.max_retries)[0]
+            ep.failed += 1
+            raise
+        finally:
+            ep.latency.add(time.perf_counter() - t0)
+            self.concurrency.release(outcome)
+            if last is not StopIteration:
+                self._settle(last, tokens)   # usage_metadata arrives with the final chunk
+
+    def stats(self) -> dict:
+        with self._lock:
+            eps = dict(self._endpoints)
+        return {"concurrency": self.concurrency.stats(), "holds": self.holds,
+                "endpoints": {name: {"calls": e.calls, "ok": e.ok, "retries": e.retries, "throttled": e.throttled,
+                                     "failed": e.failed, "rate_wait_s": round(e.rate_wait, 3), "latency": e.latency.snapshot()}
+                              for name, e in eps.items()}}
@@ -0,0 +1,1029 @@
+import os, sys, json, argparse, time, random
+from typing import List, Tuple
+
+"""
+Micro-benchmarks / regression checks for the share/ pipeline
+-------------------------------------------------------------
+USAGE
+  python bench.py luma [--n_boxes 64] [--size 1024]
+  python bench.py wrap --font NotoSansKR-Bold.otf
+  python bench.py fit  --font NotoSansKR-Bold.otf
+  python bench.py render --font NotoSansKR-Bold.otf --jobs 96 --workers 1,8,32
+  python bench.py glass [--blur 6]
+  python bench.py jsonscan [--n 500]
+  python bench.py grammar [--n 300]
+  python bench.py boxes [--sizes 10,100,500]
+  python bench.py qwen-batch --images "samples/*.png" --batch_sizes 1,2,4,8
+  python bench.py qwen-ensemble --images "samples/*.png" --ks 1,4,8
+  python bench.py qwen-quant --images "samples/*.png" --backends auto,cpu-int8,cpu-int4 --threads 16
+  python bench.py qwen-serve [--processor_id Qwen/Qwen2.5-VL-7B-Instruct]
+  python bench.py nano-batch [--jobs 24 --concurrency 1,4,8,16 --delay 0.3]
+  python bench.py upload [--sizes 1024x768,3840x2160,6000x4000 --codecs png,webp,jpeg]
+  python bench.py imgload [--sizes 3840x2160,6000x4000]
+
+Each sub-command prints one JSON line per measurement so results can be diffed between commits.
+"""
+
+# -----------------------------
+# Helpers
+# -----------------------------
+
+def timeit(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def emit(**rec):
+    print(json.dumps(rec, ensure_ascii=False))
+
+
+def random_image(size: int, seed: int = 0):
+    from PIL import Image
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    # smooth gradients + noise so LANCZOS sees realistic content
+    yy, xx = np.mgrid[0:size, 0:size]
+    base = np.stack([(xx * 255 // max(1, size-1)), (yy * 255 // max(1, size-1)), ((xx+yy) * 127 // max(1, size-1))], -1)
+    noise = rng.integers(-40, 40, size=(size, size, 3))
+    arr = np.clip(base + noise, 0, 255).astype("uint8")
+    return Image.fromarray(arr, "RGB").convert("RGBA")
+
+
+def random_boxes(n: int, W: int, H: int, seed: int = 0) -> List[Tuple[int,int,int,int]]:
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        x0 = rnd.randrange(0, W-8); y0 = rnd.randrange(0, H-8)
+        x1 = rnd.randrange(x0+1, W); y1 = rnd.randrange(y0+1, H)
+        out.append((x0, y0, x1, y1))
+    return out
+
+# -----------------------------
+# luma: vectorized engine vs legacy loop
+# -----------------------------
+
+def legacy_avg_luma(img, box) -> float:
+    """Pre-NumPy pilow.avg_luma, kept verbatim as the regression reference."""
+    from PIL import Image
+    x0,y0,x1,y1 = box
+    if x1<=x0 or y1<=y0:
+        return 0.5
+    crop = img.crop((x0,y0,x1,y1)).convert("RGB")
+    pixels = crop.resize((32, 32), Image.LANCZOS).getdata()
+    def _linear(c):
+        c = c / 255.0
+        return c/12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+    s = 0.0
+    for r,g,b in pixels:
+        R, G, B = _linear(r), _linear(g), _linear(b)
+        L = 0.2126*R + 0.7152*G + 0.0722*B
+        s += L
+    return s / (32*32)
+
+
+def bench_luma(args):
+    import luma
+    img = random_image(args.size)
+    boxes = random_boxes(args.n_boxes, *img.size) + [(10, 10, 10, 40)]  # + one empty box
+    ref = [legacy_avg_luma(img, b) for b in boxes]
+    single = [luma.avg_luma(img, b) for b in boxes]
+    err = max(abs(a-b) for a, b in zip(ref, single))
+    ok = err <= args.tol
+    emit(bench="luma", check="legacy_match", max_abs_err=err, tol=args.tol, ok=ok)
+    t_ref = timeit(lambda: [legacy_avg_luma(img, b) for b in boxes], args.repeat)
+    t_one = timeit(lambda: [luma.avg_luma(img, b) for b in boxes], args.repeat)
+    for name, t in (("legacy", t_ref), ("numpy_lut", t_one)):
+        emit(bench="luma", impl=name, boxes=len(boxes), ms_per_box=round(t*1000/len(boxes), 4))
+    # integral-image index: one build per canvas, then O(1) per box (area mean, not LANCZOS -> report drift)
+    t_build = timeit(lambda: luma.LumaIndex(img), args.repeat)
+    index = luma.LumaIndex(img)
+    t_query = timeit(lambda: [index.mean(b) for b in boxes], args.repeat)
+    drift = max(abs(m - r) for m, r in zip(index.mean_many(boxes).tolist(), single))
+    # incremental refresh after painting one panel (only the dirty cells are re-read)
+    panel = (img.size[0] // 4, img.size[1] // 4, img.size[0] // 2, img.size[1] // 3)
+    def repaint():
+        index.invalidate(panel)
+        index.mean(panel)
+    t_refresh = timeit(repaint, args.repeat)
+    emit(bench="luma", impl="sat_index", boxes=len(boxes), build_ms=round(t_build*1000, 3),
+         ms_per_box=round(t_query*1000/len(boxes), 4), refresh_ms=round(t_refresh*1000, 3),
+         cell=index.cell, index_mb=round(index.nbytes / (1 << 20), 2), max_drift_vs_resample=round(drift, 5))
+    return 0 if ok else 1
+
+# -----------------------------
+# wrap: glyph-metrics wrap vs legacy prefix re-measuring
+# -----------------------------
+
+SAMPLE_BODY_KO = (
+    "은은한 실버 광택과 꽃잎 모양의 섬세한 디자인이 어우러진 목걸이입니다. 핑크, 보라, 블루 세 가지 컬러 스톤이 "
+    "빛을 받아 반짝이며 데일리룩은 물론 특별한 날의 포인트 액세서리로도 손색이 없습니다. 알레르기 걱정을 줄인 "
+    "소재와 길이 조절이 가능한 체인으로 누구에게나 편안하게 어울리며, 고급 패키지에 담아 선물용으로도 좋습니다."
+)
+SAMPLE_HEADLINE = "Spring Silver Collection for you"
+
+
+def legacy_wrap_text_to_width(draw, text, font, max_w, mode):
+    """Pre-metrics pilow.wrap_text_to_width (textbbox on every growing prefix), kept as the reference."""
+    mode = mode.lower()
+    if mode == 'auto':
+        mode = 'word' if (' ' in text) else 'char'
+    lines = []
+    if mode == 'word':
+        words = text.split()
+        cur = ''
+        for w in words:
+            test = (cur + ' ' + w).strip() if cur else w
+            tw = draw.textbbox((0,0), test, font=font)[2]
+            if tw <= max_w:
+                cur = test
+            else:
+                if cur:
+                    lines.append(cur)
+                    cur = w
+                else:
+                    cur = w
+        if cur:
+            lines.append(cur)
+    else:
+        cur = ''
+        for ch in list(text):
+            test = cur + ch
+            tw = draw.textbbox((0,0), test, font=font)[2]
+            if tw <= max_w or cur == '':
+                cur = test
+            else:
+                lines.append(cur)
+                cur = ch
+        if cur:
+            lines.append(cur)
+    return lines
+
+
+def bench_wrap(args):
+    import pilow
+    from PIL import Image, ImageDraw
+    font_path = pilow.resolve_font_path(args.font)
+    draw = ImageDraw.Draw(Image.new("RGBA", (8, 8)), "RGBA")
+    rnd = random.Random(0)
+    texts = [SAMPLE_HEADLINE, SAMPLE_BODY_KO, SAMPLE_BODY_KO.replace(" ", "")]
+    alpha = "AVWTYLoayr.,fij 가나다라마바사 ()1234"
+    texts += [''.join(rnd.choice(alpha) for _ in range(rnd.randint(1, 200))) for _ in range(args.n_random)]
+    mismatches = 0
+    cases = 0
+    for size in (14, 28, 56, 112):
+        font = pilow.get_font(font_path, size)
+        for text in texts:
+            for mode in ("auto", "word", "char"):
+                for max_w in (120, 400, 900):
+                    cases += 1
+                    if pilow.wrap_text_to_width(draw, text, font, max_w, mode) != legacy_wrap_text_to_width(draw, text, font, max_w, mode):
+                        mismatches += 1
+    emit(bench="wrap", check="legacy_match", cases=cases, mismatches=mismatches, ok=mismatches == 0)
+    for label, text in (("headline", SAMPLE_HEADLINE), ("body_ko", SAMPLE_BODY_KO)):
+        font = pilow.get_font(font_path, 40)
+        t_old = timeit(lambda: legacy_wrap_text_to_width(draw, text, font, 600, "auto"), args.repeat)
+        t_new = timeit(lambda: pilow.wrap_text_to_width(draw, text, font, 600, "auto"), args.repeat)
+        emit(bench="wrap", text=label, chars=len(text), legacy_ms=round(t_old*1000, 3), metrics_ms=round(t_new*1000, 3))
+    return 0 if mismatches == 0 else 1
+
+# -----------------------------
+# fit: analytic vs binary font-size search
+# -----------------------------
+
+def bench_fit(args):
+    import pilow
+    from PIL import Image, ImageDraw
+    font_path = pilow.resolve_font_path(args.font)
+    draw = ImageDraw.Draw(Image.new("RGBA", (8, 8)), "RGBA")
+    body = (SAMPLE_BODY_KO * 2)[:200]
+    cases = (("headline", SAMPLE_HEADLINE, (40, 40, 984, 163)),
+             ("body_200", body, (60, 620, 964, 980)))
+
+    def fit(text, box, strategy):
+        return pilow.fit_text_in_box(draw, text, font_path, box, max_try=112, min_size=14, strategy=strategy)
+
+    for label, text, box in cases:
+        for strategy in ("binary", "analytic"):
+            def cold():
+                pilow.FONT_CACHE.resize(1)          # evict everything -> re-parse fonts
+                pilow.FONT_CACHE.resize(256)
+                pilow._METRICS.clear()
+                fit(text, box, strategy)
+            t_cold = timeit(cold, args.repeat)
+            fit(text, box, strategy)
+            t_warm = timeit(lambda: fit(text, box, strategy), args.repeat)
+            size = fit(text, box, strategy)[2]
+            emit(bench="fit", text=label, chars=len(text), strategy=strategy, size=size,
+                 cold_ms_per_box=round(t_cold*1000, 3), warm_ms_per_box=round(t_warm*1000, 3))
+    # equivalence: analytic must settle on the same size as binary for random boxes / text lengths
+    rnd = random.Random(0)
+    mismatches = 0
+    for _ in range(args.trials):
+        w, h = rnd.randrange(120, 1000), rnd.randrange(40, 500)
+        text = (SAMPLE_HEADLINE + " " + SAMPLE_BODY_KO)[: rnd.randrange(4, 220)]
+        sizes = [fit(text, (0, 0, w, h), strategy)[2] for strategy in ("binary", "analytic")]
+        mismatches += sizes[0] != sizes[1]
+    emit(bench="fit", check="analytic_matches_binary", trials=args.trials, mismatches=mismatches, ok=mismatches == 0)
+    return 0 if mismatches == 0 else 1
+
+# -----------------------------
+# render: batch throughput vs worker count
+# -----------------------------
+
+SAMPLE_LAYOUT = {"layout": {
+    "subject_layout": {"center": [0.5, 0.5], "ratio": [0.4, 0.4]},
+    "nongraphic_layout": [
+        {"type": "headline", "bbox": [0.04, 0.04, 0.92, 0.12]},
+        {"type": "subhead", "bbox": [0.04, 0.70, 0.92, 0.10]},
+        {"type": "body", "bbox": [0.04, 0.82, 0.92, 0.14]},
+    ],
+    "graphic_layout": [
+        {"type": "underlay", "bbox": [0.025, 0.025, 0.95, 0.15], "style": {"radius": 0.08, "opacity": 0.6}},
+        {"type": "underlay", "bbox": [0.025, 0.80, 0.95, 0.17], "style": {"radius": 0.08, "opacity": 0.6}},
+    ],
+}}
+
+
+def write_render_fixture(tmp: str, n_jobs: int, size: int, n_images: int = 4) -> str:
+    """Synthetic images + layout + manifest of n_jobs copy variants; returns the manifest path."""
+    layout_path = os.path.join(tmp, "layout.json")
+    with open(layout_path, "w", encoding="utf-8") as f:
+        json.dump(SAMPLE_LAYOUT, f)
+    images = []
+    for i in range(n_images):
+        path = os.path.join(tmp, f"bg_{i}.png")
+        random_image(size, seed=i).convert("RGB").save(path)
+        images.append(path)
+    manifest = os.path.join(tmp, "jobs.jsonl")
+    with open(manifest, "w", encoding="utf-8") as f:
+        for j in range(n_jobs):
+            copy = {"headline#0": f"{SAMPLE_HEADLINE} #{j}", "subhead#0": "Limited offer 30% OFF",
+                    "body#0": SAMPLE_BODY_KO[: 60 + (j * 7) % 120]}
+            f.write(json.dumps({"image": images[j % n_images], "layout_json": layout_path, "copy": copy,
+                                "out": os.path.join(tmp, "out", f"{j}.jpg")}, ensure_ascii=False) + "\n")
+    return manifest
+
+
+def bench_render(args):
+    import tempfile, contextlib, io
+    import pilow
+    workers = [int(w) for w in args.workers.split(",")]
+    with tempfile.TemporaryDirectory() as tmp:
+        manifest = write_render_fixture(tmp, args.jobs, args.size)
+        base_rate = None
+        for w in workers:
+            cli = ["--jobs", manifest, "--workers", str(w), "--jobs_report", os.path.join(tmp, "report.jsonl")]
+            if args.font:
+                cli += ["--font_kor", args.font]
+            if args.glass:
+                cli += ["--glass_underlay"]
+            bargs = pilow.build_arg_parser().parse_args(cli)
+            t0 = time.perf_counter()
+            with contextlib.redirect_stderr(io.StringIO()):
+                rc = pilow.run_batch(bargs)
+            dt = time.perf_counter() - t0
+            rate = args.jobs / dt
+            base_rate = base_rate or rate
+            emit(bench="render", workers=w, jobs=args.jobs, size=args.size, rc=rc, seconds=round(dt, 3),
+                 jobs_per_s=round(rate, 2), speedup=round(rate / base_rate, 2), cpus=os.cpu_count())
+    return 0
+
+# -----------------------------
+# glass: shared-buffer glass panels vs per-box blur
+# -----------------------------
+
+def bench_glass(args):
+    import pilow
+    for size in (1024, 2048, 4096):
+        img = random_image(size)
+        k = size / 1024
+        blur = args.blur * k
+        # headline + subhead stacked (overlapping), a body block and a small badge
+        rel = [(0.04, 0.04, 0.96, 0.16), (0.08, 0.14, 0.92, 0.24), (0.06, 0.78, 0.94, 0.96), (0.70, 0.60, 0.92, 0.70)]
+        boxes = [tuple(int(v * size) for v in b) for b in rel]
+
+        def per_box():
+            canvas = img.copy()
+            for b in boxes:
+                pilow.glass_underlay(canvas, b, radius=int(16*k), blur=blur)
+
+        def shared():
+            canvas = img.copy()
+            pilow.glass_panels(canvas, boxes, radius=int(16*k), blur=blur)
+
+        t_copy = timeit(lambda: img.copy(), args.repeat)
+        t_per = timeit(per_box, args.repeat) - t_copy
+        t_sh = timeit(shared, args.repeat) - t_copy
+        emit(bench="glass", size=size, blur=round(blur, 1), panels=len(boxes),
+             per_box_ms=round(t_per*1000, 2), shared_ms=round(t_sh*1000, 2), speedup=round(t_per / max(t_sh, 1e-9), 2))
+    return 0
+
+# -----------------------------
+# jsonscan: streaming JSON scanner (early stop) vs json.raw_decode
+# -----------------------------
+
+def bench_jsonscan(args):
+    from json_stream import JsonScanner
+    rng = random.Random(0)
+    dec = json.JSONDecoder()
+    mismatches, tail_chars, total_chars, t_scan = 0, 0, 0, 0.0
+    for n in range(args.n):
+        items = [{"type": rng.choice(["headline", "subhead", "logo"]), "content": rng.choice(["", "a}b", 'q\\"{', "한글 {괄호}"]),
+                  "bbox": [round(rng.random(), 3) for _ in range(4)], "confidence": round(rng.random(), 2)}
+                 for _ in range(rng.randint(1, 6))]
+        obj = {"product": {"type": "cup"}, "layout": {"nongraphic_layout": items}}
+        body = json.dumps(obj, ensure_ascii=False, indent=rng.choice([None, 2]))
+        tail = rng.choice(["", "\n```", "\n설명: {추가} 텍스트가 이어짐 " * 8])
+        text = rng.choice(["", "```json\n"]) + body + tail
+        sc = JsonScanner()
+        t0 = time.perf_counter()
+        pos = 0
+        while pos < len(text) and not sc.feed(text[pos:pos + rng.randint(1, 6)]):   # token-sized chunks
+            pos = len(sc.text)
+        t_scan += time.perf_counter() - t0
+        ref, _ = dec.raw_decode(text, text.index("{"))
+        mismatches += json.loads(sc.result() or "null") != ref
+        tail_chars += len(text) - len(sc.text)
+        total_chars += len(text)
+    emit(bench="jsonscan", samples=args.n, mismatches=mismatches,
+         skipped_tail_pct=round(100 * tail_chars / max(1, total_chars), 1),
+         us_per_sample=round(t_scan / args.n * 1e6, 1))
+    return 0 if mismatches == 0 else 1
+
+# -----------------------------
+# grammar: constrained-decoding grammar on a toy tokenizer (validity + forced-token share)
+# -----------------------------
+
+def toy_tokenizer():
+    """printable ASCII + a few Hangul syllables + multi-char JSON chunks; greedy longest-match encode"""
+    vocab = [chr(c) for c in range(32, 127)] + list("가나다라마바사한글제품") + \
+            ['{"', '":', '",', '"}', '":"', '"]', '],', 'type', 'head', 'line', 'bbox', '0.', '12', '<eos>']
+    vocab = list(dict.fromkeys(vocab))
+    index = {t: i for i, t in enumerate(vocab)}
+
+    def encode(text):
+        out, i = [], 0
+        while i < len(text):
+            for n in range(min(6, len(text) - i), 0, -1):
+                if text[i:i+n] in index:
+                    out.append(index[text[i:i+n]])
+                    i += n
+                    break
+        return out
+    return vocab, encode, index["<eos>"]
+
+
+def bench_grammar(args):
+    import numpy as np
+    from json_grammar import TokenGrammar, Str, Num, Enum, Arr
+    bbox = [Num(), Num(), Num(), Num()]
+    spec = {"product": {"type": Str(20), "features": Str(60)},
+            "layout": {"subject_layout": {"center": [Num(), Num()], "ratio": [Num(), Num()]},
+                       "nongraphic_layout": Arr({"type": Enum("headline", "subhead", "body"), "bbox": bbox,
+                                                 "confidence": Num(2)}, 1, 6),
+                       "graphic_layout": Arr({"type": Enum("logo"), "bbox": bbox}, 1, 3)},
+            "objects": Arr({"name": Str(20), "depth": Enum("behind_product", "same_plane")}, 0, 4)}
+    vocab, encode, eos = toy_tokenizer()
+    g = TokenGrammar(spec, vocab, encode, [eos], [eos])
+    rng = random.Random(0)
+    invalid, sampled, forced = 0, 0, 0
+    t0 = time.perf_counter()
+    for _ in range(args.n):
+        st, out = g.start(), []
+        while True:
+            allowed = g.allowed(st)
+            if isinstance(allowed, np.ndarray):
+                tok = g.quote_id if rng.random() < 0.1 else rng.choice(np.flatnonzero(allowed).tolist())
+            else:
+                tok = rng.choice(allowed)
+            if tok == eos:
+                break
+            sampled += 1
+            out.append(tok)
+            g.advance(st, tok)
+            run = g.forced_run(st)
+            for f in run:
+                g.advance(st, f)
+            out += run
+            forced += len(run)
+        try:
+            json.loads("".join(vocab[i] for i in out))
+        except ValueError:
+            invalid += 1
+    dt = time.perf_counter() - t0
+    emit(bench="grammar", samples=args.n, invalid=invalid, forced_share=round(forced / max(1, forced + sampled), 3),
+         ms_per_sample=round(dt / args.n * 1000, 2))
+    return 0 if invalid == 0 else 1
+
+# -----------------------------
+# boxes: vectorized NMS / text rules vs legacy per-pair loops
+# -----------------------------
+
+def legacy_clip_bbox(b):
+    c = lambda v: max(0.0, min(1.0, float(v)))
+    x, y, w, h = c(b[0]), c(b[1]), c(b[2]), c(b[3])
+    if x + w > 1: w = max(0.0, 1 - x)
+    if y + h > 1: h = max(0.0, 1 - y)
+    return [x, y, w, h]
+
+
+def legacy_iou(b1, b2):
+    x1,y1,w1,h1 = b1; x2,y2,w2,h2 = b2
+    xa = max(x1, x2); ya = max(y1, y2)
+    xb = min(x1+w1, x2+w2); yb = min(y1+h1, y2+h2)
+    inter = max(0.0, xb-xa) * max(0.0, yb-ya)
+    a1 = max(0.0, w1*h1); a2 = max(0.0, w2*h2)
+    union = a1 + a2 - inter
+    return inter/union if union > 0 else 0.0
+
+
+def legacy_nms(boxes, iou_thr=0.3):
+    bxs = [b for b in boxes if isinstance(b.get("bbox"), list) and len(b["bbox"])==4]
+    bxs.sort(key=lambda b: float(b.get("confidence", 0.5)), reverse=True)
+    kept = []
+    for b in bxs:
+        if all(legacy_iou(b["bbox"], k["bbox"]) < iou_thr for k in kept):
+            kept.append(b)
+    return kept
+
+
+def legacy_enforce_text_rules(items, subject_bbox, min_ar=1.8, min_margin=0.03, max_iou=0.2):
+    out = []
+    for it in items:
+        b = it.get("bbox", [0,0,0,0])
+        if not (isinstance(b, list) and len(b)==4):
+            continue
+        b = legacy_clip_bbox(b)
+        if subject_bbox and legacy_iou(b, subject_bbox) >= max_iou:
+            continue
+        x,y,w,h = b
+        if x < min_margin or y < min_margin or x+w > 1-min_margin or y+h > 1-min_margin:
+            continue
+        ar = (w / h) if h > 0 else 999
+        if ar < min_ar:
+            continue
+        it["confidence"] = float(it.get("confidence", 0.5))
+        it["bbox"] = b
+        out.append(it)
+    return out
+
+
+def random_candidates(n: int, seed: int) -> list:
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        # wide text-like boxes around a few anchors (heavy overlap), some out of range / duplicated confidences
+        ax, ay = rng.choice([(0.05, 0.05), (0.1, 0.75), (0.5, 0.4), (0.3, 0.1)])
+        b = [ax + rng.uniform(-0.08, 0.1), ay + rng.uniform(-0.06, 0.08), rng.uniform(0.2, 0.95), rng.uniform(0.02, 0.2)]
+        it = {"type": rng.choice(["headline", "subhead", "body"]), "bbox": b,
+              "confidence": rng.choice([0.5, 0.9, round(rng.random(), 2)])}
+        if i % 37 == 0:
+            it["bbox"] = b[:3]
+        out.append(it)
+    return out
+
+
+def bench_boxes(args):
+    import copy
+    import boxes
+    subject = [0.3, 0.3, 0.4, 0.4]
+    total = 0
+    for n in [int(v) for v in args.sizes.split(",")]:
+        mismatches = 0
+        for seed in range(args.trials):
+            cands = random_candidates(n, seed)
+            a, b = copy.deepcopy(cands), copy.deepcopy(cands)
+            ref = legacy_nms(legacy_enforce_text_rules(a, subject), 0.3)
+            new = boxes.nms(boxes.enforce_text_rules(b, subject), 0.3)
+            mismatches += [(x["type"], x["bbox"], x["confidence"]) for x in ref] != \
+                          [(x["type"], x["bbox"], x["confidence"]) for x in new]
+            mismatches += legacy_nms(a, 0.5) != boxes.nms(b, 0.5)
+        cands = random_candidates(n, 0)
+        t_old = timeit(lambda: legacy_nms(legacy_enforce_text_rules(copy.deepcopy(cands), subject), 0.3), args.repeat)
+        t_new = timeit(lambda: boxes.nms(boxes.enforce_text_rules(copy.deepcopy(cands), subject), 0.3), args.repeat)
+        t_copy = timeit(lambda: copy.deepcopy(cands), args.repeat)
+        emit(bench="boxes", n=n, trials=args.trials, mismatches=mismatches,
+             legacy_ms=round((t_old - t_copy) * 1000, 3), vectorized_ms=round((t_new - t_copy) * 1000, 3))
+        total += mismatches
+    return 0 if total == 0 else 1
+
+# -----------------------------
+# qwen-batch: layout inference throughput vs batch size
+# -----------------------------
+
+def bench_qwen_batch(args):
+    import glob, tempfile
+    import qwen
+    model, processor = qwen.load_model(args.model_id)
+    with tempfile.TemporaryDirectory() as tmp:
+        images = sorted(glob.glob(args.images)) if args.images else []
+        if not images:
+            for i in range(4):
+                path = os.path.join(tmp, f"bg_{i}.png")
+                random_image(args.size, seed=i).convert("RGB").save(path)
+                images.append(path)
+        paths = [images[i % len(images)] for i in range(args.n)]
+        opts = {"max_new_tokens": args.max_new_tokens, "bg_prompt": args.bg_prompt}
+        for b in [int(v) for v in args.batch_sizes.split(",")]:
+            sched = qwen.BatchScheduler(model, processor, max_batch=b, max_wait_ms=args.max_wait_ms)
+            sched.submit(paths[0], "", **opts).result()          # warm-up (weights / kernels)
+            sched.batches = sched.batched_items = 0
+            t0 = time.perf_counter()
+            futures = [sched.submit(os.path.abspath(p), "", **opts) for p in paths]
+            n_ok = sum(1 for f in futures if not f.exception())
+            dt = time.perf_counter() - t0
+            emit(bench="qwen-batch", batch=b, images=len(paths), ok=n_ok, seconds=round(dt, 2),
+                 images_per_min=round(len(paths) * 60 / dt, 2), **sched.stats())
+    return 0
+
+# -----------------------------
+# qwen-quant: quantized CPU backends vs baseline (latency, peak RSS, layout agreement)
+# -----------------------------
+
+def layout_agreement(a: dict, b: dict) -> float:
+    """mean best-match IoU of same-type boxes (text + graphic) of two layouts; 1.0 = identical boxes"""
+    import qwen
+    def boxes(d):
+        lay = (d or {}).get("layout", {}) or {}
+        return [(x.get("type"), x["bbox"]) for x in (lay.get("nongraphic_layout", []) or []) + (lay.get("graphic_layout", []) or [])
+                if isinstance(x.get("bbox"), list) and len(x["bbox"]) == 4]
+    ba, bb = boxes(a), boxes(b)
+    if not ba and not bb:
+        return 1.0
+    scores = [max([qwen.iou(box, o) for t2, o in other if t2 == t] or [0.0])
+              for mine, other in ((ba, bb), (bb, ba)) for t, box in mine]
+    return sum(scores) / len(scores)
+
+
+def _qwen_quant_worker(args):
+    """one backend per process so ru_maxrss is that backend's peak"""
+    import resource, glob
+    import qwen
+    t0 = time.perf_counter()
+    model, processor = qwen.load_model(args.model_id, args.worker, args.threads)
+    load_s = time.perf_counter() - t0
+    paths = sorted(glob.glob(args.images))[: args.n]
+    qwen.analyze_image(model, processor, paths[0], "", max_new_tokens=16, seed=0)   # warm-up
+    lat, results = [], []
+    for p in paths:
+        t0 = time.perf_counter()
+        results.append(qwen.analyze_image(model, processor, os.path.abspath(p), "",
+                                          max_new_tokens=args.max_new_tokens, seed=0, constrained=args.constrained))
+        lat.append(time.perf_counter() - t0)
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"load_s": load_s, "latency_s": lat, "peak_rss_mb": peak_mb, "results": results}, ensure_ascii=False))
+    return 0
+
+
+def bench_qwen_quant(args):
+    import subprocess, statistics
+    if args.worker:
+        return _qwen_quant_worker(args)
+    runs = {}
+    for backend in args.backends.split(","):
+        cmd = [sys.executable, os.path.abspath(__file__), "qwen-quant", "--worker", backend,
+               "--model_id", args.model_id, "--images", args.images, "--n", str(args.n),
+               "--max_new_tokens", str(args.max_new_tokens)]
+        if args.threads:
+            cmd += ["--threads", str(args.threads)]
+        if args.constrained:
+            cmd += ["--constrained"]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            emit(bench="qwen-quant", backend=backend, error=proc.stderr.strip().splitlines()[-1:] or proc.returncode)
+            continue
+        runs[backend] = rec = json.loads(proc.stdout.strip().splitlines()[-1])
+        base = runs.get(args.backends.split(",")[0])
+        agree = [layout_agreement(r, b) for r, b in zip(rec["results"], base["results"])] if base else []
+        emit(bench="qwen-quant", backend=backend, threads=args.threads, images=len(rec["latency_s"]),
+             load_s=round(rec["load_s"], 1), median_latency_s=round(statistics.median(rec["latency_s"]), 2),
+             peak_rss_mb=round(rec["peak_rss_mb"]), agreement_vs_baseline=round(sum(agree) / len(agree), 3) if agree else None)
+    return 0
+
+# -----------------------------
+# qwen-ensemble: latency of one batched K-sample pass
+# -----------------------------
+
+def bench_qwen_ensemble(args):
+    import glob, statistics
+    import qwen
+    model, processor = qwen.load_model(args.model_id, args.backend, args.threads)
+    paths = [os.path.abspath(p) for p in sorted(glob.glob(args.images))[: args.n]]
+    qwen.analyze_image(model, processor, paths[0], "", max_new_tokens=16, seed=0)   # warm-up
+    for k in [int(v) for v in args.ks.split(",")]:
+        lat, n_text = [], []
+        for p in paths:
+            t0 = time.perf_counter()
+            parsed = qwen.analyze_image(model, processor, p, "", max_new_tokens=args.max_new_tokens, seed=0, ensemble=k)
+            lat.append(time.perf_counter() - t0)
+            n_text.append(len(parsed.get("layout", {}).get("nongraphic_layout", [])))
+        emit(bench="qwen-ensemble", k=k, images=len(paths), median_latency_s=round(statistics.median(lat), 2),
+             mean_text_boxes=round(sum(n_text) / len(n_text), 2))
+    return 0
+
+
+# -----------------------------
+# qwen-serve: --serve smoke test on a tiny random Qwen2.5-VL (TCP + Unix socket round trips)
+# -----------------------------
+
+def tiny_qwen_model(processor, hidden=64, layers=2, seed=0):
+    """Randomly initialised Qwen2.5-VL with the real tokenizer's vocab: same code paths, no weight download."""
+    import torch
+    from transformers import Qwen2_5_VLConfig, Qwen2_5_VLForConditionalGeneration
+    tok = processor.tokenizer
+    config = Qwen2_5_VLConfig(
+        vocab_size=len(tok), hidden_size=hidden, intermediate_size=hidden * 2, num_hidden_layers=layers,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096,
+        rope_scaling={"type": "mrope", "mrope_section": [2, 3, 3]},   # sums to head_dim / 2 = 8
+        image_token_id=tok.convert_tokens_to_ids("<|image_pad|>"),
+        video_token_id=tok.convert_tokens_to_ids("<|video_pad|>"),
+        vision_start_token_id=tok.convert_tokens_to_ids("<|vision_start|>"),
+        vision_config={"depth": 2, "hidden_size": 32, "intermediate_size": 64, "num_heads": 2,
+                       "out_hidden_size": hidden, "fullatt_block_indexes": [1]},
+    )
+    torch.manual_seed(seed)
+    model = Qwen2_5_VLForConditionalGeneration(config).eval()
+    model.generation_config.eos_token_id = tok.convert_tokens_to_ids("<|im_end|>")
+    model.name_or_path = "tiny-random-qwen2.5-vl"
+    return model
+
+
+def _unix_http(socket_path):
+    import http.client, socket
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(socket_path)
+
+    return UnixHTTPConnection("localhost", timeout=120)
+
+
+def _http_json(conn, method, path, body=None):
+    payload = json.dumps(body).encode("utf-8") if body is not None else None
+    conn.request(method, path, body=payload, headers={"Content-Type": "application/json"} if payload else {})
+    resp = conn.getresponse()
+    data = resp.read()
+    conn.close()
+    return resp.status, json.loads(data or b"{}")
+
+
+def bench_qwen_serve(args):
+    import base64, http.client, tempfile, threading
+    from transformers import AutoProcessor
+    import qwen
+    processor = AutoProcessor.from_pretrained(args.processor_id)
+    model = tiny_qwen_model(processor)
+    defaults = {"max_new_tokens": args.max_new_tokens, "temperature": 0.7, "top_p": 0.9, "bg_prompt": False,
+                "seed": 0, "early_stop": True, "constrained": False, "ensemble": 1}
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, "bg.png")
+        random_image(args.size).convert("RGB").save(image)
+        with open(image, "rb") as f:
+            image_b64 = base64.b64encode(f.read()).decode("ascii")
+        service = qwen.LayoutService(model, processor, model.name_or_path, defaults, max_batch=2, max_wait_ms=20)
+        servers = [qwen.make_server(service, port=0), qwen.make_server(service, socket_path=os.path.join(tmp, "qwen.sock"))]
+        for httpd, _ in servers:
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            for httpd, where in servers:
+                if where.startswith("unix:"):
+                    connect = lambda: _unix_http(where[len("unix:"):])
+                else:
+                    connect = lambda: http.client.HTTPConnection("127.0.0.1", httpd.server_address[1], timeout=120)
+                checks = [
+                    ("health", "GET", "/health", None, 200),
+                    ("analyze_path", "POST", "/analyze", {"image": image, "product_name": "tiny"}, 200),
+                    ("analyze_b64", "POST", "/analyze", {"image_b64": image_b64, "product_name": "tiny",
+                                                         "options": {"constrained": True}}, 200),
+                    ("bad_option", "POST", "/analyze", {"image": image, "options": {"seed": [1]}}, 400),
+                    ("missing_image", "POST", "/analyze", {"image": os.path.join(tmp, "nope.png")}, 400),
+                    ("metrics", "GET", "/metrics", None, 200),
+                ]
+                for name, method, path, body, want in checks:
+                    t0 = time.perf_counter()
+                    status, obj = _http_json(connect(), method, path, body)
+                    ok = status == want and (name not in ("analyze_path", "analyze_b64") or "layout" in obj)
+                    failures += not ok
+                    emit(bench="qwen-serve", transport=where.split(":")[0], check=name, status=status, ok=ok,
+                         ms=round((time.perf_counter() - t0) * 1000, 1),
+                         **({"requests": obj.get("requests"), "batches": obj.get("batching", {}).get("batches")}
+                            if name == "metrics" else {}))
+        finally:
+            for httpd, _ in servers:
+                httpd.shutdown()
+                httpd.server_close()
+    return 0 if failures == 0 else 1
+
+
+# -----------------------------
+# nano-batch: Stage 3 manifest throughput vs in-flight limit (fake local server)
+# -----------------------------
+
+def bench_nano_batch(args):
+    import asyncio, tempfile, contextlib, io
+    from PIL import Image
+    import nano_banana_generate as nb
+    from api_limiter import ApiLimiter
+    from fake_genai_server import start_server
+    httpd, state, base_url = start_server(delay=args.delay, jitter=args.jitter, error_rate=args.error_rate)
+    client = nb.make_client(base_url)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            layout_path = os.path.join(tmp, "layout.json")
+            with open(layout_path, "w", encoding="utf-8") as f:
+                json.dump(SAMPLE_LAYOUT, f)
+            for c in [int(v) for v in args.concurrency.split(",")]:
+                manifest = os.path.join(tmp, f"jobs_{c}.jsonl")
+                with open(manifest, "w", encoding="utf-8") as f:
+                    for j in range(args.jobs):
+                        img = os.path.join(tmp, f"in_{j}.png")
+                        if not os.path.exists(img):
+                            random_image(args.size, seed=j).convert("RGB").save(img)
+                        f.write(json.dumps({"image": img, "layout_json": layout_path,
+                                            "out": os.path.join(tmp, f"out_{c}_{j}.png")}) + "\n")
+                with state.lock:
+                    state.requests = state.errors = state.max_inflight = 0
+                    state.arrivals = []
+                out = io.StringIO()
+                t0 = time.perf_counter()
+                with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+                    limiter = ApiLimiter(rpm=args.rpm, concurrency=c, max_concurrency=c, base_delay=0.2, seed=0)
+                    rc = asyncio.run(nb.run_manifest(client, manifest, "fake-model", args.size, c, limiter))
+                dt = time.perf_counter() - t0
+                recs = [json.loads(line) for line in out.getvalue().splitlines() if line.strip()]
+                # 가짜 서버는 입력 이미지를 그대로 돌려줌 → 결과가 올바른 out 경로에 저장됐는지 확인
+                misrouted = 0
+                for r in recs:
+                    if r["status"] == "ok":
+                        j = int(os.path.splitext(r["out"])[0].rsplit("_", 1)[1])
+                        misrouted += nb.resize_max_side(Image.open(os.path.join(tmp, f"in_{j}.png")).convert("RGB"),
+                                                        args.size).tobytes() != Image.open(r["out"]).convert("RGB").tobytes()
+                done_order = [r["line"] for r in recs]
+                emit(bench="nano-batch", concurrency=c, jobs=args.jobs, rc=rc, seconds=round(dt, 3),
+                     jobs_per_s=round(args.jobs / dt, 2), ok=sum(r["status"] == "ok" for r in recs),
+                     max_inflight=state.max_inflight, misrouted=misrouted, server_errors=state.errors,
+                     retries=limiter.stats()["endpoints"]["generate_content"]["retries"],
+                     final_concurrency_limit=limiter.concurrency.stats()["limit"],
+                     completed_in_manifest_order=done_order == sorted(done_order),
+                     first_error=next((r.get("error") for r in recs if r["status"] != "ok"), None))
+    finally:
+        httpd.shutdown()
+    return 0
+
+
+# -----------------------------
+# upload: Stage 3 upload preparation (encode once / passthrough / reduce+LANCZOS) vs legacy double PNG
+# -----------------------------
+
+def photo_like(w: int, h: int):
+    from PIL import Image
+    r = Image.linear_gradient("L").resize((w, h))
+    g = Image.radial_gradient("L").resize((w, h))
+    b = Image.blend(r, Image.effect_noise((w, h), 48), 0.35)
+    return Image.merge("RGB", (r, g, b))
+
+
+def psnr(a, b) -> float:
+    import numpy as np
+    d = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+    mse = float((d * d).mean())
+    return round(10 * np.log10(255 ** 2 / mse), 2) if mse else float("inf")
+
+
+def bench_upload(args):
+    import io, tempfile
+    from PIL import Image
+    import nano_banana_generate as nb
+
+    def legacy(path):
+        # 기존 main(): 디코드 → LANCZOS 전체 리사이즈 → PNG(미사용 버퍼) → SDK가 PIL을 다시 PNG로 인코딩
+        img = Image.open(path).convert("RGB")
+        w, h = img.size
+        size = (args.max_side, int(h * args.max_side / w)) if w >= h else (int(w * args.max_side / h), args.max_side)
+        img = img.resize(size, Image.LANCZOS) if max(w, h) > args.max_side else img
+        img.save(io.BytesIO(), format="PNG")
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        return img, buf.getvalue()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for spec in args.sizes.split(","):
+            w, h = (int(v) for v in spec.split("x"))
+            src = os.path.join(tmp, f"{spec}.jpg")
+            photo_like(w, h).save(src, quality=92)
+            ref_img, ref_bytes = legacy(src)
+            t_legacy = timeit(lambda: legacy(src), args.repeat)
+            emit(bench="upload", src=spec, mode="legacy-png-x2", ms=round(t_legacy * 1000, 1), kb=round(len(ref_bytes) / 1024))
+            for codec in args.codecs.split(","):
+                up = nb.prepare_upload(src, args.max_side, codec, args.quality)
+                t = timeit(lambda: nb.prepare_upload(src, args.max_side, codec, args.quality), args.repeat)
+                out = Image.open(io.BytesIO(up["data"])).convert("RGB")
+                emit(bench="upload", src=spec, mode=codec, ms=round(t * 1000, 1), kb=round(len(up["data"]) / 1024),
+                     speedup=round(t_legacy / t, 2), passthrough=up["passthrough"], size=list(up["size"]),
+                     psnr_vs_legacy=psnr(out, ref_img), stages_ms=up["timings"])
+    return 0
+
+
+# -----------------------------
+# imgload: draft (DCT-scaled) JPEG decode vs full decode — time + peak RSS per process
+# -----------------------------
+
+def _imgload_op(case: str, mode: str, path: str):
+    from PIL import Image
+    import image_loader
+    if case == "stage3":
+        if mode == "legacy":
+            img = Image.open(path).convert("RGB")
+            return img.resize(image_loader.target_size(img.size, 1024), Image.LANCZOS)
+        return image_loader.load_resized(path, 1024)
+    # palette (qwen.extract_palette_hex): 256px thumbnail
+    if mode == "legacy":
+        im = Image.open(path).convert("RGB").copy()
+    else:
+        im = image_loader.open_image(path, max_side=256)
+    im.thumbnail((256, 256))
+    return im
+
+
+def peak_rss_kb() -> int:
+    # VmHWM starts fresh at exec; ru_maxrss is inherited from the forking parent on Linux
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _imgload_worker(args):
+    case, mode, path = args.worker.split(":", 2)
+    from PIL import Image  # noqa: F401  (baseline RSS includes the imports)
+    import image_loader    # noqa: F401
+    base = peak_rss_kb()
+    out = _imgload_op(case, mode, path)
+    peak = peak_rss_kb()
+    t = timeit(lambda: _imgload_op(case, mode, path), args.repeat)
+    print(json.dumps({"ms": round(t * 1000, 1), "peak_mb": round((peak - base) / 1024, 1), "size": list(out.size)}))
+    return 0
+
+
+def bench_imgload(args):
+    import subprocess, tempfile
+    from PIL import Image
+    if args.worker:
+        return _imgload_worker(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        for spec in args.sizes.split(","):
+            w, h = (int(v) for v in spec.split("x"))
+            src = os.path.join(tmp, f"{spec}.jpg")
+            photo_like(w, h).save(src, quality=92)
+            for case in ("stage3", "palette"):
+                res = {}
+                for mode in ("legacy", "draft"):
+                    out = subprocess.run([sys.executable, os.path.abspath(__file__), "imgload", "--repeat", str(args.repeat),
+                                          "--worker", f"{case}:{mode}:{src}"], capture_output=True, text=True,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+                    res[mode] = json.loads(out.stdout.strip().splitlines()[-1])
+                a, b = _imgload_op(case, "legacy", src), _imgload_op(case, "draft", src)
+                emit(bench="imgload", src=spec, case=case, legacy_ms=res["legacy"]["ms"], draft_ms=res["draft"]["ms"],
+                     speedup=round(res["legacy"]["ms"] / max(res["draft"]["ms"], 1e-3), 2),
+                     legacy_peak_mb=res["legacy"]["peak_mb"], draft_peak_mb=res["draft"]["peak_mb"],
+                     size=res["draft"]["size"], same_size=a.size == b.size,
+                     psnr_vs_legacy=psnr(a, b) if a.size == b.size else None)
+    return 0
+
+
+# -----------------------------
+# Main
+# -----------------------------
+
+def main():
+    ap = argparse.ArgumentParser(description="share/ 파이프라인 벤치마크")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("luma", help="avg_luma: NumPy LUT 엔진/적분영상 vs 기존 루프 (일치 여부 + 속도)")
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--n_boxes", type=int, default=64)
+    p.add_argument("--tol", type=float, default=1e-6)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_luma)
+
+    p = sub.add_parser("wrap", help="wrap_text_to_width: 글리프 폭 테이블 vs 기존 접두사 재측정 (일치 여부 + 속도)")
+    p.add_argument("--font", default=None, help="폰트 경로(.ttf/.otf). 없으면 pilow.resolve_font_path 규칙")
+    p.add_argument("--n_random", type=int, default=40)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_wrap)
+
+    p = sub.add_parser("fit", help="fit_text_in_box: analytic vs binary 전략의 박스당 시간 (헤드라인 / 200자 본문)")
+    p.add_argument("--font", default=None, help="폰트 경로(.ttf/.otf). 없으면 pilow.resolve_font_path 규칙")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--trials", type=int, default=40, help="analytic vs binary 크기 일치 검사 횟수")
+    p.set_defaults(fn=bench_fit)
+
+    p = sub.add_parser("render", help="pilow --jobs 배치: 워커 수별 처리량(jobs/s)과 확장성")
+    p.add_argument("--font", default=None, help="폰트 경로(.ttf/.otf). 없으면 pilow.resolve_font_path 규칙")
+    p.add_argument("--jobs", type=int, default=48)
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--workers", default=",".join(str(w) for w in (1, 2, 4, 8, 16, 32) if w <= (os.cpu_count() or 1)) or "1",
+                   help="쉼표로 구분한 워커 수 목록")
+    p.add_argument("--glass", action="store_true", help="--glass_underlay 포함(블러 부하)")
+    p.set_defaults(fn=bench_render)
+
+    p = sub.add_parser("glass", help="glass 패널: 공유 블러 버퍼 vs 박스별 블러 (1024/2048/4096px)")
+    p.add_argument("--blur", type=float, default=6, help="1024px 기준 블러 반경(해상도에 비례해 스케일)")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_glass)
+
+    p = sub.add_parser("jsonscan", help="JSON 조기 종료 스캐너: raw_decode와 일치 여부 + 생략된 꼬리 비율")
+    p.add_argument("--n", type=int, default=500)
+    p.set_defaults(fn=bench_jsonscan)
+
+    p = sub.add_parser("grammar", help="제약 디코딩 문법: 토이 토크나이저로 무작위 생성 → JSON 유효성 + 강제 토큰 비율")
+    p.add_argument("--n", type=int, default=300)
+    p.set_defaults(fn=bench_grammar)
+
+    p = sub.add_parser("boxes", help="qwen 후처리: 배열 기반 NMS/텍스트 규칙 vs 기존 루프 (일치 여부 + 속도)")
+    p.add_argument("--sizes", default="10,100,500")
+    p.add_argument("--trials", type=int, default=20)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_boxes)
+
+    p = sub.add_parser("qwen-batch", help="qwen 레이아웃 분석: 배치 크기별 처리량(images/min)")
+    p.add_argument("--model_id", default="Qwen/Qwen2.5-VL-7B-Instruct")
+    p.add_argument("--images", default=None, help="입력 이미지 glob (없으면 합성 이미지)")
+    p.add_argument("--size", type=int, default=768)
+    p.add_argument("--n", type=int, default=16, help="측정할 이미지 수")
+    p.add_argument("--batch_sizes", default="1,2,4,8")
+    p.add_argument("--max_wait_ms", type=float, default=50)
+    p.add_argument("--max_new_tokens", type=int, default=640)
+    p.add_argument("--bg_prompt", action="store_true", help="2패스(배경 프롬프트)까지 포함")
+    p.set_defaults(fn=bench_qwen_batch)
+
+    p = sub.add_parser("qwen-quant", help="qwen CPU 양자화 백엔드: 지연/최대 RSS/레이아웃 일치도 (백엔드별 하위 프로세스)")
+    p.add_argument("--model_id", default="Qwen/Qwen2.5-VL-7B-Instruct")
+    p.add_argument("--images", required=True, help="입력 이미지 glob")
+    p.add_argument("--n", type=int, default=4)
+    p.add_argument("--backends", default="auto,cpu-int8,cpu-int4", help="첫 번째가 일치도 비교 기준")
+    p.add_argument("--threads", type=int, default=None)
+    p.add_argument("--max_new_tokens", type=int, default=640)
+    p.add_argument("--constrained", action="store_true")
+    p.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    p.set_defaults(fn=bench_qwen_quant)
+
+    p = sub.add_parser("qwen-ensemble", help="qwen 앙상블: K(1/4/8)개 샘플 배치 생성의 이미지당 지연")
+    p.add_argument("--model_id", default="Qwen/Qwen2.5-VL-7B-Instruct")
+    p.add_argument("--images", required=True, help="입력 이미지 glob")
+    p.add_argument("--n", type=int, default=4)
+    p.add_argument("--ks", default="1,4,8")
+    p.add_argument("--backend", default="auto")
+    p.add_argument("--threads", type=int, default=None)
+    p.add_argument("--max_new_tokens", type=int, default=640)
+    p.set_defaults(fn=bench_qwen_ensemble)
+
+    p = sub.add_parser("qwen-serve", help="qwen --serve 스모크 테스트: 작은 랜덤 Qwen2.5-VL로 TCP/Unix 소켓 왕복 (가중치 다운로드 없음)")
+    p.add_argument("--processor_id", default="Qwen/Qwen2.5-VL-7B-Instruct",
+                   help="토크나이저/이미지 프로세서만 사용 (HF 캐시 또는 로컬 경로)")
+    p.add_argument("--size", type=int, default=112)
+    p.add_argument("--max_new_tokens", type=int, default=24)
+    p.set_defaults(fn=bench_qwen_serve)
+
+    p = sub.add_parser("nano-batch", help="nano_banana --manifest: 동시 요청 수별 처리량 (가짜 로컬 서버, 오프라인)")
+    p.add_argument("--jobs", type=int, default=24)
+    p.add_argument("--size", type=int, default=512)
+    p.add_argument("--concurrency", default="1,4,8,16")
+    p.add_argument("--delay", type=float, default=0.3, help="가짜 서버의 요청당 지연(초)")
+    p.add_argument("--jitter", type=float, default=0.2)
+    p.add_argument("--error_rate", type=float, default=0.0, help="가짜 서버의 429/503 비율 (재시도/AIMD 확인)")
+    p.add_argument("--rpm", type=float, default=None)
+    p.set_defaults(fn=bench_nano_batch)
+
+    p = sub.add_parser("upload", help="nano_banana 업로드 준비: 1회 인코딩/원본 통과/reduce 리사이즈 vs 기존 PNG 2회 (시간, 크기, PSNR)")
+    p.add_argument("--sizes", default="1024x768,3840x2160,6000x4000", help="원본 크기 목록 (WxH, 합성 JPEG)")
+    p.add_argument("--max_side", type=int, default=1024)
+    p.add_argument("--codecs", default="png,webp,jpeg")
+    p.add_argument("--quality", type=int, default=90)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_upload)
+
+    p = sub.add_parser("imgload", help="image_loader: JPEG draft 디코드 vs 전체 디코드 (시간, 최대 RSS, PSNR; 케이스별 하위 프로세스)")
+    p.add_argument("--sizes", default="3840x2160,6000x4000", help="원본 크기 목록 (WxH, 합성 JPEG)")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    p.set_defaults(fn=bench_imgload)
+
+    args = ap.parse_args()
+    sys.exit(args.fn(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import numpy as np
+from typing import List, Optional, Sequence
+
+"""
+Array-backed layout boxes for qwen.py post-processing
+-----------------------------------------------------
+- BoxSet: the dict boxes of a layout section as columns — bbox (N,4) [x,y,w,h] float64, confidence (N,), type (N,)
+  plus the original dicts (items) so results are written back in place
+- clip(): same arithmetic as qwen.clip_bbox (min/max order kept, so the values are bit-identical)
+- iou_matrix(a, b): pairwise IoU, same formula/order as qwen.iou
+- nms(): greedy NMS over a stable descending-confidence order (ties keep input order, like list.sort)
+- enforce_text_rules(): subject-overlap / margin / aspect-ratio filters as one boolean mask
+- weighted_box_fusion(): merge boxes of the same type from K samples (confidence-weighted mean per cluster)
+"""
+
+
+def _min1(v):
+    # python min(1.0, v) / max(0.0, v) semantics (NaN -> bound), kept for bit-identical clipping
+    return np.where(v < 1.0, v, 1.0)
+
+
+def _max0(v):
+    return np.where(v > 0.0, v, 0.0)
+
+
+def clip(bbox: np.ndarray) -> np.ndarray:
+    """(N,4) x,y,w,h -> clipped to [0,1] with w/h shrunk so the box stays inside."""
+    x, y, w, h = (_max0(_min1(bbox[:, i])) for i in range(4))
+    w = np.where(x + w > 1, _max0(1 - x), w)
+    h = np.where(y + h > 1, _max0(1 - y), h)
+    return np.stack([x, y, w, h], axis=1)
+
+
+def iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """(N,4) x (M,4) -> (N,M) IoU of [x,y,w,h] boxes."""
+    x1, y1, w1, h1 = (a[:, None, i] for i in range(4))
+    x2, y2, w2, h2 = (b[None, :, i] for i in range(4))
+    xa = np.maximum(x1, x2); ya = np.maximum(y1, y2)
+    xb = np.minimum(x1 + w1, x2 + w2); yb = np.minimum(y1 + h1, y2 + h2)
+    inter = _max0(xb - xa) * _max0(yb - ya)
+    a1 = _max0(w1 * h1); a2 = _max0(w2 * h2)
+    union = a1 + a2 - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1.0), 0.0)
+
+
+class BoxSet:
+    def __init__(self, items: List[dict], bbox: np.ndarray):
+        self.items = items
+        self.bbox = bbox.reshape(-1, 4)
+
+    @classmethod
+    def from_items(cls, items: Sequence[dict], default_bbox: Optional[list] = None) -> "BoxSet":
+        """Boxes whose bbox is a 4-element list (missing bbox -> default_bbox when given)."""
+        kept, rows = [], []
+        for it in items:
+            b = it.get("bbox", default_bbox) if default_bbox is not None else it.get("bbox")
+            if isinstance(b, list) and len(b) == 4:
+                kept.append(it)
+                rows.append(b)
+        return cls(kept, np.asarray(rows, dtype=np.float64))
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    @property
+    def confidence(self) -> np.ndarray:
+        return np.asarray([float(it.get("confidence", 0.5)) for it in self.items], dtype=np.float64)
+
+    @property
+    def types(self) -> np.ndarray:
+        return np.asarray([it.get("type") for it in self.items], dtype=object)
+
+    def clipped(self) -> "BoxSet":
+        return BoxSet(self.items, clip(self.bbox))
+
+    def take(self, idx) -> "BoxSet":
+        idx = np.flatnonzero(idx) if np.asarray(idx).dtype == bool else np.asarray(idx, dtype=np.int64)
+        return BoxSet([self.items[i] for i in idx], self.bbox[idx])
+
+    def iou_to(self, box: Sequence[float]) -> np.ndarray:
+        return iou_matrix(self.bbox, np.asarray([box], dtype=np.float64))[:, 0]
+
+    def nms(self, iou_thr: float = 0.3) -> "BoxSet":
+        if not len(self):
+            return self
+        order = np.argsort(-self.confidence, kind="stable")
+        s = self.take(order)
+        ious = iou_matrix(s.bbox, s.bbox)
+        n = len(s)
+        suppressed = np.zeros(n, dtype=bool)
+        keep = []
+        for i in range(n):
+            if suppressed[i]:
+                continue
+            keep.append(i)
+            suppressed[i + 1:] |= ~(ious[i, i + 1:] < iou_thr)   # kept only if IoU < thr with every kept box
+        return s.take(keep)
+
+
+def nms(boxes: Sequence[dict], iou_thr: float = 0.3) -> List[dict]:
+    return BoxSet.from_items(boxes).nms(iou_thr).items
+
+
+def enforce_text_rules(items, subject_bbox, min_ar=1.8, min_margin=0.03, max_iou=0.2) -> List[dict]:
+    bs = BoxSet.from_items(items, default_bbox=[0, 0, 0, 0]).clipped()
+    if not len(bs):
+        return []
+    x, y, w, h = bs.bbox.T
+    drop = np.zeros(len(bs), dtype=bool)
+    if subject_bbox:
+        drop |= bs.iou_to(subject_bbox) >= max_iou
+    drop |= (x < min_margin) | (y < min_margin) | (x + w > 1 - min_margin) | (y + h > 1 - min_margin)
+    ar = np.where(h > 0, w / np.where(h > 0, h, 1.0), 999)
+    drop |= ar < min_ar
+    out = []
+    for i in np.flatnonzero(~drop):
+        it = bs.items[i]
+        it["confidence"] = float(it.get("confidence", 0.5))
+        it["bbox"] = bs.bbox[i].tolist()
+        out.append(it)
+    return out
+
+
+def weighted_box_fusion(items: Sequence[dict], n_samples: int, iou_thr: float = 0.55) -> List[dict]:
+    """Confidence-weighted box fusion of candidates pooled from n_samples generations.
+
+    Boxes are visited in descending confidence (stable); each joins the same-type cluster whose fused box
+    overlaps it most (IoU > iou_thr) or starts a new one. The fused bbox is the confidence-weighted mean,
+    the fused confidence the members' mean scaled by min(members, n_samples) / n_samples, so a box only
+    one sample proposed loses weight. Other fields come from the cluster's most confident member.
+    """
+    bs = BoxSet.from_items(items)
+    if not len(bs):
+        return []
+    conf = bs.confidence
+    order = np.argsort(-conf, kind="stable")
+    types = bs.types
+    fused = np.zeros((0, 4), dtype=np.float64)
+    fused_type: List = []
+    members: List[List[int]] = []
+    for i in order:
+        j = -1
+        if len(fused):
+            ious = iou_matrix(bs.bbox[i:i+1], fused)[0]
+            ious[[t != types[i] for t in fused_type]] = -1.0
+            j = int(np.argmax(ious)) if ious.max() > iou_thr else -1
+        if j < 0:
+            fused = np.vstack([fused, bs.bbox[i]])
+            fused_type.append(types[i])
+            members.append([i])
+        else:
+            members[j].append(i)
+            w = conf[members[j]]
+            fused[j] = (bs.bbox[members[j]] * w[:, None]).sum(0) / max(w.sum(), 1e-12)
+    out = []
+    for j, idx in enumerate(members):
+        w = conf[idx]
+        it = dict(bs.items[idx[0]])
+        it["bbox"] = fused[j].tolist()
+        it["confidence"] = float(w.mean() * min(len(idx), n_samples) / n_samples)
+        it["votes"] = len(idx)
+        out.append(it)
+    return out
@@ -0,0 +1,151 @@
+import os, json, time, struct, hashlib, tempfile, threading
+from typing import Any, Optional
+
+"""
+Content-addressed on-disk cache shared by the share/ scripts
+------------------------------------------------------------
+- key(*parts): sha256 over a canonical JSON dump of the parts (dicts sorted, non-JSON values via str)
+- file_digest()/bytes_digest(): content hashes for images and other inputs
+- entries live in <root>/<k[:2]>/<k>.bin, written atomically (tempfile + os.replace); each file starts with a
+  12-byte header (magic + creation time) so the TTL does not depend on the file mtime
+- size-bounded LRU: a hit bumps the file mtime, eviction drops the oldest files once the total exceeds max_bytes
+- optional TTL (seconds): entries created longer ago count as misses and are removed (reads do not extend it)
+- refresh=True: every lookup misses but results are still written (re-populate without clearing)
+- stats(): hits / misses / writes / evictions / expired / entries / bytes
+"""
+
+
+HEADER = struct.Struct(">4sd")   # magic, creation time (epoch seconds)
+MAGIC = b"DCv1"
+
+
+def key(*parts: Any) -> str:
+    blob = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def bytes_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path: str, chunk: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class DiskCache:
+    def __init__(self, root: str, max_bytes: int = 512 << 20, ttl: Optional[float] = None, refresh: bool = False):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_bytes = int(max_bytes)
+        self.ttl = ttl
+        self.refresh = refresh
+        self.hits = self.misses = self.writes = self.evictions = self.expired = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._sizes = {}   # path -> bytes (entries currently on disk)
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".bin"):
+                    p = os.path.join(dirpath, name)
+                    try:
+                        self._sizes[p] = os.path.getsize(p)
+                    except OSError:
+                        pass
+        self._total = sum(self._sizes.values())
+
+    def _path(self, k: str) -> str:
+        return os.path.join(self.root, k[:2], k + ".bin")
+
+    # -----------------------------
+    # bytes API
+    # -----------------------------
+
+    def get_bytes(self, k: str) -> Optional[bytes]:
+        path = self._path(k)
+        with self._lock:
+            if self.refresh:
+                self.misses += 1
+                return None
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                if data[:len(MAGIC)] == MAGIC and len(data) >= HEADER.size:
+                    created = HEADER.unpack_from(data)[1]
+                    data = data[HEADER.size:]
+                else:   # entry written before the header existed: fall back to its mtime
+                    created = os.stat(path).st_mtime
+                if self.ttl is not None and time.time() - created > self.ttl:
+                    self._remove(path)
+                    self.expired += 1
+                    self.misses += 1
+                    return None
+                os.utime(path)   # LRU: most recently used = newest mtime (the TTL uses the header time)
+            except OSError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return data
+
+    def put_bytes(self, k: str, data: bytes) -> None:
+        path = self._path(k)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, time.time()))
+            f.write(data)
+        os.replace(tmp, path)
+        size = HEADER.size + len(data)
+        with self._lock:
+            self._total += size - self._sizes.get(path, 0)
+            self._sizes[path] = size
+            self.writes += 1
+            if self._total > self.max_bytes:
+                self._evict()
+
+    # -----------------------------
+    # JSON API
+    # -----------------------------
+
+    def get_json(self, k: str) -> Any:
+        data = self.get_bytes(k)
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            return None
+
+    def put_json(self, k: str, obj: Any) -> None:
+        self.put_bytes(k, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+    # -----------------------------
+    # eviction / stats
+    # -----------------------------
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self._total -= self._sizes.pop(path, 0)
+
+    def _evict(self) -> None:
+        def mtime(p):
+            try:
+                return os.stat(p).st_mtime
+            except OSError:
+                return 0.0
+        for path in sorted(self._sizes, key=mtime):
+            if self._total <= self.max_bytes:
+                break
+            self._remove(path)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"dir": self.root, "entries": len(self._sizes), "bytes": self._total, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "writes": self.writes, "evictions": self.evictions, "expired": self.expired}
@@ -0,0 +1,171 @@
+# fake_genai_server.py
+# Stage 3 오프라인 테스트용 가짜 Gemini(google-genai) REST 서버 (표준 라이브러리만 사용)
+# - POST /v1beta/models/{model}:generateContent → 입력 이미지 파트를 그대로 돌려주는 응답 (지연 시간 설정 가능)
+#   :streamGenerateContent(alt=sse)도 같은 응답을 SSE 한 덩어리로 전송
+# - --error_rate: 일정 비율로 429(Retry-After 포함)/503 응답 → 재시도/속도 제한 테스트
+# - GET /stats: 요청 수, 최대 동시 처리 수(max_inflight), 에러 수, 도착 순서(프롬프트 해시)
+# 사용: python fake_genai_server.py --port 8089 --delay 0.5
+#       python nano_banana_generate.py --manifest jobs.jsonl --base_url http://127.0.0.1:8089
+
+import json
+import time
+import hashlib
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 1x1 투명 PNG (요청에 이미지가 없을 때 응답용)
+BLANK_PNG_B64 = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+
+class FakeState:
+    def __init__(self, delay=0.5, jitter=0.0, error_rate=0.0, retry_after=1.0, seed=0):
+        self.delay = delay
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.arrivals = []   # 요청 프롬프트 해시(12자리), 도착 순서 확인용
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors, "inflight": self.inflight,
+                    "max_inflight": self.max_inflight, "arrivals": list(self.arrivals)}
+
+
+def build_response(req):
+    """요청의 첫 inlineData 이미지를 그대로 응답 이미지로 사용 + 짧은 텍스트 파트"""
+    image = None
+    for content in req.get("contents", []) or []:
+        for part in content.get("parts", []) or []:
+            blob = part.get("inlineData") or part.get("inline_data")
+            if blob and image is None:
+                image = {"mimeType": blob.get("mimeType") or blob.get("mime_type") or "image/png",
+                         "data": blob.get("data")}
+    image = image or {"mimeType": "image/png", "data": BLANK_PNG_B64}
+    return {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": "fake render"}, {"inlineData": image}]},
+            "finishReason": "STOP",
+            "index": 0,
+        }],
+        "usageMetadata": {"promptTokenCount": 1290, "candidatesTokenCount": 1290, "totalTokenCount": 2580},
+    }
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128   # 기본 listen backlog(5)로는 동시 접속 폭주 시 연결이 거부됨
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass
+
+        def _send(self, code, obj, headers=None):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, state.snapshot())
+            else:
+                self._send(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+
+        def _send_sse(self, obj):
+            body = b"data: " + json.dumps(obj).encode("utf-8") + b"\r\n\r\n"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            stream = ":streamGenerateContent" in self.path
+            if ":generateContent" not in self.path and not stream:
+                self._send(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+                return
+            n = int(self.headers.get("Content-Length") or 0)
+            try:
+                req = json.loads(self.rfile.read(n) or b"{}")
+            except ValueError:
+                self._send(400, {"error": {"code": 400, "message": "bad json", "status": "INVALID_ARGUMENT"}})
+                return
+            text = next((p.get("text", "") for c in req.get("contents", []) or [] for p in c.get("parts", []) or []
+                         if p.get("text")), "")
+            with state.lock:
+                state.requests += 1
+                state.inflight += 1
+                state.max_inflight = max(state.max_inflight, state.inflight)
+                state.arrivals.append(hashlib.sha256(text.encode("utf-8")).hexdigest()[:12])
+                fail = state.rng.random() < state.error_rate
+                code = state.rng.choice([429, 503]) if fail else 200
+                delay = state.delay + state.rng.uniform(0, state.jitter)
+            try:
+                time.sleep(delay)
+                if code == 429:
+                    with state.lock:
+                        state.errors += 1
+                    self._send(429, {"error": {"code": 429, "message": "Resource exhausted", "status": "RESOURCE_EXHAUSTED"}},
+                               {"Retry-After": f"{state.retry_after:g}"})
+                elif code == 503:
+                    with state.lock:
+                        state.errors += 1
+                    self._send(503, {"error": {"code": 503, "message": "unavailable", "status": "UNAVAILABLE"}})
+                elif stream:
+                    self._send_sse(build_response(req))
+                else:
+                    self._send(200, build_response(req))
+            finally:
+                with state.lock:
+                    state.inflight -= 1
+
+    return Handler
+
+
+def start_server(host="127.0.0.1", port=0, **state_kwargs):
+    """백그라운드 스레드로 서버 시작 → (httpd, state, base_url). 테스트/벤치에서 사용"""
+    state = FakeState(**state_kwargs)
+    httpd = FakeServer((host, port), make_handler(state))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, state, f"http://{host}:{httpd.server_address[1]}"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fake google-genai generateContent server for offline Stage 3 tests.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8089)
+    ap.add_argument("--delay", type=float, default=0.5, help="Seconds per request (simulated generation latency).")
+    ap.add_argument("--jitter", type=float, default=0.0, help="Extra uniform random delay (seconds).")
+    ap.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with 429/503.")
+    ap.add_argument("--retry_after", type=float, default=1.0, help="Retry-After seconds sent with 429.")
+    args = ap.parse_args()
+
+    state = FakeState(args.delay, args.jitter, args.error_rate, args.retry_after)
+    httpd = FakeServer((args.host, args.port), make_handler(state))
+    print(f"[fake genai] http://{args.host}:{args.port}  (POST /v1beta/models/<model>:generateContent, GET /stats)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
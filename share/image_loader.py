@@ -0,0 +1,71 @@
+import math
+from typing import BinaryIO, Optional, Tuple, Union
+from PIL import Image
+
+"""
+Shared image loader for the Stage 1 (qwen.py) / Stage 3 (nano_banana_generate.py) inputs
+----------------------------------------------------------------------------------------
+- image_size(): header-only (W, H), file closed right away
+- draft_decode(): JPEG sources much larger than the target are decoded at 1/2, 1/4 or 1/8 scale straight
+  from the DCT coefficients (Image.draft) before the pixels are read; other formats decode normally
+- open_image(): Image.open + draft_decode (max_side=None -> plain full decode)
+- resize_max_side(): max-side fit; integer Image.reduce() first when the source is >= reducing_gap x target,
+  LANCZOS for the final step (output size always computed from the original dimensions)
+- load_resized(): open + draft decode + resize in one call
+The draft keeps at least reducing_gap x the target resolution, so the final LANCZOS step still has
+oversampled input to work with.
+"""
+
+Source = Union[str, BinaryIO]
+
+
+def image_size(src: Source) -> Tuple[int, int]:
+    with Image.open(src) as im:
+        return im.size
+
+
+def target_size(size: Tuple[int, int], max_side: int) -> Optional[Tuple[int, int]]:
+    """(w, h) after fitting the longer side to max_side, or None when no resize is needed."""
+    w, h = size
+    if max(w, h) <= max_side:
+        return None
+    if w >= h:
+        return (max_side, int(h * max_side / w))
+    return (int(w * max_side / h), max_side)
+
+
+def draft_decode(im: Image.Image, max_side: Optional[int] = None, mode: str = "RGB",
+                 reducing_gap: float = 2.0) -> Image.Image:
+    """Decode a freshly opened image; JPEG uses DCT scaling when max_side * reducing_gap is <= half the source."""
+    if max_side and reducing_gap and im.format == "JPEG":
+        w, h = im.size
+        s = max_side * reducing_gap / max(w, h)
+        if s <= 0.5:
+            im.draft(None, (max(1, math.ceil(w * s)), max(1, math.ceil(h * s))))
+    if mode and im.mode != mode:
+        return im.convert(mode)
+    im.load()
+    return im
+
+
+def open_image(src: Source, max_side: Optional[int] = None, mode: str = "RGB", reducing_gap: float = 2.0) -> Image.Image:
+    return draft_decode(Image.open(src), max_side, mode, reducing_gap)
+
+
+def resize_max_side(img: Image.Image, max_side: int = 1024, reducing_gap: float = 2.0,
+                    size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """size: final size when known from the original header (draft-decoded images are already smaller)."""
+    size = size or target_size(img.size, max_side)
+    if size is None:
+        return img
+    factor = int(max(img.size) / (max(size) * reducing_gap)) if reducing_gap else 1
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img.resize(size, Image.LANCZOS)
+
+
+def load_resized(src: Source, max_side: int, mode: str = "RGB", reducing_gap: float = 2.0) -> Image.Image:
+    im = Image.open(src)
+    size = target_size(im.size, max_side)
+    im = draft_decode(im, max_side if size else None, mode, reducing_gap)
+    return resize_max_side(im, max_side, reducing_gap, size) if size else im
@@ -0,0 +1,254 @@
+import re, json
+from typing import Callable, Dict, List, Optional, Sequence
+import numpy as np
+
+"""
+Token-level JSON grammar for constrained decoding
+-------------------------------------------------
+- schema specs: dict = object (keys emitted in order), list = fixed-length array,
+  Str(max_len), Num(decimals) in 0~1, Enum(*options), Arr(item, min_items, max_items)
+- compile(): flattens the schema into a small program of ops
+    lit   fixed text (keys, braces, commas, quotes) -> forced token by token (canonical tokenization)
+    str   free string content until the closing quote, capped at max_len characters
+    num   0~1 number, digits/'.' tokens checked against a prefix pattern
+    enum  one of the options (token sequences of option + closing quote)
+    opt   optional array body (min_items=0): enter the item or jump to the closing bracket
+    loop  after an array item: ',' -> next item (up to max_items) or fall through to ']'
+    end   only EOS
+- TokenGrammar: per-tokenizer token classification (plain string tokens / numeric tokens) + the program;
+  allowed(state) -> token ids or a vocab mask, advance(state, tok), forced_run(state) for fast-forwarding
+  structural tokens without sampling
+"""
+
+
+# -----------------------------
+# Schema specs
+# -----------------------------
+
+class Str:
+    def __init__(self, max_len: int = 80):
+        self.max_len = max_len
+
+
+class Num:
+    def __init__(self, decimals: int = 4):
+        self.decimals = decimals
+
+
+class Enum:
+    def __init__(self, *options: str):
+        self.options = options
+
+
+class Arr:
+    def __init__(self, item, min_items: int = 1, max_items: int = 8):
+        self.item = item
+        self.min_items = min_items
+        self.max_items = max_items
+
+
+# -----------------------------
+# Schema -> flat program
+# -----------------------------
+
+class _Compiler:
+    def __init__(self):
+        self.prog: List[tuple] = []
+        self.barrier = 0      # ops before this index are jump targets' predecessors: never merge into them
+        self.loops = 0
+
+    def label(self) -> int:
+        self.barrier = len(self.prog)
+        return self.barrier
+
+    def lit(self, text: str) -> None:
+        if self.prog and len(self.prog) - 1 >= self.barrier and self.prog[-1][0] == "lit":
+            self.prog[-1] = ("lit", self.prog[-1][1] + text)
+        else:
+            self.prog.append(("lit", text))
+
+    def op(self, *op) -> int:
+        self.prog.append(op)
+        self.barrier = len(self.prog)
+        return len(self.prog) - 1
+
+    def emit(self, spec) -> None:
+        if isinstance(spec, dict):
+            for i, (k, v) in enumerate(spec.items()):
+                self.lit(("{" if i == 0 else ",") + json.dumps(k, ensure_ascii=False) + ":")
+                self.emit(v)
+            self.lit("}" if spec else "{}")
+        elif isinstance(spec, list):
+            self.lit("[")
+            for i, v in enumerate(spec):
+                if i:
+                    self.lit(",")
+                self.emit(v)
+            self.lit("]")
+        elif isinstance(spec, Str):
+            self.lit('"')
+            self.op("str", spec.max_len)
+        elif isinstance(spec, Enum):
+            self.lit('"')
+            self.op("enum", tuple(spec.options))
+        elif isinstance(spec, Num):
+            self.op("num", spec.decimals)
+        elif isinstance(spec, Arr):
+            if spec.min_items == 0 and isinstance(spec.item, (Num, Arr)):
+                raise ValueError("optional arrays need items that start with fixed text")
+            loop_id = self.loops
+            self.loops += 1
+            self.lit("[")
+            opt_pc = self.op("opt", None) if spec.min_items == 0 else None
+            body = self.label()
+            self.emit(spec.item)
+            self.op("loop", loop_id, body, spec.max_items)
+            exit_pc = self.label()
+            self.lit("]")
+            if opt_pc is not None:
+                self.prog[opt_pc] = ("opt", exit_pc)
+        else:
+            raise TypeError(f"unsupported schema spec: {spec!r}")
+
+
+def compile_schema(spec) -> List[tuple]:
+    c = _Compiler()
+    c.emit(spec)
+    c.op("end")
+    return c.prog
+
+
+# -----------------------------
+# Token-level grammar
+# -----------------------------
+
+class TokenGrammar:
+    def __init__(self, spec, token_texts: Sequence[str], encode: Callable[[str], List[int]],
+                 eos_ids: Sequence[int], special_ids: Sequence[int] = ()):
+        self.prog = compile_schema(spec)
+        self.texts = list(token_texts)
+        self.eos_ids = list(eos_ids)
+        V = len(self.texts)
+        special = set(special_ids)
+        # plain string content: no quote / backslash / control chars (byte fragments of multi-byte chars allowed)
+        self.plain = np.zeros(V, dtype=bool)
+        self.plain_len = np.zeros(V, dtype=np.int32)
+        self.numeric: Dict[int, str] = {}
+        for i, t in enumerate(self.texts):
+            if not t or i in special:
+                continue
+            if '"' not in t and "\\" not in t and all(ord(c) >= 0x20 for c in t):
+                self.plain[i] = True
+                self.plain_len[i] = len(t)
+            if re.fullmatch(r"[0-9.]+", t):
+                self.numeric[i] = t
+        self.quote_id = encode('"')[0]
+        self.comma_id = encode(",")[0]
+        self.lit_ids = {pc: encode(op[1]) for pc, op in enumerate(self.prog) if op[0] == "lit"}
+        self.enum_ids = {pc: [encode(o + '"') for o in op[1]] for pc, op in enumerate(self.prog) if op[0] == "enum"}
+        self._num_re = {}
+
+    # -----------------------------
+    # state
+    # -----------------------------
+
+    def start(self) -> dict:
+        return {"pc": 0, "i": 0, "n": 0, "num": "", "ids": [], "counts": {}}
+
+    @staticmethod
+    def copy(state: dict) -> dict:
+        return {**state, "ids": list(state["ids"]), "counts": dict(state["counts"])}
+
+    def done(self, state: dict) -> bool:
+        return self.prog[state["pc"]][0] == "end"
+
+    def _num_patterns(self, k: int):
+        if k not in self._num_re:
+            self._num_re[k] = re.compile(rf"0(\.\d{{0,{k}}})?|1(\.0{{0,{k}}})?")
+        return self._num_re[k]
+
+    def _entry(self, pc: int, state: dict) -> List[int]:
+        """token ids that can start the op at pc (ops reached by falling through after num/loop/opt)"""
+        op = self.prog[pc]
+        kind = op[0]
+        if kind == "lit":
+            return [self.lit_ids[pc][0]]
+        if kind == "loop":
+            ids = self._entry(pc + 1, state)
+            if state["counts"].get(op[1], 0) + 1 < op[3]:
+                ids = [self.comma_id] + ids
+            return ids
+        if kind == "opt":
+            return self._entry(pc + 1, state) + self._entry(op[1], state)
+        if kind == "end":
+            return list(self.eos_ids)
+        raise AssertionError(f"op {kind} cannot follow a number/array")
+
+    def allowed(self, state: dict):
+        """list of allowed token ids, or a bool mask over the vocabulary (string content)"""
+        pc = state["pc"]
+        op = self.prog[pc]
+        kind = op[0]
+        if kind == "lit":
+            return [self.lit_ids[pc][state["i"]]]
+        if kind == "str":
+            mask = self.plain & (self.plain_len <= op[1] - state["n"])
+            mask[self.quote_id] = True
+            return mask
+        if kind == "enum":
+            k = len(state["ids"])
+            return sorted({ids[k] for ids in self.enum_ids[pc] if ids[:k] == state["ids"] and len(ids) > k})
+        if kind == "num":
+            pat, cur = self._num_patterns(op[1]), state["num"]
+            ids = [i for i, t in self.numeric.items() if pat.fullmatch(cur + t)]
+            if cur and not cur.endswith("."):
+                ids += self._entry(pc + 1, state)
+            return ids
+        return self._entry(pc, state)
+
+    def advance(self, state: dict, tok: int) -> None:
+        pc = state["pc"]
+        op = self.prog[pc]
+        kind = op[0]
+        if kind == "lit":
+            state["i"] += 1
+            if state["i"] == len(self.lit_ids[pc]):
+                state["pc"], state["i"] = pc + 1, 0
+        elif kind == "str":
+            if tok == self.quote_id:
+                state["pc"], state["n"] = pc + 1, 0
+            else:
+                state["n"] += len(self.texts[tok])
+        elif kind == "enum":
+            state["ids"].append(tok)
+            if any(ids == state["ids"] for ids in self.enum_ids[pc]):
+                state["pc"], state["ids"] = pc + 1, []
+        elif kind == "num":
+            t = self.numeric.get(tok)
+            if t is not None and self._num_patterns(op[1]).fullmatch(state["num"] + t):
+                state["num"] += t
+            else:
+                state["pc"], state["num"] = pc + 1, ""
+                self.advance(state, tok)
+        elif kind == "loop":
+            if tok == self.comma_id and state["counts"].get(op[1], 0) + 1 < op[3]:
+                state["counts"][op[1]] = state["counts"].get(op[1], 0) + 1
+                state["pc"] = op[2]
+            else:
+                state["counts"].pop(op[1], None)
+                state["pc"] = pc + 1
+                self.advance(state, tok)
+        elif kind == "opt":
+            state["pc"] = pc + 1 if tok in self._entry(pc + 1, state) else op[1]
+            self.advance(state, tok)
+
+    def forced_run(self, state: dict, limit: int = 64) -> List[int]:
+        """tokens that are the only legal continuation from state (does not modify state)"""
+        st, out = self.copy(state), []
+        while len(out) < limit and not self.done(st):
+            ids = self.allowed(st)
+            if isinstance(ids, np.ndarray) or len(ids) != 1:
+                break
+            out.append(ids[0])
+            self.advance(st, ids[0])
+        return out
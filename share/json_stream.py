@@ -0,0 +1,90 @@
+import json
+from typing import Any, Callable, List, Optional
+
+"""
+Incremental JSON scanner for streamed VLM output
+------------------------------------------------
+- feed(chunk): tracks object/array nesting and string/escape state, O(len(chunk)) per call
+- done / end: set as soon as the first top-level object closes (text before the first '{' is ignored)
+- snapshot(): best-effort parse of what has streamed so far — cut after the last closed nested value,
+  then close the still-open brackets (partial results before generation finishes)
+- on_partial(obj): optional callback fired with snapshot() every time a nested object closes
+"""
+
+_CLOSER = {"{": "}", "[": "]"}
+
+
+class JsonScanner:
+    def __init__(self, on_partial: Optional[Callable[[Any], None]] = None):
+        self.on_partial = on_partial
+        self.text = ""
+        self.start = -1            # index of the top-level '{'
+        self.end = -1              # index just past the matching '}'
+        self._stack: List[str] = []
+        self._in_str = False
+        self._esc = False
+        self._cut = -1             # end of the last closed nested value
+        self._cut_stack: List[str] = []
+        self._last_partial: Any = None
+
+    @property
+    def done(self) -> bool:
+        return self.end >= 0
+
+    def feed(self, chunk: str) -> bool:
+        """Append chunk; returns True once the top-level object is complete."""
+        if self.done or not chunk:
+            return self.done
+        base = len(self.text)
+        self.text += chunk
+        closed_object = False
+        for i, ch in enumerate(chunk, base):
+            if self.start < 0:
+                if ch == "{":
+                    self.start = i
+                    self._stack.append("{")
+                continue
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+                continue
+            if ch == '"':
+                self._in_str = True
+            elif ch in "{[":
+                self._stack.append(ch)
+            elif ch in "}]":
+                if not self._stack:
+                    continue
+                opener = self._stack.pop()
+                if not self._stack:
+                    self.end = i + 1
+                    return True
+                self._cut = i + 1
+                self._cut_stack = list(self._stack)
+                closed_object = closed_object or opener == "{"
+        if closed_object and self.on_partial is not None:
+            obj = self.snapshot()
+            if obj is not None and obj != self._last_partial:
+                self._last_partial = obj
+                self.on_partial(obj)
+        return False
+
+    def result(self) -> Optional[str]:
+        """The complete top-level JSON text, or None while still open."""
+        return self.text[self.start:self.end] if self.done else None
+
+    def snapshot(self) -> Any:
+        if self.done:
+            src = self.result()
+        elif self._cut < 0:
+            return None
+        else:
+            src = self.text[self.start:self._cut] + "".join(_CLOSER[c] for c in reversed(self._cut_stack))
+        try:
+            return json.loads(src)
+        except ValueError:
+            return None
@@ -6,27 +6,84 @@ import os
 import sys
 import io
 import json
+import time
+import base64
+import asyncio
 import argparse
 from PIL import Image
 from typing import List
 
 # Google Gen AI SDK (Vertex 사용은 환경변수로 전환)
 from google import genai
-from google.genai.types import GenerateContentConfig, Modality
+from google.genai.types import GenerateContentConfig, Modality, HttpOptions, Part
+
+from api_limiter import ApiLimiter
+import disk_cache
+import image_loader
 
 # ----------------------------
 # 이미지 리사이즈 (최대 변 기준, 비율 유지)
 # ----------------------------
-def resize_max_side(img: Image.Image, max_side: int = 1024) -> Image.Image:
-    w, h = img.size
-    if max(w, h) <= max_side:
-        return img
-    if w >= h:
-        nh = int(h * max_side / w)
-        return img.resize((max_side, nh), Image.LANCZOS)
+def resize_max_side(img: Image.Image, max_side: int = 1024, reducing_gap: float = 2.0) -> Image.Image:
+    # (NEW) 큰 축소: 정수배 박스 축소(Image.reduce) 후 LANCZOS 마무리 → image_loader 공용 구현
+    return image_loader.resize_max_side(img, max_side, reducing_gap)
+
+
+# ----------------------------
+# (NEW) 업로드 준비: 한 번만 인코딩 (PNG/WebP/JPEG), 리사이즈가 필요 없고 RGB/L + 같은 코덱이면 원본 바이트 그대로
+# ----------------------------
+CODECS = {"png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+PASSTHROUGH_MIME = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def encode_image(img: Image.Image, codec: str = "png", quality: int = 90) -> bytes:
+    fmt, _ = CODECS[codec]
+    buf = io.BytesIO()
+    if fmt == "PNG":
+        img.save(buf, format="PNG", compress_level=1)        # 무손실이라 압축률보다 속도 우선
+    elif fmt == "WEBP":
+        img.save(buf, format="WEBP", quality=quality, lossless=quality >= 100, method=4)
     else:
-        nw = int(w * max_side / h)
-        return img.resize((nw, max_side), Image.LANCZOS)
+        img.save(buf, format="JPEG", quality=quality, subsampling=0 if quality >= 90 else 2)
+    return buf.getvalue()
+
+
+def prepare_upload(image_path: str, max_side: int = 1024, codec: str = "png", quality: int = 90) -> dict:
+    """→ {"data", "mime_type", "size", "passthrough", "timings"(ms: read/decode/resize/encode)}"""
+    timings = {}
+    t0 = time.perf_counter()
+    with open(image_path, "rb") as f:
+        raw = f.read()
+    t1 = time.perf_counter()
+    timings["read"] = round((t1 - t0) * 1000, 1)
+    img = Image.open(io.BytesIO(raw))      # 헤더만 읽음 (픽셀 디코드는 아래 draft_decode에서)
+    mime = PASSTHROUGH_MIME.get(img.format)
+    size = image_loader.target_size(img.size, max_side)
+    # 원본 전달은 기존 convert("RGB") 결과와 같은 픽셀(RGB/L)이고 요청한 --codec과 같은 포맷일 때만
+    # (투명 배경 RGBA/LA/P는 기존처럼 RGB로 변환해 1회 인코딩)
+    if size is None and mime == CODECS[codec][1] and img.mode in ("RGB", "L"):
+        return {"data": raw, "mime_type": mime, "size": img.size, "passthrough": True, "timings": timings}
+    # (NEW) 큰 JPEG은 DCT 단계에서 1/2~1/8로 디코드 (목표의 2배 이상 해상도는 유지)
+    img = image_loader.draft_decode(img, max_side if size else None, "RGB")
+    t2 = time.perf_counter()
+    timings["decode"] = round((t2 - t1) * 1000, 1)
+    img = image_loader.resize_max_side(img, max_side, size=size) if size else img
+    t3 = time.perf_counter()
+    timings["resize"] = round((t3 - t2) * 1000, 1)
+    data = encode_image(img, codec, quality)
+    timings["encode"] = round((time.perf_counter() - t3) * 1000, 1)
+    return {"data": data, "mime_type": CODECS[codec][1], "size": img.size, "passthrough": False, "timings": timings}
+
+
+def upload_part(upload: dict) -> Part:
+    return Part.from_bytes(data=upload["data"], mime_type=upload["mime_type"])
+
+
+def describe_upload(upload: dict) -> str:
+    stages = " · ".join(f"{k} {v:.0f}ms" for k, v in upload["timings"].items())
+    how = "원본 그대로" if upload["passthrough"] else "1회 인코딩"
+    return (f"{upload['size'][0]}x{upload['size'][1]} {upload['mime_type']} {len(upload['data']) / 1024:.0f}KB "
+            f"({how}) | {stages}")
 
 # ----------------------------
 # 프롬프트 구성 (제품만 남기고 배경 합성, 텍스트/로고 금지)
@@ -136,45 +193,221 @@ def build_prompt(meta: dict) -> str:
 # ----------------------------
 # 첫 이미지 파트 저장
 # ----------------------------
-def save_first_image_part(resp, out_path: str) -> bool:
+def response_parts(resp) -> list:
+    """응답 → [{"mime_type", "data"(base64)} | {"text"}] (캐시에 그대로 저장 가능한 형태)"""
     cand = None
     if getattr(resp, "candidates", None):
         cand = resp.candidates[0]
     if not cand or not getattr(cand, "content", None):
-        return False
+        return []
 
-    parts = getattr(cand.content, "parts", []) or []
-    for p in parts:
+    out = []
+    for p in getattr(cand.content, "parts", []) or []:
         # TEXT or IMAGE가 섞여서 나옵니다. (이미지 전용은 지원X)  :contentReference[oaicite:5]{index=5}
         if getattr(p, "inline_data", None):
             mime = getattr(p.inline_data, "mime_type", "")
             data = getattr(p.inline_data, "data", None)
             if mime and data:
-                ext = mime.split("/")[-1].lower().replace("jpeg", "jpg")
-                root, _ = os.path.splitext(out_path)
-                out_file = f"{root}.{ext}"
-                with open(out_file, "wb") as f:
-                    f.write(data)
+                out.append({"mime_type": mime, "data": base64.b64encode(data).decode("ascii")})
+        elif getattr(p, "text", None):
+            out.append({"text": p.text})
+    return out
+
+
+def parts_text(parts: list) -> str:
+    return "".join(p.get("text", "") for p in parts)
+
+
+def save_image_parts(parts: list, out_path: str, verbose: bool = True):
+    for p in parts:
+        if p.get("data"):
+            ext = p["mime_type"].split("/")[-1].lower().replace("jpeg", "jpg")
+            root, _ = os.path.splitext(out_path)
+            out_file = f"{root}.{ext}"
+            with open(out_file, "wb") as f:
+                f.write(base64.b64decode(p["data"]))
+            if verbose:
                 print(f"✅ [저장 완료] {out_file}")
-                return True
+            return out_file
     return False
 
+
+def save_first_image_part(resp, out_path: str, verbose: bool = True):
+    return save_image_parts(response_parts(resp), out_path, verbose)
+
+# ----------------------------
+# (NEW) 입력 로드 / 클라이언트 / 설정
+# ----------------------------
+def load_inputs(image_path: str, layout_json: str, max_side: int, codec: str = "png", quality: int = 90):
+    """레이아웃 JSON + 이미지 로드 → (meta, 업로드 준비 결과, 프롬프트). 실패 시 예외"""
+    with open(layout_json, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    upload = prepare_upload(image_path, max_side, codec, quality)
+    return meta, upload, build_prompt(meta)
+
+
+def make_client(base_url: str = None):
+    # base_url 지정 시: 로컬 가짜 서버(fake_genai_server.py) 등 Gemini API 호환 엔드포인트로 전송
+    if base_url:
+        return genai.Client(api_key=os.environ.get("GOOGLE_API_KEY", "fake"),
+                            http_options=HttpOptions(base_url=base_url))
+    # 인증(ADC) 점검은 SDK가 진행. 실패 시 예외 발생.
+    return genai.Client()
+
+
+def build_config() -> GenerateContentConfig:
+    # 중요: 응답 모달리티에 TEXT와 IMAGE를 모두 요청해야 함  :contentReference[oaicite:7]{index=7}
+    return GenerateContentConfig(
+        response_modalities=[Modality.TEXT, Modality.IMAGE],
+        candidate_count=1,
+    )
+
+
+# ----------------------------
+# (NEW) 응답 캐시: 모델 + 프롬프트 해시 + 입력 이미지 해시 + GenerateContentConfig
+# ----------------------------
+def response_cache_key(model: str, prompt_text: str, upload: dict, cfg: GenerateContentConfig) -> str:
+    return disk_cache.key("stage3", model, disk_cache.bytes_digest(prompt_text.encode("utf-8")),
+                          upload["mime_type"], disk_cache.bytes_digest(upload["data"]),
+                          cfg.model_dump(mode="json", exclude_none=True))
+
+
+def cache_lookup(cache, key: str):
+    rec = cache.get_json(key) if cache is not None else None
+    return rec.get("parts") if isinstance(rec, dict) else None
+
+
+def cache_store(cache, key: str, parts: list) -> None:
+    # 이미지를 받은 응답만 저장 (텍스트만 온 실패 응답은 다음에 다시 요청)
+    if cache is not None and any(p.get("data") for p in parts):
+        cache.put_json(key, {"parts": parts, "created": time.time()})
+
+
+def make_cache(cache_dir: str, max_mb: float, ttl_h: float, refresh: bool = False):
+    return disk_cache.DiskCache(cache_dir, max_bytes=int(max_mb * (1 << 20)),
+                                ttl=ttl_h * 3600 if ttl_h > 0 else None, refresh=refresh)
+
+
+# ----------------------------
+# (NEW) 매니페스트 일괄 처리 (asyncio, 동시 요청 수 제한)
+# ----------------------------
+def read_manifest(path: str):
+    """JSONL: {"image": ..., "layout_json": ..., "out": ...} 줄 단위 → [(줄 번호, job 또는 에러 문자열)]"""
+    jobs = []
+    with open(path, "r", encoding="utf-8-sig") as f:
+        for lineno, raw in enumerate(f, 1):
+            raw = raw.strip()
+            if not raw or raw.startswith("#"):
+                continue
+            try:
+                job = json.loads(raw)
+                for k in ("image", "layout_json"):
+                    if not os.path.exists(job[k]):
+                        raise FileNotFoundError(job[k])
+                job.setdefault("out", os.path.splitext(job["image"])[0] + "_stage3.png")
+            except Exception as e:
+                job = f"{type(e).__name__}: {e}"
+            jobs.append((lineno, job))
+    return jobs
+
+
+async def generate_job(client, limiter, sem, lineno: int, job: dict, model: str, max_side: int, cfg, cache=None,
+                       codec: str = "png", quality: int = 90) -> dict:
+    rec = {"line": lineno, "out": job["out"]}
+    async with sem:
+        t0 = time.perf_counter()
+        try:
+            # 디코드/리사이즈/파일 쓰기는 스레드로 → 이벤트 루프는 네트워크 대기만 담당
+            meta, upload, prompt_text = await asyncio.to_thread(load_inputs, job["image"], job["layout_json"], max_side,
+                                                                codec, quality)
+            rec.update(upload_kb=round(len(upload["data"]) / 1024, 1), prep_ms=upload["timings"])
+            key = response_cache_key(model, prompt_text, upload, cfg) if cache else None
+            parts = await asyncio.to_thread(cache_lookup, cache, key) if cache else None
+            rec["cached"] = parts is not None
+            if parts is None:
+                response = await limiter.acall("generate_content", client.aio.models.generate_content,
+                                               model=model, contents=[prompt_text, upload_part(upload)], config=cfg)
+                parts = response_parts(response)
+                await asyncio.to_thread(cache_store, cache, key, parts)
+            saved = await asyncio.to_thread(save_image_parts, parts, job["out"], False)
+            if saved:
+                rec.update(status="ok", out=saved)
+            else:
+                rec.update(status="no_image", text=parts_text(parts)[:200])
+        except Exception as e:
+            rec.update(status="error", error=f"{type(e).__name__}: {e}")
+        rec["seconds"] = round(time.perf_counter() - t0, 3)
+    return rec
+
+
+async def run_manifest(client, manifest: str, model: str, max_side: int, concurrency: int = 4, limiter=None,
+                       cache=None, codec: str = "png", quality: int = 90) -> int:
+    """매니페스트의 작업을 최대 concurrency개씩 동시에 요청하고, 끝나는 순서대로 저장 + JSON 한 줄 출력"""
+    cfg = build_config()
+    # 429/5xx 시 limiter가 동시 요청 수를 concurrency 아래로 줄였다가 다시 늘림 (AIMD)
+    limiter = limiter or ApiLimiter(concurrency=concurrency, max_concurrency=concurrency)
+    sem = asyncio.Semaphore(max(1, concurrency))
+    tasks, n_all, n_err = [], 0, 0
+    for lineno, job in read_manifest(manifest):
+        n_all += 1
+        if isinstance(job, str):
+            n_err += 1
+            print(json.dumps({"line": lineno, "status": "error", "error": job}, ensure_ascii=False), flush=True)
+            continue
+        tasks.append(asyncio.create_task(generate_job(client, limiter, sem, lineno, job, model, max_side, cfg, cache,
+                                                       codec, quality)))
+    t0 = time.perf_counter()
+    for fut in asyncio.as_completed(tasks):
+        rec = await fut
+        n_err += rec["status"] != "ok"
+        print(json.dumps(rec, ensure_ascii=False), flush=True)
+    print(f"[일괄 생성 완료] {n_all - n_err}/{n_all} | {time.perf_counter() - t0:.2f}s | 동시 요청 {concurrency}",
+          file=sys.stderr)
+    print(json.dumps(limiter.stats(), ensure_ascii=False), file=sys.stderr)
+    if cache is not None:
+        print(f"[응답 캐시] {cache.stats()}", file=sys.stderr)
+    return 0 if n_err == 0 else 1
+
+
 # ----------------------------
 # 메인
 # ----------------------------
 def main():
     ap = argparse.ArgumentParser(description="Stage 3 with Gemini 2.5 Flash Image (Vertex backend via google-genai).")
-    ap.add_argument("--image", required=True, help="Path to the product foreground image.")
-    ap.add_argument("--layout_json", required=True, help="Path to the layout JSON file.")
+    ap.add_argument("--image", help="Path to the product foreground image.")
+    ap.add_argument("--layout_json", help="Path to the layout JSON file.")
     ap.add_argument("--out", default="stage3_output.png", help="Output file path (extension adapts to returned MIME).")
     ap.add_argument("--max_side", type=int, default=1024, help="Max side length for resizing input image.")
     ap.add_argument("--model", default="gemini-2.5-flash-image-preview", help="Model id.")
+    # (NEW) 업로드 인코딩
+    ap.add_argument("--codec", choices=sorted(CODECS), default="png",
+                    help="Upload encoding when the image has to be resized (png = lossless).")
+    ap.add_argument("--quality", type=int, default=90, help="WebP/JPEG quality (WebP 100 = lossless).")
+    # (NEW) 일괄 처리 모드
+    ap.add_argument("--manifest", default=None,
+                    help='JSONL: {"image": ..., "layout_json": ..., "out": ...} per line; runs the jobs concurrently.')
+    ap.add_argument("--concurrency", type=int, default=4, help="Max in-flight requests in --manifest mode.")
+    ap.add_argument("--base_url", default=None,
+                    help="Send requests to a Gemini-API-compatible endpoint (e.g. fake_genai_server.py) instead of Vertex.")
+    # (NEW) 속도 제한 / 재시도
+    ap.add_argument("--rpm", type=float, default=None, help="Requests-per-minute budget (token bucket).")
+    ap.add_argument("--tpm", type=float, default=None, help="Tokens-per-minute budget (token bucket).")
+    ap.add_argument("--max_retries", type=int, default=5, help="Retries on 429/5xx/timeouts (jittered backoff, honours Retry-After).")
+    # (NEW) 응답 캐시
+    ap.add_argument("--cache_dir", default=os.path.join("~", ".cache", "generate-to-image", "stage3"),
+                    help="Response cache directory (returned image parts keyed by model/prompt/image/config).")
+    ap.add_argument("--cache_max_mb", type=float, default=1024, help="Cache size limit in MB (oldest entries evicted).")
+    ap.add_argument("--cache_ttl_h", type=float, default=72, help="Cache entry lifetime in hours (0 = no expiry).")
+    ap.add_argument("--no_cache", action="store_true", help="Disable the response cache.")
+    ap.add_argument("--refresh", action="store_true", help="Ignore cached responses and request fresh samples (overwrites them).")
     args = ap.parse_args()
+    if not args.manifest and not (args.image and args.layout_json):
+        ap.error("--image and --layout_json are required (or use --manifest)")
 
     # 환경변수 점검 (Vertex 백엔드 사용 설정)  :contentReference[oaicite:6]{index=6}
     need_vars = ["GOOGLE_CLOUD_PROJECT", "GOOGLE_CLOUD_LOCATION", "GOOGLE_GENAI_USE_VERTEXAI"]
     missing = [v for v in need_vars if not os.environ.get(v)]
-    if missing:
+    if missing and not args.base_url:
         print(f"❌ 환경변수 누락: {', '.join(missing)}")
         print("   예) PowerShell:")
         print('   $env:GOOGLE_CLOUD_PROJECT="nano-471710"')
@@ -182,8 +415,14 @@ def main():
         print('   $env:GOOGLE_GENAI_USE_VERTEXAI="True"')
         sys.exit(1)
 
-    # 인증(ADC) 점검은 SDK가 진행. 실패 시 예외 발생.
-    client = genai.Client()
+    client = make_client(args.base_url)
+    limiter = ApiLimiter(rpm=args.rpm, tpm=args.tpm, concurrency=args.concurrency,
+                         max_concurrency=args.concurrency, max_retries=args.max_retries)
+    cache = None if args.no_cache else make_cache(args.cache_dir, args.cache_max_mb, args.cache_ttl_h, args.refresh)
+
+    if args.manifest:
+        sys.exit(asyncio.run(run_manifest(client, args.manifest, args.model, args.max_side, args.concurrency,
+                                          limiter, cache, args.codec, args.quality)))
 
     # 입력 로드
     try:
@@ -194,41 +433,41 @@ def main():
         sys.exit(1)
 
     try:
-        img = Image.open(args.image).convert("RGB")
+        upload = prepare_upload(args.image, args.max_side, args.codec, args.quality)
     except Exception as e:
         print(f"❌ 이미지 로드 실패({args.image}): {e}")
         sys.exit(1)
-
-    img = resize_max_side(img, args.max_side)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    image_bytes = buf.getvalue()
+    print(f"[업로드 준비] {describe_upload(upload)}")
 
     prompt_text = build_prompt(meta)
 
-    # 중요: 응답 모달리티에 TEXT와 IMAGE를 모두 요청해야 함  :contentReference[oaicite:7]{index=7}
-    cfg = GenerateContentConfig(
-        response_modalities=[Modality.TEXT, Modality.IMAGE],
-        candidate_count=1,
-    )
+    cfg = build_config()
 
-    print(f"... Requesting '{args.model}' (Vertex backend) ...")
-    try:
-        response = client.models.generate_content(
-            model=args.model,
-            contents=[prompt_text, img],  # ← PIL.Image.Image 객체 그대로
-            config=cfg,
-            )
-    except Exception as e:
-        print(f"❌ [호출 실패] {e}")
-        print("   - 모델/리전/인증/결제를 점검하세요.")
-        print("   - 모델은 gemini-2.5-flash-image-preview, LOCATION은 global 권장.")
-        sys.exit(1)
+    key = response_cache_key(args.model, prompt_text, upload, cfg) if cache else None
+    parts = cache_lookup(cache, key)
+    if parts is not None:
+        print(f"♻️ [캐시 적중] {key[:12]} (새 샘플이 필요하면 --refresh)")
+    else:
+        print(f"... Requesting '{args.model}' (Vertex backend) ...")
+        try:
+            response = limiter.call(
+                "generate_content", client.models.generate_content,
+                model=args.model,
+                contents=[prompt_text, upload_part(upload)],  # ← 이미 인코딩된 바이트 (SDK 재인코딩 없음)
+                config=cfg,
+                )
+        except Exception as e:
+            print(f"❌ [호출 실패] {e}")
+            print("   - 모델/리전/인증/결제를 점검하세요.")
+            print("   - 모델은 gemini-2.5-flash-image-preview, LOCATION은 global 권장.")
+            sys.exit(1)
+        parts = response_parts(response)
+        cache_store(cache, key, parts)
 
-    saved = save_first_image_part(response, args.out)
+    saved = save_image_parts(parts, args.out)
     if not saved:
         print("⚠️ 이미지 파트를 받지 못했습니다. 모델이 텍스트만 반환했을 수 있습니다.")
-        txt = getattr(response, "text", None)
+        txt = parts_text(parts)
         if txt:
             print("---- Response text (truncated) ----")
             print(txt[:800])
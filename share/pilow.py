@@ -1,7 +1,10 @@
-import os, sys, json, argparse, math, glob, re
-from typing import Tuple, Dict, Optional, List
+import os, sys, json, argparse, math, glob, re, time
+from collections import OrderedDict
+from typing import Tuple, Dict, Optional, List, Iterable
 from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageFilter
 
+import luma as _luma
+
 """
 Stage 4 – Ad Text/Logo Rendering (Improved)
 -------------------------------------------
@@ -22,6 +25,12 @@ USAGE (PowerShell example)
     --line_spacing 1.02 `
     --shrink_underlay_to_text 
 
+Batch mode (one process for many jobs; fonts/logo tiles/decoded images/luma tables stay warm)
+  python pilow.py --jobs jobs.jsonl --font_kor NotoSansKR-Bold.otf --logo_path logo.png --out_dir out/
+  jobs.jsonl line: {"image": "...", "layout_json": "...", "copy_json": "..." (or "copy": {...}), "out": "...", "stroke": 0, ...}
+  -> one status record per line ({"line", "out", "status", "error", "ms"}) to stdout or --jobs_report
+  --workers N renders on N processes (each with its own caches); --unordered emits records as jobs finish
+
 Tips
 - Prefer a bold Korean font (e.g., malgunbd.ttf or NotoSansKR-Bold.otf)
 - Use --stroke 0~1 and lighter underlay opacity for a modern look
@@ -96,25 +105,17 @@ def detect_and_to_px(bbox: List[float], W: int, H: int) -> Tuple[int,int,int,int
 def box_size_xyxy(x0, y0, x1, y1):
     return (x1 - x0, y1 - y0)
 
+
+def _intersects(a, b) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
 # -----------------------------
 # Luma / color choice
 # -----------------------------
 
-def avg_luma(img: Image.Image, box) -> float:
-    x0,y0,x1,y1 = box
-    if x1<=x0 or y1<=y0:
-        return 0.5
-    crop = img.crop((x0,y0,x1,y1)).convert("RGB")
-    pixels = crop.resize((32, 32), Image.LANCZOS).getdata()
-    def _linear(c):
-        c = c / 255.0
-        return c/12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
-    s = 0.0
-    for r,g,b in pixels:
-        R, G, B = _linear(r), _linear(g), _linear(b)
-        L = 0.2126*R + 0.7152*G + 0.0722*B
-        s += L
-    return s / (32*32)
+def avg_luma(img: Image.Image, box, sample: int = 32) -> float:
+    # NumPy/LUT implementation lives in luma.py (same crop -> sample x sample LANCZOS -> mean linear luma)
+    return _luma.avg_luma(img, box, sample)
 
 
 def choose_text_and_stroke(bg_luma: float):
@@ -141,86 +142,310 @@ def glass_underlay(base: Image.Image, box, radius=16, blur=6, tint=(17,20,24,115
     d = ImageDraw.Draw(base, "RGBA")
     d.rounded_rectangle((x0,y0,x1,y1), radius=radius, fill=tint)
 
+
+def _merge_regions(boxes, pad: int, W: int, H: int):
+    """Group boxes whose padded extents touch; returns [(padded union, [member boxes])]."""
+    groups = []
+    for b in boxes:
+        region, members = clamp_box(b[0]-pad, b[1]-pad, b[2]+pad, b[3]+pad, W, H), [b]
+        k = 0
+        while k < len(groups):
+            g_region, g_members = groups[k]
+            if _intersects(region, g_region):
+                region = (min(region[0], g_region[0]), min(region[1], g_region[1]),
+                          max(region[2], g_region[2]), max(region[3], g_region[3]))
+                members = g_members + members
+                groups.pop(k)
+                k = 0
+            else:
+                k += 1
+        groups.append((region, members))
+    return groups
+
+
+def blur_region(region: Image.Image, blur: float, downsample_above: float = 8) -> Image.Image:
+    """Gaussian blur; for large radii blur a reduced copy (radius/f) and scale back up - same look, ~f^2 less work."""
+    f = int(min(8, blur // 4)) if blur >= downsample_above else 1
+    if f <= 1 or min(region.size) < 4 * f:
+        return region.filter(ImageFilter.GaussianBlur(blur))
+    small = region.reduce(f).filter(ImageFilter.GaussianBlur(blur / f))
+    return small.resize(region.size, Image.BILINEAR)
+
+
+def glass_panels(base: Image.Image, boxes, radius=16, blur=6, tint=(17,20,24,115), downsample_above=8):
+    """Glass panels for many boxes at once: each group of touching boxes is blurred once (with 3*blur
+    of real surrounding context instead of crop edges), every panel is pasted from that shared buffer,
+    then the tints are drawn."""
+    W, H = base.size
+    boxes = [clamp_box(*[int(v) for v in b], W, H) for b in boxes]
+    boxes = [b for b in boxes if b[2] > b[0] and b[3] > b[1]]
+    if not boxes:
+        return
+    pad = int(math.ceil(3 * blur))
+    for (rx0, ry0, rx1, ry1), members in _merge_regions(boxes, pad, W, H):
+        blurred = blur_region(base.crop((rx0, ry0, rx1, ry1)), blur, downsample_above)
+        for x0, y0, x1, y1 in members:
+            base.paste(blurred.crop((x0-rx0, y0-ry0, x1-rx0, y1-ry0)), (x0, y0))
+    d = ImageDraw.Draw(base, "RGBA")
+    for b in boxes:
+        d.rounded_rectangle(b, radius=radius, fill=tint)
+
+# -----------------------------
+# Font cache
+# -----------------------------
+
+class FontCache:
+    """Process-wide LRU of FreeTypeFont objects keyed by (path, size, layout_engine).
+    Parsing a large Korean OTF per truetype() call dominated fit_text_in_box; fonts are immutable so sharing is safe."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._fonts: "OrderedDict[tuple, ImageFont.FreeTypeFont]" = OrderedDict()
+
+    def get(self, path: str, size: int, layout_engine=None) -> ImageFont.FreeTypeFont:
+        key = (path, int(size), layout_engine)
+        font = self._fonts.get(key)
+        if font is not None:
+            self.hits += 1
+            self._fonts.move_to_end(key)
+            return font
+        self.misses += 1
+        font = ImageFont.truetype(path, int(size), layout_engine=layout_engine)
+        self._fonts[key] = font
+        while len(self._fonts) > self.maxsize:
+            self._fonts.popitem(last=False)
+        return font
+
+    def prewarm(self, path: str, sizes: Iterable[int], layout_engine=None) -> int:
+        n = 0
+        for sz in sizes:
+            self.get(path, sz, layout_engine)
+            n += 1
+        return n
+
+    def resize(self, maxsize: int):
+        self.maxsize = max(1, int(maxsize))
+        while len(self._fonts) > self.maxsize:
+            self._fonts.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._fonts), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+FONT_CACHE = FontCache()
+
+
+def get_font(path: str, size: int, layout_engine=None) -> ImageFont.FreeTypeFont:
+    return FONT_CACHE.get(path, size, layout_engine)
+
+# -----------------------------
+# Glyph metrics (incremental line widths)
+# -----------------------------
+
+KERN_SLACK = 0.02  # em per glyph: kerning/hinting the per-glyph sums cannot see
+
+
+class GlyphMetrics:
+    """Advance / ink-extent table for one (font, size).
+    Line widths are accumulated glyph by glyph; draw.textbbox is only consulted when the estimate lands
+    within the kerning allowance of the wrap limit, so wrap decisions stay identical to full re-measuring."""
+
+    def __init__(self, font: ImageFont.FreeTypeFont):
+        self.font = font
+        self._glyphs: Dict[str, Tuple[float, int, int]] = {}  # ch -> (advance, ink right, ink bottom)
+
+    def glyph(self, ch: str) -> Tuple[float, int, int]:
+        g = self._glyphs.get(ch)
+        if g is None:
+            bb = self.font.getbbox(ch)
+            g = (self.font.getlength(ch), bb[2], bb[3])
+            self._glyphs[ch] = g
+        return g
+
+    def extend(self, pen: float, right: float, s: str) -> Tuple[float, float]:
+        """Append s to a run measured so far: (pen advance, rightmost ink) -> updated pair."""
+        for ch in s:
+            adv, ink_r, _ = self.glyph(ch)
+            right = max(right, pen + ink_r)
+            pen += adv
+        return pen, right
+
+    def fits(self, draw: ImageDraw.ImageDraw, text: str, est_right: float, max_w: int) -> bool:
+        tol = 1.0 + KERN_SLACK * self.font.size * len(text)
+        if est_right + tol <= max_w:
+            return True
+        if est_right - tol > max_w:
+            return False
+        # near the line boundary -> exact (kerned, hinted) measurement
+        return draw.textbbox((0,0), text, font=self.font)[2] <= max_w
+
+
+_METRICS: "OrderedDict[tuple, GlyphMetrics]" = OrderedDict()
+
+
+def get_metrics(font: ImageFont.FreeTypeFont, maxsize: int = 256) -> GlyphMetrics:
+    key = (font.path, font.size, font.layout_engine)
+    m = _METRICS.get(key)
+    if m is None or m.font is not font:
+        m = GlyphMetrics(font)
+        _METRICS[key] = m
+        while len(_METRICS) > maxsize:
+            _METRICS.popitem(last=False)
+    else:
+        _METRICS.move_to_end(key)
+    return m
+
 # -----------------------------
 # Text wrapping & fitting
 # -----------------------------
 
-def wrap_text_to_width(draw: ImageDraw.ImageDraw, text: str, font: ImageFont.FreeTypeFont, max_w: int, mode: str) -> List[str]:
+def _wrap_lines(text: str, mode: str, gm: GlyphMetrics, fits) -> List[str]:
+    """Greedy word/char wrap driven by running glyph metrics; fits(test, est_right) decides each extension."""
     mode = mode.lower()
     if mode == 'auto':
         mode = 'word' if (' ' in text) else 'char'
-    
+
     lines = []
     if mode == 'word':
         words = text.split()
         cur = ''
+        pen = right = 0.0  # running metrics of `cur`
         for w in words:
-            test = (cur + ' ' + w).strip() if cur else w
-            tw = draw.textbbox((0,0), test, font=font)[2]
-            if tw <= max_w:
-                cur = test
+            if not cur:
+                # first word of a line is always taken (over-long words overflow, as before)
+                cur = w
+                pen, right = gm.extend(0.0, 0.0, w)
+                continue
+            test = cur + ' ' + w
+            t_pen, t_right = gm.extend(pen, right, ' ' + w)
+            if fits(test, t_right):
+                cur, pen, right = test, t_pen, t_right
             else:
-                if cur:
-                    lines.append(cur)
-                    cur = w
-                else:
-                    # a single word longer than max_w -> fallback char wrap
-                    cur = w
+                lines.append(cur)
+                cur = w
+                pen, right = gm.extend(0.0, 0.0, w)
         if cur:
             lines.append(cur)
     else:  # char mode
         cur = ''
-        for ch in list(text):
+        pen = right = 0.0
+        for ch in text:
+            if not cur:
+                cur = ch
+                pen, right = gm.extend(0.0, 0.0, ch)
+                continue
             test = cur + ch
-            tw = draw.textbbox((0,0), test, font=font)[2]
-            if tw <= max_w or cur == '':
-                cur = test
+            t_pen, t_right = gm.extend(pen, right, ch)
+            if fits(test, t_right):
+                cur, pen, right = test, t_pen, t_right
             else:
                 lines.append(cur)
                 cur = ch
+                pen, right = gm.extend(0.0, 0.0, ch)
         if cur:
             lines.append(cur)
     return lines
 
 
-def fit_text_in_box(draw: ImageDraw.ImageDraw, text: str, font_path: str, box,
-                    target_ratio=0.82, max_try=96, min_size=14, line_spacing=1.02, align="center", wrap_mode='auto'):
-    x0,y0,x1,y1 = box
-    W = x1 - x0
-    H = y1 - y0
-    if not text or W<=1 or H<=1:
-        return None, None, None
+def wrap_text_to_width(draw: ImageDraw.ImageDraw, text: str, font: ImageFont.FreeTypeFont, max_w: int, mode: str) -> List[str]:
+    gm = get_metrics(font)
+    return _wrap_lines(text, mode, gm, lambda test, est_right: gm.fits(draw, test, est_right, max_w))
 
+
+def _block_height(line_heights: List[float], line_spacing: float) -> int:
+    if not line_heights:
+        return 0
+    return int(sum(line_heights) + (len(line_heights)-1) * (line_heights[0]*(line_spacing-1)))
+
+
+def _fits_at(draw, text, font, usable_w, max_h, line_spacing, wrap_mode):
+    """Exact check at one size: wrap + per-line textbbox heights. Returns (fits, lines)."""
+    lines = wrap_text_to_width(draw, text, font, usable_w, wrap_mode)
+    total_h = _block_height([draw.textbbox((0,0), ln, font=font)[3] for ln in lines], line_spacing)
+    return total_h <= max_h, lines
+
+
+def _solve_size_binary(draw, text, font_path, usable_w, max_h, min_size, max_try, line_spacing, wrap_mode, layout_engine):
     lo, hi = min_size, max_try
     best = (min_size, [text])
     while lo <= hi:
         mid = (lo + hi) // 2
-        font = ImageFont.truetype(font_path, mid)
-        usable_w = int(W * target_ratio)
-        lines = wrap_text_to_width(draw, text, font, usable_w, wrap_mode)
-
-        # measure height
-        total_h = 0
-        line_metrics = []
-        for ln in lines:
-            _,_,tw,th = draw.textbbox((0,0), ln, font=font)
-            line_metrics.append((tw, th))
-            total_h += th
-        if line_metrics:
-            total_h = int(total_h + (len(lines)-1) * (line_metrics[0][1]*(line_spacing-1)))
-        
-        if total_h <= H * target_ratio:
+        font = get_font(font_path, mid, layout_engine)
+        ok, lines = _fits_at(draw, text, font, usable_w, max_h, line_spacing, wrap_mode)
+        if ok:
             best = (mid, lines)
             lo = mid + 1
         else:
             hi = mid - 1
+    return best
+
+
+def _solve_size_analytic(draw, text, font_path, usable_w, max_h, min_size, max_try, line_spacing, wrap_mode, layout_engine):
+    """Glyph metrics scale linearly with size: measure once at a reference size, then search sizes
+    arithmetically (wrap width usable_w*ref/s, heights *s/ref) and only verify the chosen size for real."""
+    ref = max(max_try, min_size)
+    gm = get_metrics(get_font(font_path, ref, layout_engine))
+
+    def model_fits(size):
+        limit = usable_w * ref / size
+        lines = _wrap_lines(text, wrap_mode, gm, lambda test, est_right: est_right <= limit)
+        heights = [max(gm.glyph(ch)[2] for ch in ln) * size / ref for ln in lines]
+        return _block_height(heights, line_spacing) <= max_h
+
+    lo, hi = min_size, max_try
+    size = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if model_fits(mid):
+            size = mid
+            lo = mid + 1
+        else:
+            hi = mid - 1
+
+    def real_fits(size):
+        return _fits_at(draw, text, get_font(font_path, size, layout_engine), usable_w, max_h, line_spacing, wrap_mode)
+
+    # verification render: the estimate can be off by a pixel either way (hinting, rounding)
+    s = size if size is not None else min_size
+    ok, lines = real_fits(s)
+    if ok:
+        # estimate low -> step up while the next size still fits (same size the binary search settles on)
+        while s < max_try:
+            up_ok, up_lines = real_fits(s + 1)
+            if not up_ok:
+                break
+            s, lines = s + 1, up_lines
+        return s, lines
+    # estimate high -> step down to the first size that really fits
+    for s in range(s - 1, min_size - 1, -1):
+        ok, lines = real_fits(s)
+        if ok:
+            return s, lines
+    return min_size, [text]
+
 
-    size, lines = best
-    font = ImageFont.truetype(font_path, size)
+FIT_STRATEGIES = {"binary": _solve_size_binary, "analytic": _solve_size_analytic}
+
+
+def fit_text_in_box(draw: ImageDraw.ImageDraw, text: str, font_path: str, box,
+                    target_ratio=0.82, max_try=96, min_size=14, line_spacing=1.02, align="center", wrap_mode='auto',
+                    layout_engine=None, strategy='binary'):
+    x0,y0,x1,y1 = box
+    W = x1 - x0
+    H = y1 - y0
+    if not text or W<=1 or H<=1:
+        return None, None, None
+
+    usable_w = int(W * target_ratio)
+    size, lines = FIT_STRATEGIES[strategy](draw, text, font_path, usable_w, H * target_ratio,
+                                           min_size, max_try, line_spacing, wrap_mode, layout_engine)
+    font = get_font(font_path, size, layout_engine)
 
     # Center vertically
     line_heights = [draw.textbbox((0,0), ln, font=font)[3] for ln in lines]
-    text_block_h = int(sum(line_heights) + (len(lines)-1) * (line_heights[0]*(line_spacing-1))) if lines else 0
+    text_block_h = _block_height(line_heights, line_spacing)
     cur_y = y0 + max(0, (H - text_block_h)//2)
 
     line_boxes = []
@@ -240,6 +465,98 @@ def fit_text_in_box(draw: ImageDraw.ImageDraw, text: str, font_path: str, box,
 # Logo placement
 # -----------------------------
 
+def _logo_target_size(lw: int, lh: int, W: int, H: int, keep_aspect: bool) -> Tuple[int, int]:
+    if keep_aspect and lw>0 and lh>0:
+        scale = min(W/lw, H/lh)
+        return max(1, int(lw*scale)), max(1, int(lh*scale))
+    return max(1, W), max(1, H)
+
+
+class LogoCache:
+    """Ready-to-composite RGBA logo tiles keyed by (path, mtime, target size, keep_aspect).
+
+    Decoded sources and resized tiles share one LRU bounded by a byte budget (RGBA = 4 B/px).
+    With mipmaps=True each source also keeps a halving pyramid and tiles are resampled from the
+    smallest level still >= the target (cheap for small bboxes, slightly different pixels than level 0)."""
+
+    def __init__(self, max_bytes: int = 64 << 20, mipmaps: bool = False):
+        self.max_bytes = max_bytes
+        self.mipmaps = mipmaps
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (value, nbytes)
+
+    def configure(self, max_bytes: Optional[int] = None, mipmaps: Optional[bool] = None):
+        if mipmaps is not None and mipmaps != self.mipmaps:
+            self.mipmaps = mipmaps
+            self._items.clear()
+            self.bytes = 0
+        if max_bytes is not None:
+            self.max_bytes = max(0, int(max_bytes))
+            self._evict()
+
+    def _get(self, key):
+        hit = self._items.get(key)
+        if hit is None:
+            return None
+        self._items.move_to_end(key)
+        return hit[0]
+
+    def _put(self, key, value, nbytes: int):
+        self._items[key] = (value, nbytes)
+        self.bytes += nbytes
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        while self.bytes > self.max_bytes and self._items:
+            key = next(iter(self._items))
+            if key == keep:
+                if len(self._items) == 1:
+                    break
+                self._items.move_to_end(key)
+                continue
+            _, nbytes = self._items.pop(key)
+            self.bytes -= nbytes
+
+    def levels(self, path: str, mtime_ns: int) -> List[Image.Image]:
+        key = ("src", path, mtime_ns, self.mipmaps)
+        levels = self._get(key)
+        if levels is None:
+            levels = [Image.open(path).convert("RGBA")]
+            while self.mipmaps and min(levels[-1].size) >= 2:
+                levels.append(levels[-1].reduce(2))
+            self._put(key, levels, sum(im.width * im.height * 4 for im in levels))
+        return levels
+
+    def tile(self, logo_path: str, W: int, H: int, keep_aspect: bool = True) -> Image.Image:
+        path = os.path.abspath(logo_path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        levels = self.levels(path, mtime_ns)
+        nw, nh = _logo_target_size(*levels[0].size, W, H, keep_aspect)
+        key = ("tile", path, mtime_ns, (nw, nh), keep_aspect)
+        tile = self._get(key)
+        if tile is not None:
+            self.hits += 1
+            return tile
+        self.misses += 1
+        src = levels[0]
+        for lvl in levels[1:]:
+            if lvl.width < nw or lvl.height < nh:
+                break
+            src = lvl
+        tile = src if src.size == (nw, nh) else src.resize((nw, nh), Image.LANCZOS)
+        self._put(key, tile, nw * nh * 4)
+        return tile
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._items), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+LOGO_CACHE = LogoCache()
+
+
 def place_logo(base: Image.Image, logo_path: str, box, keep_aspect=True):
     if not logo_path or not os.path.exists(logo_path):
         return
@@ -247,14 +564,8 @@ def place_logo(base: Image.Image, logo_path: str, box, keep_aspect=True):
     W,H = x1-x0, y1-y0
     if W<=0 or H<=0:
         return
-    logo = Image.open(logo_path).convert("RGBA")
-    lw, lh = logo.size
-    if keep_aspect and lw>0 and lh>0:
-        scale = min(W/lw, H/lh)
-        nw, nh = max(1, int(lw*scale)), max(1, int(lh*scale))
-    else:
-        nw, nh = max(1, W), max(1, H)
-    logo = logo.resize((nw, nh), Image.LANCZOS)
+    logo = LOGO_CACHE.tile(logo_path, W, H, keep_aspect)
+    nw, nh = logo.size
     px = x0 + (W - nw)//2
     py = y0 + (H - nh)//2
     base.alpha_composite(logo, (px, py))
@@ -264,24 +575,25 @@ def place_logo(base: Image.Image, logo_path: str, box, keep_aspect=True):
 # -----------------------------
 
 def load_copy_map(path: Optional[str]) -> Dict[str,str]:
+    # diagnostics go to stderr: in --jobs mode stdout carries the JSONL status records
     if not path or not os.path.exists(path):
-        print("[i] copy.json 생략됨 → 빈 매핑으로 진행")
+        print("[i] copy.json 생략됨 → 빈 매핑으로 진행", file=sys.stderr)
         return {}
     try:
         with open(path, 'r', encoding='utf-8-sig') as f:  # accept BOM
             raw = f.read()
         if not raw.strip():
-            print(f"[i] {path} 가 비어있음 → 빈 매핑으로 진행")
+            print(f"[i] {path} 가 비어있음 → 빈 매핑으로 진행", file=sys.stderr)
             return {}
         txt = re.sub(r"/\*.*?\*/", "", raw, flags=re.S)  # /* */ comments
         txt = re.sub(r"//.*", "", txt)                   # // comments
         txt = re.sub(r",\s*(\]|})", r"\\1", txt)        # trailing commas
         return json.loads(txt)
     except json.JSONDecodeError as e:
-        print(f"[경고] copy.json 파싱 실패: {e} → 빈 매핑으로 계속")
+        print(f"[경고] copy.json 파싱 실패: {e} → 빈 매핑으로 계속", file=sys.stderr)
         return {}
     except Exception as e:
-        print(f"[경고] copy.json 읽기 오류: {e} → 빈 매핑으로 계속")
+        print(f"[경고] copy.json 읽기 오류: {e} → 빈 매핑으로 계속", file=sys.stderr)
         return {}
 
 
@@ -314,51 +626,98 @@ def resolve_font_path(requested_path: Optional[str]) -> str:
         "한글 폰트를 찾지 못했습니다. --font_kor 로 실제 파일(.ttf/.otf)을 지정하거나 'C:\\Windows\\Fonts\\malgunbd.ttf' 등을 사용하세요.")
 
 # -----------------------------
-# Main
+# Canvas / font setup (shared by single and batch runs)
 # -----------------------------
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--image", required=True, help="Stage3/4 결과 이미지 경로")
-    ap.add_argument("--layout_json", required=True, help="레이아웃 JSON 경로")
-    ap.add_argument("--copy_json", required=False, help="문구 매핑 JSON (type#index -> text)")
-    ap.add_argument("--font_kor", required=False, help="한국어 폰트 파일 경로(.ttf/.otf)")
-    ap.add_argument("--logo_path", required=False, help="로고 PNG 경로(선택)")
-    ap.add_argument("--out", default="final_ad.png")
-    ap.add_argument("--stroke", type=int, default=1, help="텍스트 외곽선 두께")
-    ap.add_argument("--underlay_color", default=None, help="언더레이 색상(hex, 예:#111418). 없으면 자동")
-    ap.add_argument("--underlay_opacity", type=float, default=None, help="언더레이 불투명도(0~1) override")
-    ap.add_argument("--target_ratio", type=float, default=0.82, help="텍스트 폭/높이 여유 비율")
-    ap.add_argument("--line_spacing", type=float, default=1.02, help="줄간 간격 배수")
-    ap.add_argument("--wrap_mode", choices=["auto","word","char"], default="auto")
-    ap.add_argument("--glass_underlay", action='store_true', help="텍스트 영역에 유리(블러) 패널 적용")
-    ap.add_argument("--glass_blur", type=int, default=6, help="유리 패널 블러 강도")
-    ap.add_argument("--glass_alpha", type=float, default=0.45, help="유리 패널 틴트 알파(0~1)")
-    ap.add_argument("--shrink_underlay_to_text", action='store_true', help="언더레이를 텍스트 폭+패딩으로 축소")
-    ap.add_argument("--skip_layout_underlays", action='store_true', help="layout의 underlay 박스 그리지 않음")
-    ap.add_argument("--debug_boxes", action='store_true', help="각 bbox 테두리 표시")
-    args = ap.parse_args()
+class CanvasCache:
+    """LRU of decoded RGBA base images (+ pristine LumaIndex) keyed by (path, mtime).
+    Every job gets its own copy, so painting never leaks between jobs."""
+
+    def __init__(self, maxsize: int = 4):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def get(self, path: str, luma_engine: str):
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+        hit = self._items.get(key)
+        if hit is None:
+            img = Image.open(path).convert("RGBA")
+            hit = (img, None)
+            self._items[key] = hit
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        else:
+            self._items.move_to_end(key)
+        img, index = hit
+        if luma_engine == 'sat' and index is None:
+            index = _luma.LumaIndex(img)
+            self._items[key] = (img, index)
+        canvas = img.copy()
+        return canvas, (index.clone(canvas) if luma_engine == 'sat' else None)
+
+
+def load_canvas(path: str, luma_engine: str, cache: Optional[CanvasCache] = None):
+    if cache is not None:
+        return cache.get(path, luma_engine)
+    base = Image.open(path).convert("RGBA")
+    return base, (_luma.LumaIndex(base) if luma_engine == 'sat' else None)
+
+
+LAYOUT_ENGINES = {"basic": ImageFont.Layout.BASIC, "raqm": ImageFont.Layout.RAQM}
+_FONT_SETUP: Dict[tuple, str] = {}
+
+
+def setup_font(args):
+    """Resolve + validate (+ optionally prewarm) the Korean font once per (request, engine)."""
+    layout_engine = LAYOUT_ENGINES.get(args.layout_engine)
+    key = (args.font_kor, layout_engine, bool(args.prewarm_fonts))
+    font_path = _FONT_SETUP.get(key)
+    if font_path is None:
+        font_path = resolve_font_path(args.font_kor)
+        try:
+            _ = get_font(font_path, 18, layout_engine)
+        except OSError as e:
+            raise SystemExit(f"[폰트 오류] '{font_path}' 로드 실패: {e}")
+        if args.prewarm_fonts:
+            FONT_CACHE.prewarm(font_path, range(14, 113), layout_engine)
+        _FONT_SETUP[key] = font_path
+    return font_path, layout_engine
+
+# -----------------------------
+# Copy-independent base layers (underlays, logo, luma decisions)
+# -----------------------------
 
-    base = Image.open(args.image).convert("RGBA")
+class BaseLayers:
+    """Everything about one (image, layout) that does not depend on the copy text:
+    canvas with layout underlays painted, logo overlay layer, and per-slot text/stroke colours.
+    Build once with prepare_layers(), then render_variant() for every copy map."""
+
+    def __init__(self, canvas, luma_index, logo_layer, slots):
+        self.canvas = canvas          # RGBA, layout underlays baked in
+        self.luma_index = luma_index  # LumaIndex of `canvas` (None with --luma_engine resample)
+        self.logo_layer = logo_layer  # RGBA overlay composited last, or None
+        self.slots = slots            # [(copy key, (x0,y0,x1,y1), text colour, stroke colour)]
+
+
+def load_layout(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        return json.load(f)
+
+
+def prepare_layers(args, meta: dict, canvas_cache: Optional[CanvasCache] = None) -> BaseLayers:
+    base, luma_index = load_canvas(args.image, args.luma_engine, canvas_cache)
     W, H = base.size
     draw = ImageDraw.Draw(base, "RGBA")
 
-    with open(args.layout_json, 'r', encoding='utf-8-sig') as f:
-        meta = json.load(f)
-
-    copy_map: Dict[str,str] = load_copy_map(args.copy_json)
+    def region_luma(box) -> float:
+        if luma_index is not None:
+            return luma_index.mean(box)
+        return avg_luma(base, box, args.luma_sample)
 
     layout = meta.get("layout", {}) or {}
     nongraphics = layout.get("nongraphic_layout", []) or []
     graphics = layout.get("graphic_layout", []) or []
 
-    # Resolve font
-    font_path = resolve_font_path(args.font_kor)
-    try:
-        _ = ImageFont.truetype(font_path, 18)
-    except OSError as e:
-        raise SystemExit(f"[폰트 오류] '{font_path}' 로드 실패: {e}")
-
     # 1) Layout-provided UNDERLAYS first (optional)
     if not args.skip_layout_underlays:
         for g in graphics:
@@ -377,41 +736,85 @@ def main():
             if args.underlay_color:
                 ur,ug,ub = hex_to_rgb(args.underlay_color)
             else:
-                luma = avg_luma(base, (x0,y0,x1,y1))
+                luma = region_luma((x0,y0,x1,y1))
                 ur,ug,ub = ((255,255,255) if luma < 0.5 else (0,0,0))
             ua = int(clamp(opacity,0,1)*255)
             draw_underlay(draw, (x0,y0,x1,y1), radius_px, (ur,ug,ub,ua))
+            if luma_index is not None:
+                luma_index.invalidate((x0,y0,x1,y1))
 
-    # 2) TEXTS (headline/subhead/etc.)
+    # 2) Text slots: box + colour decided from the local background luma
+    slots = []
     type_counts: Dict[str,int] = {}
     for t in nongraphics:
         ttype = (t.get("type") or 'text').lower()
         idx = type_counts.get(ttype, 0)
         type_counts[ttype] = idx + 1
-        key = f"{ttype}#{idx}"
-
-        text = copy_map.get(key, '')
-        if not text:
-            continue
         bbox = t.get("bbox")
         if not (isinstance(bbox, list) and len(bbox)==4):
             continue
+        box = detect_and_to_px(bbox, W, H)
+        txt_col, stroke_col = choose_text_and_stroke(region_luma(box))
+        slots.append((f"{ttype}#{idx}", box, txt_col, stroke_col))
 
-        x0,y0,x1,y1 = detect_and_to_px(bbox, W, H)
-        if args.debug_boxes:
-            draw.rectangle((x0,y0,x1,y1), outline=(255,0,0,128), width=1)
+    # 3) LOGO from graphic_layout (type=logo) -> separate overlay, composited after the text
+    logo_layer = None
+    if args.logo_path:
+        for g in graphics:
+            if (g.get("type") or '').lower() != 'logo':
+                continue
+            bbox = g.get("bbox")
+            if not (isinstance(bbox, list) and len(bbox)==4):
+                continue
+            if logo_layer is None:
+                logo_layer = Image.new("RGBA", base.size, (0,0,0,0))
+            place_logo(logo_layer, args.logo_path, detect_and_to_px(bbox, W, H))
 
-        # Decide text color based on local background luma
-        luma = avg_luma(base, (x0,y0,x1,y1))
-        txt_col, stroke_col = choose_text_and_stroke(luma)
+    return BaseLayers(base, luma_index, logo_layer, slots)
 
-        # Fit text
+# -----------------------------
+# Per-copy text pass
+# -----------------------------
+
+def render_variant(args, layers: BaseLayers, copy_map: Dict[str,str], font_path: str, layout_engine=None) -> Image.Image:
+    base = layers.canvas.copy()
+    W, H = base.size
+    draw = ImageDraw.Draw(base, "RGBA")
+    painted: List[Tuple[int,int,int,int]] = []   # regions drawn so far for earlier slots (colour re-decision)
+    dirty: List[Tuple[int,int,int,int]] = []     # every region changed on `base` (luma index invalidation)
+    live = {}                                    # lazily cloned LumaIndex for this variant's canvas
+
+    def region_luma(box) -> float:
+        if layers.luma_index is None:
+            return avg_luma(base, box, args.luma_sample)
+        if "index" not in live:
+            live["index"] = layers.luma_index.clone(base)
+            for r in dirty:
+                live["index"].invalidate(r)
+        return live["index"].mean(box)
+
+    def mark_dirty(box):
+        dirty.append(box)
+        if "index" in live:
+            live["index"].invalidate(box)
+
+    def mark_painted(box):
+        painted.append(box)
+        mark_dirty(box)
+
+    # 1) Fit every slot first
+    fitted = []
+    for key, (x0,y0,x1,y1), txt_col, stroke_col in layers.slots:
+        text = copy_map.get(key, '')
+        if not text:
+            continue
         font, line_boxes, size = fit_text_in_box(
             draw, text, font_path, (x0,y0,x1,y1),
             target_ratio=args.target_ratio,
             max_try=112, min_size=14,
             line_spacing=args.line_spacing,
-            align='center', wrap_mode=args.wrap_mode
+            align='center', wrap_mode=args.wrap_mode,
+            layout_engine=layout_engine, strategy=args.fit_strategy
         )
         if not font:
             continue
@@ -425,43 +828,260 @@ def main():
             ty1 = max(ty + th for _, (tx, ty), (tw, th) in line_boxes)
         else:
             tx0,ty0,tx1,ty1 = x0,y0,x1,y1
-        ux0, uy0, ux1, uy1 = clamp_box(tx0-pad, ty0-pad, tx1+pad, ty1+pad, W, H)
+        panel = clamp_box(tx0-pad, ty0-pad, tx1+pad, ty1+pad, W, H)
+        fitted.append(((x0,y0,x1,y1), txt_col, stroke_col, font, line_boxes, (tx0,ty0,tx1,ty1), panel))
+
+    glass_alpha = clamp(args.glass_alpha, 0, 1)
+    tint = (17,20,24, int(glass_alpha*255))
+    shared_glass = args.glass_underlay and args.glass_mode == 'shared'
+    if shared_glass:
+        # 2) all glass panels from one blur per group of touching panels
+        #    (all panels go under all text here; per_box paints each panel right before its own text)
+        glass_panels(base, [f[6] for f in fitted], radius=16, blur=args.glass_blur, tint=tint)
+        for f in fitted:
+            mark_dirty(f[6])
+
+    # 3) Panels / underlays + text, slot by slot
+    for (x0,y0,x1,y1), txt_col, stroke_col, font, line_boxes, (tx0,ty0,tx1,ty1), panel in fitted:
+        if args.debug_boxes:
+            draw.rectangle((x0,y0,x1,y1), outline=(255,0,0,128), width=1)
+
+        # Colour was decided on the copy-independent layers; re-decide only if this variant painted over the slot
+        if any(_intersects((x0,y0,x1,y1), r) for r in painted):
+            txt_col, stroke_col = choose_text_and_stroke(region_luma((x0,y0,x1,y1)))
 
         # Optional glass or text-tight underlay
         if args.glass_underlay:
-            glass_alpha = clamp(args.glass_alpha, 0, 1)
-            tint = (17,20,24, int(glass_alpha*255))
-            glass_underlay(base, (ux0,uy0,ux1,uy1), radius=16, blur=args.glass_blur, tint=tint)
+            if shared_glass:
+                painted.append(panel)
+            else:
+                glass_underlay(base, panel, radius=16, blur=args.glass_blur, tint=tint)
+                mark_painted(panel)
         elif args.shrink_underlay_to_text:
             if args.underlay_color:
                 ur,ug,ub = hex_to_rgb(args.underlay_color)
             else:
-                luma_u = avg_luma(base, (ux0,uy0,ux1,uy1))
+                luma_u = region_luma(panel)
                 ur,ug,ub = ((255,255,255) if luma_u < 0.5 else (0,0,0))
             opacity = 0.42 if args.underlay_opacity is None else args.underlay_opacity
-            draw_underlay(draw, (ux0,uy0,ux1,uy1), radius_px=16, fill_rgba=(ur,ug,ub,int(clamp(opacity,0,1)*255)))
+            draw_underlay(draw, panel, radius_px=16, fill_rgba=(ur,ug,ub,int(clamp(opacity,0,1)*255)))
+            mark_painted(panel)
 
         # Render text lines
         for ln, (tx, ty), (tw, th) in line_boxes:
             draw.text((tx, ty), ln, font=font, fill=txt_col+(255,),
                       stroke_width=max(0, args.stroke), stroke_fill=stroke_col+(255,))
+        if line_boxes:
+            sw = max(0, args.stroke)
+            mark_painted((tx0-sw, ty0-sw, tx1+sw, ty1+sw))
 
-    # 3) LOGO from graphic_layout (type=logo)
-    for g in graphics:
-        if (g.get("type") or '').lower() != 'logo':
-            continue
-        if not args.logo_path:
-            continue
-        bbox = g.get("bbox")
-        if not (isinstance(bbox, list) and len(bbox)==4):
-            continue
-        x0,y0,x1,y1 = detect_and_to_px(bbox, W, H)
-        place_logo(base, args.logo_path, (x0,y0,x1,y1))
+    if layers.logo_layer is not None:
+        base.alpha_composite(layers.logo_layer)
+    return base
 
-    base.convert("RGB").save(args.out, quality=95)
-    print(f"✅ 저장 완료: {args.out}")
+
+def render_variants(args, copy_maps: List[Dict[str,str]], canvas_cache: Optional[CanvasCache] = None) -> List[Image.Image]:
+    """A/B fan-out: one base image + layout, many copy maps. Underlays, logo and luma decisions are computed once."""
+    font_path, layout_engine = setup_font(args)
+    layers = prepare_layers(args, load_layout(args.layout_json), canvas_cache)
+    return [render_variant(args, layers, cm, font_path, layout_engine) for cm in copy_maps]
+
+# -----------------------------
+# Render one (image, layout, copy) job
+# -----------------------------
+
+def render_ad(args, canvas_cache: Optional[CanvasCache] = None) -> str:
+    copy_map: Dict[str,str] = args.copy if getattr(args, "copy", None) is not None else load_copy_map(args.copy_json)
+    img = render_variants(args, [copy_map], canvas_cache)[0]
+    img.convert("RGB").save(args.out, quality=95)
+    return args.out
+
+
+def variant_out_path(out: str, i: int) -> str:
+    root, ext = os.path.splitext(out)
+    return f"{root}_{i}{ext or '.png'}"
+
+# -----------------------------
+# Batch mode (--jobs manifest.jsonl)
+# -----------------------------
+
+def iter_jobs(path: str):
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for lineno, raw in enumerate(f, 1):
+            raw = raw.strip()
+            if not raw or raw.startswith('#'):
+                continue
+            try:
+                yield lineno, json.loads(raw)
+            except json.JSONDecodeError as e:
+                yield lineno, e
+
+
+def job_args(args, job: dict, lineno: int):
+    """CLI args + per-job overrides (keys = option names, e.g. "stroke", "glass_underlay", "copy")."""
+    if not isinstance(job, dict):
+        raise ValueError("작업 줄은 JSON 객체여야 합니다")
+    merged = dict(vars(args))
+    unknown = [k for k in job if k not in merged and k != "copy"]
+    if unknown:
+        raise ValueError(f"알 수 없는 옵션: {', '.join(unknown)}")
+    merged.update(job)
+    if not merged.get("image") or not merged.get("layout_json"):
+        raise ValueError("image / layout_json 누락")
+    if "out" not in job:
+        stem = os.path.splitext(os.path.basename(merged["image"]))[0]
+        merged["out"] = os.path.join(args.out_dir or ".", f"{stem}_{lineno}.png")
+    return argparse.Namespace(**merged)
+
+
+def run_job(args, lineno: int, job, canvas_cache: Optional[CanvasCache] = None) -> dict:
+    t0 = time.perf_counter()
+    rec = {"line": lineno}
+    try:
+        if isinstance(job, Exception):
+            raise job
+        jargs = job_args(args, job, lineno)
+        rec.update(image=jargs.image, out=jargs.out)
+        out_dir = os.path.dirname(jargs.out)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        render_ad(jargs, canvas_cache)
+        rec["status"] = "ok"
+    except (Exception, SystemExit) as e:
+        rec["status"] = "error"
+        rec["error"] = f"{type(e).__name__}: {e}"
+    rec["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return rec
+
+
+def configure_caches(args):
+    FONT_CACHE.resize(args.font_cache_size)
+    LOGO_CACHE.configure(max_bytes=int(args.logo_cache_mb * (1 << 20)), mipmaps=args.logo_mipmaps)
+
+
+# Worker-process state: every worker owns its font/logo/canvas caches (module globals + this)
+_WORKER: Dict[str, object] = {}
+
+
+def _init_worker(args):
+    configure_caches(args)
+    _WORKER["args"] = args
+    _WORKER["canvas_cache"] = CanvasCache(args.image_cache)
+
+
+def _run_in_worker(item) -> dict:
+    lineno, job = item
+    rec = run_job(_WORKER["args"], lineno, job, _WORKER["canvas_cache"])
+    rec["pid"] = os.getpid()
+    return rec
+
+
+def iter_results(args):
+    """Job status records, sequential or from a process pool.
+    chunksize=1 -> idle workers pull the next job as soon as they finish (dynamic load balancing);
+    --unordered emits records as jobs complete instead of in manifest order."""
+    jobs = iter_jobs(args.jobs)
+    if args.workers <= 1:
+        canvas_cache = CanvasCache(args.image_cache)
+        for lineno, job in jobs:
+            yield run_job(args, lineno, job, canvas_cache)
+        return
+    import multiprocessing as mp
+    with mp.Pool(processes=args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+        imap = pool.imap_unordered if args.unordered else pool.imap
+        yield from imap(_run_in_worker, jobs, chunksize=1)
+
+
+def run_batch(args) -> int:
+    report = open(args.jobs_report, 'w', encoding='utf-8') if args.jobs_report else sys.stdout
+    n_ok = n_err = 0
+    try:
+        for rec in iter_results(args):
+            report.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            report.flush()
+            if rec["status"] == "ok":
+                n_ok += 1
+            else:
+                n_err += 1
+    finally:
+        if report is not sys.stdout:
+            report.close()
+    cache_info = (f"font cache {FONT_CACHE.stats()} | logo cache {LOGO_CACHE.stats()}"
+                  if args.workers <= 1 else f"workers={args.workers}")
+    print(f"✅ 배치 완료: ok={n_ok} error={n_err} | {cache_info}", file=sys.stderr)
+    return 0 if n_err == 0 else 1
+
+# -----------------------------
+# Main
+# -----------------------------
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--image", required=False, help="Stage3/4 결과 이미지 경로")
+    ap.add_argument("--layout_json", required=False, help="레이아웃 JSON 경로")
+    ap.add_argument("--copy_json", required=False, help="문구 매핑 JSON (type#index -> text)")
+    ap.add_argument("--copy_variants", nargs='+', default=None,
+                    help="A/B 문구 JSON 여러 개: 배경/언더레이/로고는 1회 계산, 문구만 변형별 합성 → <out>_<i>.png")
+    ap.add_argument("--font_kor", required=False, help="한국어 폰트 파일 경로(.ttf/.otf)")
+    ap.add_argument("--logo_path", required=False, help="로고 PNG 경로(선택)")
+    ap.add_argument("--out", default="final_ad.png")
+    ap.add_argument("--stroke", type=int, default=1, help="텍스트 외곽선 두께")
+    ap.add_argument("--underlay_color", default=None, help="언더레이 색상(hex, 예:#111418). 없으면 자동")
+    ap.add_argument("--underlay_opacity", type=float, default=None, help="언더레이 불투명도(0~1) override")
+    ap.add_argument("--target_ratio", type=float, default=0.82, help="텍스트 폭/높이 여유 비율")
+    ap.add_argument("--line_spacing", type=float, default=1.02, help="줄간 간격 배수")
+    ap.add_argument("--wrap_mode", choices=["auto","word","char"], default="auto")
+    ap.add_argument("--fit_strategy", choices=["binary","analytic"], default="binary",
+                    help="글자 크기 탐색: binary=크기마다 재측정, analytic=기준 크기 1회 측정 후 선형 스케일로 계산 + 검증 1회")
+    ap.add_argument("--glass_underlay", action='store_true', help="텍스트 영역에 유리(블러) 패널 적용")
+    ap.add_argument("--glass_blur", type=int, default=6, help="유리 패널 블러 강도")
+    ap.add_argument("--glass_mode", choices=["shared","per_box"], default="per_box",
+                    help="유리 패널: per_box=박스마다 블러(기존 출력), shared=겹치는 패널 묶음당 1회 블러(큰 반경은 축소-블러-확대). "
+                         "shared는 모든 패널을 텍스트보다 먼저 칠하므로 뒤 패널이 앞 텍스트를 덮지 않음(출력이 약간 다름). "
+                         "큰 캔버스(2048px+)/큰 블러/패널 多일 때 유리")
+    ap.add_argument("--glass_alpha", type=float, default=0.45, help="유리 패널 틴트 알파(0~1)")
+    ap.add_argument("--shrink_underlay_to_text", action='store_true', help="언더레이를 텍스트 폭+패딩으로 축소")
+    ap.add_argument("--skip_layout_underlays", action='store_true', help="layout의 underlay 박스 그리지 않음")
+    ap.add_argument("--debug_boxes", action='store_true', help="각 bbox 테두리 표시")
+    ap.add_argument("--layout_engine", choices=["basic","raqm"], default=None, help="Pillow 텍스트 레이아웃 엔진(기본: 자동)")
+    ap.add_argument("--font_cache_size", type=int, default=256, help="폰트 객체 LRU 캐시 크기(경로·크기·엔진별)")
+    ap.add_argument("--prewarm_fonts", action='store_true', help="시작 시 탐색 범위(14~112pt) 폰트를 미리 로드")
+    ap.add_argument("--logo_cache_mb", type=float, default=64, help="로고 디코딩/리사이즈 결과 캐시 용량(MB)")
+    ap.add_argument("--logo_mipmaps", action='store_true', help="로고 1/2 축소 피라미드를 만들어 가까운 단계에서 리샘플")
+    ap.add_argument("--luma_engine", choices=["sat","resample"], default="resample",
+                    help="배경 밝기 측정 방식: resample=박스마다 크롭+리샘플(기존 값), "
+                         "sat=이미지당 1회 적분영상(O(1) 조회, 면적 평균이라 기존 값과 최대 ~0.01 차이)")
+    ap.add_argument("--luma_sample", type=int, default=32, help="resample 엔진의 박스당 샘플 해상도(NxN)")
+    # batch mode
+    ap.add_argument("--jobs", default=None, help="JSONL 작업 목록(한 줄당 image/layout_json/copy_json(or copy)/out + 옵션 override)")
+    ap.add_argument("--jobs_report", default=None, help="작업별 상태 JSONL 출력 경로(없으면 stdout)")
+    ap.add_argument("--out_dir", default=None, help="배치에서 out 미지정 작업의 출력 폴더")
+    ap.add_argument("--image_cache", type=int, default=4, help="배치에서 디코딩된 원본 이미지+밝기 테이블 캐시 개수")
+    ap.add_argument("--workers", type=int, default=1, help="배치 렌더링 프로세스 수(1=단일 프로세스)")
+    ap.add_argument("--unordered", action='store_true', help="배치 상태 기록을 완료 순서대로 출력(기본: 목록 순서)")
+    return ap
+
+
+def main():
+    ap = build_arg_parser()
+    args = ap.parse_args()
+    configure_caches(args)
+
+    if args.jobs:
+        sys.exit(run_batch(args))
+
+    if not args.image or not args.layout_json:
+        ap.error("--image 와 --layout_json 이 필요합니다 (또는 --jobs 사용)")
+    if args.copy_variants:
+        images = render_variants(args, [load_copy_map(p) for p in args.copy_variants])
+        for i, img in enumerate(images):
+            out = variant_out_path(args.out, i)
+            img.convert("RGB").save(out, quality=95)
+            print(f"✅ 저장 완료: {out}")
+        return
+    out = render_ad(args)
+    print(f"✅ 저장 완료: {out}")
 
 
 if __name__ == "__main__":
     main()
-
@@ -3,12 +3,34 @@
 # - Pass2 (옵션 --bg_prompt): Pass1 결과를 이용해 전경/배치/각도에 맞는 배경 프롬프트 + 소품 계획 JSON 생성
 # - 픽셀 좌표 자동 정규화(0~1) + 규칙 정제 + 비었을 때 배너/로고/언더레이 자동 보강
 # - 출력: product/background(+prompt…) + layout(subject/nongraphic/graphic) + background_objects JSON
-
-import json, argparse, os, sys, math
+# - (NEW) --serve: 모델을 한 번만 로드하고 로컬 HTTP/Unix 소켓 서비스로 요청 처리 (/analyze, /health, /metrics)
+# - (NEW) --max_batch/--max_wait_ms: 대기 요청을 모아 한 번의 generate로 배치 추론 (--serve, --jobs)
+# - (NEW) --prefix_cache: 고정 SYSTEM(+스키마) 프리픽스의 KV 캐시를 재사용, 이미지/제품명 부분만 prefill
+# - (NEW) --bg_prompt 시 1패스의 이미지 전처리/비전 임베딩을 2패스가 재사용 (2패스는 텍스트 prefill+디코드만)
+# - (NEW) 결과 디스크 캐시: 이미지 내용 해시+제품명+모델+프롬프트 해시+샘플링 파라미터(+seed) 키, --seed 지정 시만 (--no_cache/--refresh)
+# - (NEW) JSON 인식 조기 종료: 최상위 JSON 객체가 닫히면 디코드 중단 (--no_early_stop), --stream_partial로 중간 결과 출력
+# - (NEW) --constrained: 스키마 문법으로 logits를 마스킹해 항상 유효한 JSON(숫자 bbox) 생성, 구조 토큰은 강제 입력
+# - (NEW) --backend cpu-int8|cpu-int4: optimum-quanto weight-only 양자화 CPU 경로 (1회 변환 후 산출물 캐시), --threads
+# - (NEW) --ensemble K: 1패스 K개 샘플을 한 번의 배치 generate로 생성 → 타입별 confidence 가중 박스 융합 후 후처리
+
+import json, argparse, os, sys, math, time, base64, tempfile, threading, socketserver, queue, copy, hashlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn
+import numpy as np
 import torch
 from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
+from transformers import LogitsProcessorList, TemperatureLogitsWarper, TopPLogitsWarper, DynamicCache
+from transformers import TopKLogitsWarper, MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, NoRepeatNGramLogitsProcessor
+from transformers import StoppingCriteria, StoppingCriteriaList, LogitsProcessor
 from qwen_vl_utils import process_vision_info
 from PIL import Image
+import disk_cache
+import image_loader
+import boxes as _boxes
+from json_stream import JsonScanner
+from json_grammar import TokenGrammar, Str, Num, Enum, Arr, compile_schema
 
 # ----------------------------
 # 프롬프트 스키마 (confidence 포함, 다중 후보)
@@ -76,6 +98,36 @@ BG_SCHEMA = (
   '}\n'
 )
 
+# ----------------------------
+# (NEW) 제약 디코딩용 문법 (SCHEMA_TEXT / BG_SCHEMA와 같은 모양, 키 순서 고정)
+# ----------------------------
+_BBOX = [Num(), Num(), Num(), Num()]
+
+LAYOUT_GRAMMAR = {
+    "product": {"type": Str(60), "material": Str(60), "design": Str(120), "features": Str(200)},
+    "background": {"ideal_color": Str(40), "texture": Str(60), "lighting": Str(60), "style": Str(60)},
+    "layout": {
+        "subject_layout": {"center": [Num(), Num()], "ratio": [Num(), Num()]},
+        "nongraphic_layout": Arr({"type": Enum("headline", "subhead", "body", "cta"),
+                                  "bbox": _BBOX, "confidence": Num(2)}, min_items=1, max_items=6),
+        "graphic_layout": Arr({"type": Enum("logo"), "content": Str(40),
+                               "bbox": _BBOX, "confidence": Num(2)}, min_items=1, max_items=3),
+    },
+}
+
+BG_GRAMMAR = {
+    "background_prompt": Str(600),
+    "negative_prompt": Str(300),
+    "camera": {"angle": Enum("eye-level", "top-down", "low-angle", "macro", "oblique"),
+               "distance": Enum("closeup", "medium", "wide")},
+    "lighting": {"type": Enum("soft", "hard", "rim", "ambient"),
+                 "direction": Enum("left", "right", "front", "back", "top", "bottom")},
+    "palette": Arr(Str(7), min_items=1, max_items=6),
+    "objects": Arr({"name": Str(60), "style": Enum("bokeh", "flat", "painterly", "realistic"),
+                    "bbox_hint": _BBOX, "depth": Enum("behind_product", "same_plane"),
+                    "avoid_iou_with": Str(20), "notes": Str(120)}, min_items=0, max_items=4),
+}
+
 # ----------------------------
 # 유틸 / 후처리
 # ----------------------------
@@ -114,44 +166,16 @@ def iou(b1, b2):
 
 def nms(boxes, iou_thr=0.3):
     # boxes: [{bbox:[x,y,w,h], confidence:0~1, ...}]
-    bxs = [b for b in boxes if isinstance(b.get("bbox"), list) and len(b["bbox"])==4]
-    bxs.sort(key=lambda b: float(b.get("confidence", 0.5)), reverse=True)
-    kept = []
-    for b in bxs:
-        if all(iou(b["bbox"], k["bbox"]) < iou_thr for k in kept):
-            kept.append(b)
-    return kept
+    # (NEW) 배열 기반 BoxSet: 쌍별 IoU 행렬 1회 계산 + 신뢰도 내림차순(안정 정렬) 그리디 → 기존과 같은 결과
+    return _boxes.nms(boxes, iou_thr)
 
 
 def enforce_text_rules(items, subject_bbox,
                        min_ar=1.8,      # 가로형 권장
                        min_margin=0.03, # 가장자리 여백
                        max_iou=0.2):    # subject와 겹침 제한
-    out = []
-    for it in items:
-        b = it.get("bbox", [0,0,0,0])
-        if not (isinstance(b, list) and len(b)==4):
-            continue
-        b = clip_bbox(b)
-
-        # subject 겹침 제한
-        if subject_bbox and iou(b, subject_bbox) >= max_iou:
-            continue
-
-        # 가장자리 여백
-        x,y,w,h = b
-        if x < min_margin or y < min_margin or x+w > 1-min_margin or y+h > 1-min_margin:
-            continue
-
-        # 가로형 체크
-        ar = (w / h) if h > 0 else 999
-        if ar < min_ar:
-            continue
-
-        it["confidence"] = float(it.get("confidence", 0.5))
-        it["bbox"] = b
-        out.append(it)
-    return out
+    # subject 겹침 / 가장자리 여백 / 가로형 체크를 한 번에 마스크로 계산
+    return _boxes.enforce_text_rules(items, subject_bbox, min_ar, min_margin, max_iou)
 
 
 def postprocess_layout(parsed,
@@ -184,19 +208,13 @@ def postprocess_layout(parsed,
     # 2) 로고/그래픽 정제
     graphics = layout.get("graphic_layout", [])
     if not isinstance(graphics, list): graphics = []
-    cleaned_g = []
-    for g in graphics:
-        b = g.get("bbox")
-        if not (isinstance(b, list) and len(b)==4):
-            continue
-        b = clip_bbox(b)
-        # subject를 과도하게 가리는 로고 제외
-        if iou(b, subject_bbox) > 0.4:
-            continue
+    gs = _boxes.BoxSet.from_items(graphics).clipped()
+    # subject를 과도하게 가리는 로고 제외
+    gs = gs.take(~(gs.iou_to(subject_bbox) > 0.4)) if len(gs) else gs
+    for g, b in zip(gs.items, gs.bbox.tolist()):
         g["bbox"] = b
         g["confidence"] = float(g.get("confidence", 0.5))
-        cleaned_g.append(g)
-    graphics = nms(cleaned_g, iou_thr=logo_iou_thr)
+    graphics = gs.nms(logo_iou_thr).items
 
     layout["nongraphic_layout"] = texts
     layout["graphic_layout"] = graphics
@@ -211,7 +229,7 @@ def normalize_if_pixels_layout(parsed, image_path):
     """subject_layout.center/ratio 및 모든 bbox를 0~1로 강제 정규화.
     값 중 1을 넘는 항목이 있으면 '픽셀'로 판단해 이미지 크기로 나눔."""
     try:
-        W, H = Image.open(image_path).size
+        W, H = image_loader.image_size(image_path)   # 헤더만 읽음
     except Exception:
         W, H = 1, 1  # 실패 시 no-op
 
@@ -357,8 +375,8 @@ def add_text_underlays(parsed, pad=0.015, opacity=0.6, radius=0.08):
 
 def extract_palette_hex(image_path, k=5):
     try:
-        im = Image.open(image_path).convert("RGB")
-        im_thumb = im.copy()
+        # (NEW) 큰 JPEG은 draft 디코드(1/2~1/8)로 읽은 뒤 썸네일 → 전체 해상도 디코드/복사 없음
+        im_thumb = image_loader.open_image(image_path, max_side=256)
         im_thumb.thumbnail((256, 256))
         pal = im_thumb.convert("P", palette=Image.ADAPTIVE, colors=k).convert("RGB")
         colors = pal.getcolors(256*256) or []
@@ -415,28 +433,30 @@ def summarize_layout_for_bg(parsed):
 # (NEW) 배경 프롬프트/소품 계획 생성 (2nd pass VLM 호출)
 # ----------------------------
 
-def generate_bg_plan(model, processor, image_path, product_name, parsed, palette):
+BG_GEN_KWARGS = {"max_new_tokens": 512, "temperature": 0.7, "top_p": 0.9}
+
+
+def build_bg_messages(image_path, product_name, parsed, palette, schema_in_system=False):
     context = summarize_layout_for_bg(parsed)
     user_text = (
         f"[제품명 힌트] {product_name or ''}\n"
         f"[레이아웃 컨텍스트] {context}\n"
-        f"[권장 팔레트] {palette}\n"
-        f"{BG_SCHEMA}"
+        f"[권장 팔레트] {palette}"
     )
-    messages = [
-        {"role": "system", "content": [{"type":"text","text": BG_SYSTEM}]},
+    # 프리픽스 캐시 사용 시 스키마를 system 쪽으로 옮겨 요청 간 공통 프리픽스를 길게 만든다
+    system_text = f"{BG_SYSTEM}\n{BG_SCHEMA}" if schema_in_system else BG_SYSTEM
+    if not schema_in_system:
+        user_text += f"\n{BG_SCHEMA}"
+    return [
+        {"role": "system", "content": [{"type":"text","text": system_text}]},
         {"role": "user", "content": [
             {"type": "image", "image": f"file://{image_path}"},
             {"type": "text", "text": user_text}
         ]}
     ]
-    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    image_inputs, video_inputs = process_vision_info(messages)
-    inputs = processor(text=[text], images=image_inputs, videos=video_inputs,
-                       padding=True, return_tensors="pt").to(model.device)
-    with torch.no_grad():
-        out_ids = model.generate(**inputs, max_new_tokens=512, do_sample=True, top_p=0.9, temperature=0.7)
-    gen = processor.batch_decode(out_ids[:, inputs.input_ids.shape[1]:], skip_special_tokens=True)[0]
+
+
+def parse_bg_plan(gen, palette):
     try:
         start = gen.index("{"); end = gen.rindex("}") + 1
         return json.loads(gen[start:end])
@@ -444,88 +464,929 @@ def generate_bg_plan(model, processor, image_path, product_name, parsed, palette
         return {"background_prompt": gen.strip()[:800], "negative_prompt": "", "palette": palette}
 
 
-# ----------------------------
-# 메인
-# ----------------------------
+def generate_bg_plan(model, processor, image_path, product_name, parsed, palette):
+    messages = build_bg_messages(image_path, product_name, parsed, palette)
+    gen = generate_texts(model, processor, [messages], **BG_GEN_KWARGS)[0]
+    return parse_bg_plan(gen, palette)
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--image", help="분석할 이미지 경로", required=False)
-    ap.add_argument("--product_name", help="제품 이름(힌트)", default=None)
-    ap.add_argument("--max_new_tokens", type=int, default=640)
-    ap.add_argument("--temperature", type=float, default=0.7)
-    ap.add_argument("--top_p", type=float, default=0.9)
-    ap.add_argument("--save", help="결과를 저장할 파일 경로(json)", default=None)
-    # (NEW) 옵션: 2패스 배경 프롬프트 생성 on/off
-    ap.add_argument("--bg_prompt", action="store_true", help="배경 프롬프트/소품 계획 생성 활성화")
-    args = ap.parse_args()
 
-    product_name = args.product_name or input("제품 이름을 입력하세요: ").strip()
-    image_path = args.image or input("제품 이미지 파일 경로를 입력하세요 (예: './image.jpg'): ").strip()
-    if not os.path.exists(image_path):
-        print(f"[에러] 이미지 경로를 찾을 수 없습니다: {image_path}", file=sys.stderr)
-        sys.exit(1)
+# ----------------------------
+# 모델 로드 / 1패스 분석 (CLI·서비스 공용)
+# ----------------------------
 
-    model_id = "Qwen/Qwen2.5-VL-7B-Instruct"
-    model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-        model_id, torch_dtype="auto", device_map="auto"
-    )
+DEFAULT_MODEL_ID = "Qwen/Qwen2.5-VL-7B-Instruct"
+
+
+BACKENDS = ("auto", "cpu-int8", "cpu-int4")
+QUANT_DIR = os.path.join("~", ".cache", "generate-to-image", "qwen-quant")
+QUANT_EXCLUDE = ["*visual*", "lm_head"]   # 비전 타워/출력층은 원 정밀도 유지 (품질 민감)
+
+
+def quantized_artifact_dir(model_id, backend, quant_dir=QUANT_DIR):
+    name = model_id.strip("/").replace("/", "--")
+    return os.path.join(os.path.expanduser(quant_dir), f"{name}-{backend}")
+
+
+def convert_quantized(model_id, backend, quant_dir=QUANT_DIR):
+    """(1회) 원본 가중치 로드 → LLM 선형층 int8/int4 weight-only 양자화 → safetensors + quantization_map.json 저장"""
+    from optimum.quanto import quantize, freeze, qint8, qint4, quantization_map
+    from safetensors.torch import save_file
+    out_dir = quantized_artifact_dir(model_id, backend, quant_dir)
+    model = Qwen2_5_VLForConditionalGeneration.from_pretrained(model_id, torch_dtype=torch.bfloat16, device_map="cpu")
+    quantize(model, weights=qint8 if backend == "cpu-int8" else qint4, exclude=QUANT_EXCLUDE)
+    freeze(model)
+    os.makedirs(out_dir, exist_ok=True)
+    save_file(model.state_dict(), os.path.join(out_dir, "model.safetensors"))
+    with open(os.path.join(out_dir, "quantization_map.json"), "w", encoding="utf-8") as f:
+        json.dump(quantization_map(model), f)
+    model.config.save_pretrained(out_dir)
+    print(f"[양자화 저장] {out_dir}", file=sys.stderr)
+    return out_dir
+
+
+def load_quantized(model_id, backend, quant_dir=QUANT_DIR):
+    """캐시된 양자화 산출물이 있으면 meta 디바이스에 뼈대만 만들고 requantize로 바로 적재 (없으면 변환부터)"""
+    from optimum.quanto import requantize
+    from safetensors.torch import load_file
+    out_dir = quantized_artifact_dir(model_id, backend, quant_dir)
+    if not os.path.exists(os.path.join(out_dir, "quantization_map.json")):
+        convert_quantized(model_id, backend, quant_dir)
+    config = Qwen2_5_VLForConditionalGeneration.config_class.from_pretrained(out_dir)
+    with torch.device("meta"):
+        model = Qwen2_5_VLForConditionalGeneration._from_config(config, torch_dtype=torch.bfloat16)
+    with open(os.path.join(out_dir, "quantization_map.json"), "r", encoding="utf-8") as f:
+        qmap = json.load(f)
+    requantize(model, load_file(os.path.join(out_dir, "model.safetensors")), qmap, device=torch.device("cpu"))
+    model.tie_weights()
+    model.eval()
+    return model
+
+
+def load_model(model_id=DEFAULT_MODEL_ID, backend="auto", threads=None, quant_dir=QUANT_DIR):
+    """backend: auto(원래 경로: dtype/device 자동) | cpu-int8 | cpu-int4 (optimum-quanto weight-only, GPU 없는 노드용)"""
+    if threads:
+        torch.set_num_threads(threads)
+    if backend == "auto":
+        model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+            model_id, torch_dtype="auto", device_map="auto"
+        )
+    else:
+        model = load_quantized(model_id, backend, quant_dir)
+    model.name_or_path = model_id
+    model.layout_backend = backend   # 결과 캐시 키가 백엔드(원본/int8/int4)별로 갈리도록
     processor = AutoProcessor.from_pretrained(model_id)
+    return model, processor
 
-    user_text = f"[제품명 힌트] {product_name}\n{SCHEMA_TEXT}"
 
-    messages = [
-      {"role": "system", "content": [{"type": "text", "text": SYSTEM}]},
+def build_layout_messages(image_path, product_name, schema_in_system=False):
+    if schema_in_system:
+        system_text, user_text = f"{SYSTEM}\n{SCHEMA_TEXT}", f"[제품명 힌트] {product_name}"
+    else:
+        system_text, user_text = SYSTEM, f"[제품명 힌트] {product_name}\n{SCHEMA_TEXT}"
+    return [
+      {"role": "system", "content": [{"type": "text", "text": system_text}]},
       {"role": "user", "content": [
           {"type": "image", "image": f"file://{image_path}"},
           {"type": "text",  "text": user_text}
       ]}
     ]
 
+
+# ----------------------------
+# (NEW) JSON 인식 조기 종료: 행마다 괄호/문자열 상태를 추적해 최상위 객체가 닫히면 그 행은 끝
+# ----------------------------
+
+class JsonStopCriteria(StoppingCriteria):
+    def __init__(self, tokenizer, prompt_len, batch_size, on_partial=None):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.scanners = [JsonScanner((lambda obj, i=i: on_partial(i, obj)) if on_partial else None)
+                         for i in range(batch_size)]
+        self._pending = [[] for _ in range(batch_size)]   # 아직 글자로 확정되지 않은 토큰(멀티바이트 조각)
+        self._seen = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        new = input_ids[:, self._seen:].tolist()
+        self._seen = input_ids.shape[1]
+        done = []
+        for sc, pending, ids in zip(self.scanners, self._pending, new):
+            if not sc.done:
+                pending.extend(ids)
+                text = self.tokenizer.decode(pending, skip_special_tokens=True)
+                if not text.endswith("\ufffd"):    # 한글 등 바이트 조각이 완성될 때까지 보류
+                    sc.feed(text)
+                    pending.clear()
+            done.append(sc.done)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+# ----------------------------
+# (NEW) 문법 제약 디코딩: 행마다 문법 상태를 진행시키며 허용 토큰 밖의 logits를 -inf로
+# ----------------------------
+
+_GRAMMARS = {}
+
+
+def get_token_grammar(model, processor, spec):
+    """토크나이저별 토큰 분류(문자열/숫자 토큰) + 스키마 프로그램은 한 번만 계산"""
+    tok = processor.tokenizer
+    key = (id(tok), id(spec))
+    if key not in _GRAMMARS:
+        texts = tok.batch_decode([[i] for i in range(len(tok))])
+        special = set(tok.all_special_ids) | set(getattr(tok, "added_tokens_decoder", {}) or {})
+        eos = model.generation_config.eos_token_id
+        eos = list(eos) if isinstance(eos, (list, tuple)) else [eos]
+        _GRAMMARS[key] = TokenGrammar(spec, texts, lambda t: tok.encode(t, add_special_tokens=False), eos, special)
+    return _GRAMMARS[key]
+
+
+class GrammarLogitsProcessor(LogitsProcessor):
+    def __init__(self, grammar, prompt_len, batch_size):
+        self.grammar = grammar
+        self.states = [grammar.start() for _ in range(batch_size)]
+        self._seen = prompt_len
+
+    def sync(self, input_ids):
+        for t in range(self._seen, input_ids.shape[1]):
+            for st, tok in zip(self.states, input_ids[:, t].tolist()):
+                if not self.grammar.done(st):
+                    self.grammar.advance(st, tok)
+        self._seen = input_ids.shape[1]
+
+    def forced_run(self, input_ids, row=0):
+        """문법상 유일한 다음 토큰들(키/괄호/따옴표 등) → 샘플링 없이 한 번의 forward로 밀어넣기"""
+        self.sync(input_ids)
+        return self.grammar.forced_run(self.states[row])
+
+    def __call__(self, input_ids, scores):
+        self.sync(input_ids)
+        mask = torch.full_like(scores, float("-inf"))
+        for i, st in enumerate(self.states):
+            allowed = self.grammar.allowed(st)
+            if isinstance(allowed, np.ndarray):
+                mask[i, :len(allowed)].masked_fill_(torch.from_numpy(allowed).to(scores.device), 0.0)
+            else:
+                mask[i, allowed] = 0.0
+        return scores + mask
+
+
+def generate_texts(model, processor, messages_list, max_new_tokens=640, temperature=0.7, top_p=0.9,
+                   early_stop=True, on_partial=None, grammar=None, num_return_sequences=1):
+    """대화 여러 개를 한 번의 generate로 처리 (left padding) → 대화별 생성 텍스트"""
     # 전처리
-    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    image_inputs, video_inputs = process_vision_info(messages)
+    texts = [processor.apply_chat_template(m, tokenize=False, add_generation_prompt=True) for m in messages_list]
+    image_inputs, video_inputs = process_vision_info(messages_list)
+    processor.tokenizer.padding_side = "left"   # 디코더 전용 모델: 배치 생성은 왼쪽 패딩
     inputs = processor(
-        text=[text], images=image_inputs, videos=video_inputs,
+        text=texts, images=image_inputs, videos=video_inputs,
         padding=True, return_tensors="pt"
     ).to(model.device)
 
-    # 생성 (1st pass)
+    rows = len(texts) * num_return_sequences   # 출력은 입력별 K개씩 연속
+    stop = StoppingCriteriaList([JsonStopCriteria(processor.tokenizer, inputs.input_ids.shape[1],
+                                                  rows, on_partial)]) if early_stop else None
+    constrain = LogitsProcessorList([GrammarLogitsProcessor(get_token_grammar(model, processor, grammar),
+                                                            inputs.input_ids.shape[1], rows)]) if grammar else None
+
+    # 생성
     with torch.no_grad():
         out_ids = model.generate(
             **inputs,
-            max_new_tokens=args.max_new_tokens,
+            max_new_tokens=max_new_tokens,
             do_sample=True,
-            top_p=args.top_p,
-            temperature=args.temperature
+            top_p=top_p,
+            temperature=temperature,
+            stopping_criteria=stop,
+            logits_processor=constrain,
+            num_return_sequences=num_return_sequences
         )
 
-    gen_text = processor.batch_decode(
+    return processor.batch_decode(
         out_ids[:, inputs.input_ids.shape[1]:],
         skip_special_tokens=True
-    )[0]
+    )
+
 
-    # JSON 추출 + 보정/후처리/폴백 + 언더레이
+def generate_text(model, processor, messages, max_new_tokens=640, temperature=0.7, top_p=0.9):
+    return generate_texts(model, processor, [messages], max_new_tokens, temperature, top_p)[0]
+
+
+# ----------------------------
+# (NEW) 공유 프리픽스 KV 캐시 + 수동 prefill/decode
+#   - 프리픽스 = chat template으로 렌더링한 system 메시지(SYSTEM+SCHEMA_TEXT / BG_SYSTEM+BG_SCHEMA)
+#   - 키 = 렌더링된 프리픽스 텍스트 sha1 → 프롬프트 문구가 바뀌면 자동으로 새로 prefill
+#   - generate()는 캐시가 있으면(cache_position != 0) pixel_values를 버리므로,
+#     이미지 임베딩을 직접 끼운 inputs_embeds로 접미부만 prefill한 뒤 샘플링 루프를 돌린다
+# ----------------------------
+
+class PrefixKVCache:
+    def __init__(self, model, processor, max_entries=4):
+        self.model = model
+        self.processor = processor
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # sha1(prefix_text) -> (prefix_ids, past_key_values)
+        self._lock = threading.Lock()
+
+    def get(self, system_message):
+        """system 메시지 → (prefix_text, prefix_ids, past_key_values). 반환된 KV는 읽기 전용(복사해서 사용)"""
+        text = self.processor.apply_chat_template([system_message], tokenize=False, add_generation_prompt=False)
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return (text,) + entry
+            self.misses += 1
+            ids = self.processor.tokenizer(text, return_tensors="pt").input_ids.to(self.model.device)
+            P = ids.shape[1]
+            pos = torch.arange(P, device=ids.device).view(1, 1, P).expand(3, 1, P)   # 텍스트만: t/h/w 위치 동일
+            with torch.no_grad():
+                out = self.model(input_ids=ids, position_ids=pos, use_cache=True)
+            entry = (ids, out.past_key_values)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return (text,) + entry
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def _rope_index(model):
+    # transformers 버전에 따라 get_rope_index 위치가 다름 (ForConditionalGeneration / .model)
+    return getattr(model, "get_rope_index", None) or model.model.get_rope_index
+
+
+def encode_images(model, processor, messages_list):
+    """대화별 이미지 1장 → [(image_grid_thw(1,3), image_embeds(n_tokens, D))] (전처리 + 비전 타워)"""
+    image_inputs, _ = process_vision_info(messages_list)
+    vis = processor.image_processor(images=image_inputs, return_tensors="pt")
+    grid = vis["image_grid_thw"].to(model.device)
+    visual = model.visual
+    with torch.no_grad():
+        embeds = visual(vis["pixel_values"].to(model.device, dtype=visual.dtype), grid_thw=grid)
+    merge = processor.image_processor.merge_size ** 2
+    sizes = (grid.prod(-1) // merge).tolist()
+    return [(g.view(1, 3), e) for g, e in zip(grid, embeds.split(sizes))]
+
+
+def sampling_processors(model, temperature, top_p):
+    """수동 디코드 루프용 processor/warper 목록. generate(do_sample=True, temperature=, top_p=)와 같게
+    나머지 값(repetition_penalty, top_k, min_p, no_repeat_ngram_size)은 model.generation_config에서 가져옴"""
+    gc = model.generation_config
+    procs = LogitsProcessorList()
+    if gc.repetition_penalty is not None and gc.repetition_penalty != 1.0:
+        procs.append(RepetitionPenaltyLogitsProcessor(gc.repetition_penalty))
+    if gc.no_repeat_ngram_size:
+        procs.append(NoRepeatNGramLogitsProcessor(gc.no_repeat_ngram_size))
+    # warper 순서도 generate와 동일: temperature → top_k → top_p → min_p
+    if temperature is not None and temperature != 1.0:
+        procs.append(TemperatureLogitsWarper(temperature))
+    if gc.top_k:
+        procs.append(TopKLogitsWarper(gc.top_k))
+    if top_p is not None and top_p < 1.0:
+        procs.append(TopPLogitsWarper(top_p))
+    if getattr(gc, "min_p", None):
+        procs.append(MinPLogitsWarper(gc.min_p))
+    return procs
+
+
+def generate_texts_cached(model, processor, prefix_cache, messages_list,
+                          max_new_tokens=640, temperature=0.7, top_p=0.9, images=None,
+                          early_stop=True, on_partial=None, grammar=None, num_return_sequences=1, seed=None):
+    """generate_texts와 같은 결과 형식. 공통 system 프리픽스는 KV 캐시에서 복사, 접미부만 prefill.
+    prefix_cache=None이면 프리픽스 없이 전체를 prefill (images 재사용만 필요한 경우)
+    images: encode_images() 결과를 미리 가지고 있으면 전달(전처리/비전 타워 재실행 생략)
+    seed: 정수(모든 행 공통) 또는 행별 리스트 → 행마다 별도 torch.Generator로 샘플링 (배치 구성과 무관하게 재현)"""
+    if num_return_sequences > 1:
+        # 행 복제: 비전 임베딩/프리픽스 KV는 한 번만 계산되고 행마다 독립 샘플링 (j번째 샘플은 seed+j)
+        images = images or encode_images(model, processor, messages_list)
+        K = num_return_sequences
+        seeds = [seed + j for _ in messages_list for j in range(K)] if seed is not None else None
+        return generate_texts_cached(model, processor, prefix_cache, [m for m in messages_list for _ in range(K)],
+                                     max_new_tokens, temperature, top_p, [e for e in images for _ in range(K)],
+                                     early_stop, on_partial, grammar, seed=seeds)
+    # 행별 seed 리스트로 통일 (seed 없음 = None 유지 → 전역 RNG 샘플링)
+    seeds = None if seed is None else seed if isinstance(seed, list) else [seed] * len(messages_list)
+    system = messages_list[0][0]
+    if prefix_cache is not None and any(m[0] != system for m in messages_list):
+        return [generate_texts_cached(model, processor, prefix_cache, [m], max_new_tokens, temperature, top_p,
+                                      images[i:i+1] if images else None, early_stop,
+                                      (lambda _, obj, i=i: on_partial(i, obj)) if on_partial else None, grammar,
+                                      seed=seeds[i:i+1] if seeds else None)[0]
+                for i, m in enumerate(messages_list)]
+    if prefix_cache is not None:
+        prefix_text, prefix_ids, prefix_kv = prefix_cache.get(system)
+    else:
+        prefix_text, prefix_ids, prefix_kv = "", torch.empty((1, 0), dtype=torch.long, device=model.device), DynamicCache()
+    texts = [processor.apply_chat_template(m, tokenize=False, add_generation_prompt=True) for m in messages_list]
+    if not all(t.startswith(prefix_text) for t in texts):
+        if seed is not None:   # 행별 generator는 수동 루프에서만 가능 → 프리픽스 없이 전체 prefill
+            return generate_texts_cached(model, processor, None, messages_list, max_new_tokens, temperature, top_p,
+                                         images, early_stop, on_partial, grammar, seed=seeds)
+        return generate_texts(model, processor, messages_list, max_new_tokens, temperature, top_p,
+                              early_stop, on_partial, grammar)
+
+    # 접미부 토큰화: <|image_pad|> 자리를 이미지 토큰 수만큼 펼친다 (processor와 동일 규칙)
+    images = images or encode_images(model, processor, messages_list)
+    pad = processor.image_token
+    suffixes = [t[len(prefix_text):].replace(pad, pad * e.shape[0], 1) for t, (_, e) in zip(texts, images)]
+    tok = processor.tokenizer
+    tok.padding_side = "left"   # 패딩은 프리픽스와 접미부 사이에 위치 (attention_mask로 가림)
+    enc = tok(suffixes, padding=True, return_tensors="pt").to(model.device)
+    B, P = len(texts), prefix_ids.shape[1]
+    full_ids = torch.cat([prefix_ids.expand(B, -1), enc.input_ids], dim=1)
+    attn = torch.cat([torch.ones(B, P, dtype=enc.attention_mask.dtype, device=model.device), enc.attention_mask], dim=1)
+    grid = torch.cat([g for g, _ in images])
+    position_ids, _ = _rope_index(model)(input_ids=full_ids, image_grid_thw=grid, video_grid_thw=None, attention_mask=attn)
+
+    L = full_ids.shape[1]
+    warpers = sampling_processors(model, temperature, top_p)
+    eos = model.generation_config.eos_token_id
+    eos = torch.tensor(eos if isinstance(eos, (list, tuple)) else [eos], device=model.device)
+    pad_id = tok.pad_token_id if tok.pad_token_id is not None else int(eos[0])
+    stop = JsonStopCriteria(tok, L, B, on_partial) if early_stop else None
+    constrain = GrammarLogitsProcessor(get_token_grammar(model, processor, grammar), L, B) if grammar else None
+
+    with torch.no_grad():
+        # 접미부 임베딩 + 이미지 임베딩 삽입
+        embeds = model.get_input_embeddings()(enc.input_ids)
+        image_mask = enc.input_ids == model.config.image_token_id
+        embeds[image_mask] = torch.cat([e for _, e in images]).to(embeds.dtype)
+
+        kv = copy.deepcopy(prefix_kv)
+        if B > 1 and P:
+            kv.batch_repeat_interleave(B)
+        out = model(inputs_embeds=embeds, attention_mask=attn, position_ids=position_ids[:, :, P:],
+                    past_key_values=kv, use_cache=True, cache_position=torch.arange(P, L, device=model.device))
+        next_pos = position_ids.amax(dim=(0, 2)) + 1        # (B,) 이미지 구간 때문에 행마다 다름
+        # 행별 generator: 같은 seed면 배치에 누가 같이 묶였는지와 무관하게 같은 난수열
+        generators = [torch.Generator(device=out.logits.device).manual_seed(int(sd)) for sd in seeds] \
+            if seed is not None else None
+        seq = full_ids
+        unfinished = torch.ones(B, dtype=torch.bool, device=model.device)
+        while seq.shape[1] - L < max_new_tokens:
+            logits = out.logits[:, -1, :].float()
+            if constrain is not None:
+                logits = constrain(seq, logits)
+            scores = warpers(seq, logits)
+            probs = torch.softmax(scores, dim=-1)
+            if generators is None:
+                nxt = torch.multinomial(probs, 1).squeeze(1)
+            else:
+                nxt = torch.cat([torch.multinomial(p, 1, generator=g) for p, g in zip(probs, generators)])
+            nxt = torch.where(unfinished, nxt, torch.full_like(nxt, pad_id))
+            unfinished &= ~torch.isin(nxt, eos)
+            step = nxt[:, None]
+            # 문법이 강제하는 구조 토큰은 샘플링 없이 이어 붙여 한 번의 forward로 처리 (단일 행)
+            if constrain is not None and B == 1 and unfinished.all():
+                budget = max_new_tokens - (seq.shape[1] - L) - 1
+                forced = constrain.forced_run(torch.cat([seq, step], dim=1))[:budget]
+                if forced:
+                    step = torch.cat([step, step.new_tensor([forced])], dim=1)
+            seq = torch.cat([seq, step], dim=1)
+            if stop is not None:
+                unfinished &= ~stop(seq, scores)
+            if not unfinished.any():
+                break
+            k = step.shape[1]
+            attn = torch.cat([attn, attn.new_ones(B, k)], dim=1)
+            pos = next_pos.view(1, B, 1) + torch.arange(k, device=model.device).view(1, 1, k)
+            out = model(input_ids=step, attention_mask=attn, position_ids=pos.expand(3, B, k),
+                        past_key_values=kv, use_cache=True,
+                        cache_position=torch.arange(attn.shape[1] - k, attn.shape[1], device=model.device))
+            next_pos = next_pos + k
+
+    return processor.batch_decode(seq[:, L:], skip_special_tokens=True)
+
+
+def run_generation(model, processor, messages_list, prefix_cache=None, images=None, **gen_kwargs):
+    # 문법 제약 시에도 수동 디코드 경로 사용 (강제 토큰 일괄 입력)
+    # seed 지정 시에도 수동 경로: generate()는 행별 generator를 받을 수 없음
+    seed = gen_kwargs.pop("seed", None)
+    if prefix_cache is not None or images is not None or gen_kwargs.get("grammar") is not None or seed is not None:
+        return generate_texts_cached(model, processor, prefix_cache, messages_list, images=images, seed=seed,
+                                     **gen_kwargs)
+    return generate_texts(model, processor, messages_list, **gen_kwargs)
+
+
+def finalize_layout(gen_text, image_path):
+    """JSON 추출 + 보정/후처리/폴백 + 언더레이"""
     parsed = extract_json(gen_text)
     parsed = normalize_if_pixels_layout(parsed, image_path)  # (1) 픽셀→정규화
+    return finish_layout(parsed)
+
+
+def finish_layout(parsed):
     parsed = postprocess_layout(parsed)                      # (2) 규칙/NMS 정제 + id
     parsed = inject_fallback_boxes(parsed)                   # (3) 비면 자동 보강
     parsed = add_text_underlays(parsed)                      # (4) 가독성 언더레이 추가
+    return parsed
+
+
+# ----------------------------
+# (NEW) 앙상블: 한 번의 generate(num_return_sequences=K)로 K개 샘플 → 박스 가중 융합 후 기존 후처리
+# ----------------------------
+
+def fuse_layouts(samples, iou_thr=0.55):
+    """정규화까지 끝난 K개 샘플 → 레이아웃 1개.
+    product/background는 첫 유효 샘플, subject는 평균, 텍스트/로고 박스는 타입별 confidence 가중 융합"""
+    valid = [p for p in samples if isinstance(p, dict) and isinstance(p.get("layout"), dict)]
+    if not valid:
+        return samples[0]
+    fused = copy.deepcopy(valid[0])
+    layout = fused["layout"]
+    subj = [p["layout"].get("subject_layout") or {} for p in valid]
+    centers = [s["center"] for s in subj if isinstance(s.get("center"), list) and len(s["center"]) == 2]
+    ratios = [s["ratio"] for s in subj if isinstance(s.get("ratio"), list) and len(s["ratio"]) == 2]
+    if centers and ratios:
+        layout["subject_layout"] = {"center": np.mean(np.asarray(centers, dtype=np.float64), axis=0).tolist(),
+                                    "ratio": np.mean(np.asarray(ratios, dtype=np.float64), axis=0).tolist()}
+    for key in ("nongraphic_layout", "graphic_layout"):
+        pooled = [it for p in valid for it in (p["layout"].get(key) or []) if isinstance(it, dict)]
+        layout[key] = _boxes.weighted_box_fusion(pooled, len(valid), iou_thr)
+    return fused
+
+
+def finalize_ensemble(gen_texts, image_path):
+    samples = [normalize_if_pixels_layout(extract_json(g), image_path) for g in gen_texts]
+    return finish_layout(fuse_layouts(samples))
+
+
+def merge_bg_plan(parsed, bg_plan, palette):
+    """2패스 결과를 background 필드에 결합"""
+    if "background" not in parsed or not isinstance(parsed["background"], dict):
+        parsed["background"] = {}
+    parsed["background"]["prompt"] = bg_plan.get("background_prompt", "")
+    parsed["background"]["negative_prompt"] = bg_plan.get("negative_prompt", "")
+    parsed["background"]["camera"] = bg_plan.get("camera", {})
+    parsed["background"]["lighting"] = bg_plan.get("lighting", {})
+    parsed["background"]["palette"] = bg_plan.get("palette", palette)
+    # 소품은 레이아웃의 별도 섹션으로도 보존
+    parsed.setdefault("background_objects", bg_plan.get("objects", []))
+    return parsed
+
+
+def attach_bg_plan(model, processor, image_path, product_name, parsed):
+    """(NEW) 2패스: 배경 프롬프트/소품 계획 생성"""
+    palette = extract_palette_hex(image_path, k=5)
+    bg_plan = generate_bg_plan(model, processor, image_path, product_name, parsed, palette)
+    return merge_bg_plan(parsed, bg_plan, palette)
+
+
+def analyze_image(model, processor, image_path, product_name,
+                  max_new_tokens=640, temperature=0.7, top_p=0.9, bg_prompt=False, seed=None, early_stop=True,
+                  constrained=False, ensemble=1, prefix_cache=None, result_cache=None, on_partial=None):
+    """이미지 1장 → 후처리까지 끝난 레이아웃 JSON (CLI와 서비스 모드가 같은 경로 사용)
+    on_partial(obj): 1패스 생성 중 중첩 객체가 닫힐 때마다 지금까지의 부분 JSON 전달"""
+    return analyze_images(model, processor, [(image_path, product_name)], max_new_tokens, temperature, top_p,
+                          bg_prompt, seed, early_stop, constrained, ensemble,
+                          prefix_cache=prefix_cache, result_cache=result_cache,
+                          on_partial=(lambda _, obj: on_partial(obj)) if on_partial else None)[0]
+
+
+def layout_cache_key(image_path, product_name, model, opts):
+    """결과 캐시 키: 이미지 내용 해시 + 제품명 + 모델 id + 프롬프트/문법 해시 + 샘플링 파라미터(seed, 백엔드 포함)"""
+    prompt_hash = disk_cache.key(SYSTEM, SCHEMA_TEXT, BG_SYSTEM, BG_SCHEMA,
+                                 compile_schema(LAYOUT_GRAMMAR), compile_schema(BG_GRAMMAR))
+    return disk_cache.key("qwen-layout", disk_cache.file_digest(image_path), product_name or "",
+                          getattr(model, "name_or_path", ""), prompt_hash, opts)
+
+
+def analyze_images(model, processor, requests, max_new_tokens=640, temperature=0.7, top_p=0.9, bg_prompt=False,
+                   seed=None, early_stop=True, constrained=False, ensemble=1,
+                   prefix_cache=None, result_cache=None, on_partial=None):
+    """(image_path, product_name) 여러 건을 1패스 1회 + (옵션) 2패스 1회의 배치 generate로 처리"""
+    if not requests:
+        return []
+    in_system = prefix_cache is not None
+
+    # (NEW) 결과 캐시: 적중한 건은 바로 반환, 나머지만 배치 추론 후 저장
+    # seed가 없으면 실행마다 다른 샘플이 기대값이므로 캐시를 읽지도 쓰지도 않음
+    if result_cache is not None and seed is not None:
+        opts = {"max_new_tokens": max_new_tokens, "temperature": temperature, "top_p": top_p,
+                "bg_prompt": bool(bg_prompt), "seed": seed, "schema_in_system": in_system,
+                "early_stop": bool(early_stop), "constrained": bool(constrained), "ensemble": int(ensemble),
+                "backend": getattr(model, "layout_backend", "auto"), "dtype": str(getattr(model, "dtype", ""))}
+        keys = [layout_cache_key(path, name, model, opts) for path, name in requests]
+        results = [result_cache.get_json(k) for k in keys]
+        todo = [i for i, r in enumerate(results) if r is None]
+        if todo:
+            fresh = analyze_images(model, processor, [requests[i] for i in todo], max_new_tokens, temperature,
+                                   top_p, bg_prompt, seed, early_stop, constrained, ensemble, prefix_cache=prefix_cache,
+                                   on_partial=(lambda j, obj: on_partial(todo[j], obj)) if on_partial else None)
+            for i, parsed in zip(todo, fresh):
+                result_cache.put_json(keys[i], parsed)
+                results[i] = parsed
+        return results
+
+    messages = [build_layout_messages(path, name, in_system) for path, name in requests]
+    # (NEW) 2패스가 있으면 이미지 전처리/비전 임베딩을 1회만 계산해 두 패스가 공유 (요청 단위 캐시)
+    vision = encode_images(model, processor, messages) if bg_prompt else None
+    gens = run_generation(model, processor, messages, prefix_cache, vision,
+                          max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p,
+                          early_stop=early_stop, on_partial=on_partial if ensemble <= 1 else None,
+                          grammar=LAYOUT_GRAMMAR if constrained else None, num_return_sequences=max(1, ensemble),
+                          seed=seed)
+    if ensemble > 1:
+        results = [finalize_ensemble(gens[i * ensemble:(i + 1) * ensemble], path) for i, (path, _) in enumerate(requests)]
+    else:
+        results = [finalize_layout(g, path) for g, (path, _) in zip(gens, requests)]
+    if bg_prompt:
+        palettes = [extract_palette_hex(path, k=5) for path, _ in requests]
+        bg_messages = [build_bg_messages(path, name, parsed, pal, in_system)
+                       for (path, name), parsed, pal in zip(requests, results, palettes)]
+        bg_gens = run_generation(model, processor, bg_messages, prefix_cache, vision,
+                                 early_stop=early_stop, grammar=BG_GRAMMAR if constrained else None, seed=seed,
+                                 **BG_GEN_KWARGS)
+        results = [merge_bg_plan(parsed, parse_bg_plan(g, pal), pal)
+                   for parsed, g, pal in zip(results, bg_gens, palettes)]
+    return results
+
+
+# ----------------------------
+# (NEW) 동적 배치 스케줄러: 대기 요청을 max_batch개 또는 max_wait_ms까지 모아 generate 1회
+# ----------------------------
+
+class BatchScheduler:
+    def __init__(self, model, processor, max_batch=4, max_wait_ms=50, prefix_cache=None, result_cache=None):
+        self.model = model
+        self.processor = processor
+        self.prefix_cache = prefix_cache
+        self.result_cache = result_cache
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, max_wait_ms / 1000.0)
+        self.batches = 0
+        self.batched_items = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="qwen-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, image_path, product_name, **opts):
+        fut = Future()
+        self._queue.put((image_path, product_name, opts, fut))
+        return fut
+
+    def stats(self):
+        st = {"max_batch": self.max_batch, "max_wait_ms": round(self.max_wait * 1000, 1),
+              "batches": self.batches, "avg_batch": round(self.batched_items / self.batches, 2) if self.batches else None,
+              "pending": self._queue.qsize()}
+        if self.prefix_cache is not None:
+            st["prefix_cache"] = self.prefix_cache.stats()
+        if self.result_cache is not None:
+            st["result_cache"] = self.result_cache.stats()
+        return st
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            # 샘플링 옵션이 같은 요청끼리만 한 generate로 묶음
+            # 그룹 키를 만들 수 없는 요청(해시 불가 옵션 등)은 그 요청만 실패시키고 루프는 계속
+            groups = {}
+            for item in batch:
+                try:
+                    key = tuple(sorted(item[2].items()))
+                    groups.setdefault(key, []).append(item)
+                except Exception as e:
+                    if item[3].set_running_or_notify_cancel():
+                        item[3].set_exception(e)
+            for key, items in groups.items():
+                live = [it for it in items if it[3].set_running_or_notify_cancel()]
+                if not live:
+                    continue
+                self.batches += 1
+                self.batched_items += len(live)
+                try:
+                    results = analyze_images(self.model, self.processor,
+                                             [(path, name) for path, name, _, _ in live],
+                                             prefix_cache=self.prefix_cache, result_cache=self.result_cache,
+                                             **dict(key))
+                    for (_, _, _, fut), res in zip(live, results):
+                        fut.set_result(res)
+                except Exception as e:
+                    for _, _, _, fut in live:
+                        fut.set_exception(e)
+
+
+# ----------------------------
+# (NEW) 상주 서비스 모드: 모델 1회 로드 후 HTTP(로컬 TCP 또는 Unix 소켓)로 요청 처리
+#   POST /analyze  {"image": 경로 | "image_b64": base64, "product_name": "...", "options": {...}}
+#   GET  /health, GET /metrics
+# ----------------------------
+
+ANALYZE_OPTIONS = ("max_new_tokens", "temperature", "top_p", "bg_prompt", "seed", "early_stop", "constrained",
+                   "ensemble")
+# 옵션별 허용 타입 (JSON 값 기준, bool은 int의 하위 타입이라 숫자 옵션에서 따로 거름)
+OPTION_TYPES = {"max_new_tokens": (int,), "temperature": (int, float), "top_p": (int, float), "bg_prompt": (bool,),
+                "seed": (int, type(None)), "early_stop": (bool,), "constrained": (bool,), "ensemble": (int,)}
+
+
+def pick_options(defaults, options):
+    """요청의 options에서 ANALYZE_OPTIONS만 골라 defaults에 덮어씀. 타입이 맞지 않으면 ValueError
+    (리스트/딕트 같은 값이 스케줄러의 배치 그룹 키로 들어가지 않도록 제출 전에 거름)"""
+    if options is None:
+        options = {}
+    if not isinstance(options, dict):
+        raise ValueError(f"options는 객체여야 합니다: {type(options).__name__}")
+    picked = {k: v for k, v in options.items() if k in ANALYZE_OPTIONS}
+    for k, v in picked.items():
+        types = OPTION_TYPES[k]
+        if not isinstance(v, types) or (isinstance(v, bool) and bool not in types):
+            raise ValueError(f"옵션 {k}의 타입이 올바르지 않습니다: {type(v).__name__}")
+    return {**defaults, **picked}
+
+
+class ServiceMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latencies_ms = []   # 최근 1000건
+
+    def begin(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+
+    def end(self, ms, ok):
+        with self.lock:
+            self.in_flight -= 1
+            if not ok:
+                self.errors += 1
+            self.latencies_ms.append(ms)
+            del self.latencies_ms[:-1000]
+
+    def snapshot(self):
+        with self.lock:
+            lat = sorted(self.latencies_ms)
+            def pct(p):
+                return round(lat[min(len(lat) - 1, int(p * len(lat)))], 1) if lat else None
+            return {
+                "uptime_s": round(time.time() - self.started, 1),
+                "requests": self.requests,
+                "errors": self.errors,
+                "in_flight": self.in_flight,
+                "latency_ms": {"count": len(lat), "mean": round(sum(lat) / len(lat), 1) if lat else None,
+                               "p50": pct(0.5), "p95": pct(0.95), "max": round(lat[-1], 1) if lat else None},
+            }
+
+
+class LayoutService:
+    """모델/프로세서를 한 번만 올려두고, 요청은 BatchScheduler로 모아 처리 (max_batch=1이면 직렬)"""
+
+    def __init__(self, model, processor, model_id, defaults, max_batch=1, max_wait_ms=50, prefix_cache=None,
+                 result_cache=None):
+        self.model = model
+        self.processor = processor
+        self.model_id = model_id
+        self.defaults = defaults
+        self.metrics = ServiceMetrics()
+        self.scheduler = BatchScheduler(model, processor, max_batch, max_wait_ms, prefix_cache, result_cache)
+
+    def analyze(self, req):
+        opts = pick_options(self.defaults, req.get("options"))   # 타입 오류 → ValueError → 400
+        tmp_path = None
+        image_path = req.get("image")
+        if req.get("image_b64"):
+            fd, tmp_path = tempfile.mkstemp(suffix=".png")
+            with os.fdopen(fd, "wb") as f:
+                f.write(base64.b64decode(req["image_b64"]))
+            image_path = tmp_path
+        try:
+            if not image_path or not os.path.exists(image_path):
+                raise FileNotFoundError(f"이미지 경로를 찾을 수 없습니다: {image_path}")
+            return self.scheduler.submit(os.path.abspath(image_path), req.get("product_name") or "", **opts).result()
+        finally:
+            if tmp_path:
+                os.unlink(tmp_path)
+
+    def health(self):
+        return {"status": "ok", "model_id": self.model_id, "device": str(self.model.device)}
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, obj):
+            body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, service.health())
+            elif self.path == "/metrics":
+                self._send(200, {**service.metrics.snapshot(), "batching": service.scheduler.stats()})
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/analyze":
+                self._send(404, {"error": "not found"})
+                return
+            t0 = time.perf_counter()
+            service.metrics.begin()
+            ok = False
+            try:
+                n = int(self.headers.get("Content-Length") or 0)
+                req = json.loads(self.rfile.read(n) or b"{}")
+                result = service.analyze(req)
+                ok = True
+                self._send(200, result)
+            except (FileNotFoundError, ValueError) as e:
+                self._send(400, {"error": str(e)})
+            except Exception as e:
+                self._send(500, {"error": f"{type(e).__name__}: {e}"})
+            finally:
+                service.metrics.end((time.perf_counter() - t0) * 1000, ok)
+
+        def address_string(self):
+            # Unix 소켓은 client_address가 비어 있음
+            return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else "unix"
+
+        def log_message(self, fmt, *args):
+            print(f"[serve] {self.address_string()} {fmt % args}", file=sys.stderr)
+
+    return Handler
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=8765, socket_path=None):
+    """→ (httpd, where). port=0이면 빈 포트 자동 선택 (벤치/스모크 테스트에서 스레드로 띄울 때)"""
+    handler = make_handler(service)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, handler), f"unix:{socket_path}"
+    httpd = ThreadingHTTPServer((host, port), handler)
+    return httpd, f"http://{host}:{httpd.server_address[1]}"
+
+
+def serve(service, host="127.0.0.1", port=8765, socket_path=None):
+    httpd, where = make_server(service, host, port, socket_path)
+    print(f"[서비스 시작] {where}  (POST /analyze, GET /health, GET /metrics)", file=sys.stderr)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+# ----------------------------
+# (NEW) JSONL 일괄 분석: 모든 줄을 스케줄러에 제출 → 배치로 처리, 끝나는 대로 저장
+# ----------------------------
+
+def run_jobs(scheduler, jobs_path, defaults):
+    futures = []
+    with open(jobs_path, "r", encoding="utf-8-sig") as f:
+        for lineno, raw in enumerate(f, 1):
+            raw = raw.strip()
+            if not raw or raw.startswith("#"):
+                continue
+            try:
+                job = json.loads(raw)
+                image_path = job["image"]
+                if not os.path.exists(image_path):
+                    raise FileNotFoundError(image_path)
+                opts = pick_options(defaults, job.get("options"))
+            except Exception as e:
+                print(json.dumps({"line": lineno, "status": "error", "error": f"{type(e).__name__}: {e}"}, ensure_ascii=False))
+                continue
+            save = job.get("save") or os.path.splitext(image_path)[0] + "_layout.json"
+            futures.append((lineno, save, scheduler.submit(os.path.abspath(image_path), job.get("product_name") or "", **opts)))
+    n_err = 0
+    for lineno, save, fut in futures:
+        rec = {"line": lineno, "save": save}
+        try:
+            with open(save, "w", encoding="utf-8") as f:
+                json.dump(fut.result(), f, ensure_ascii=False, indent=2)
+            rec["status"] = "ok"
+        except Exception as e:
+            n_err += 1
+            rec.update(status="error", error=f"{type(e).__name__}: {e}")
+        print(json.dumps(rec, ensure_ascii=False))
+    print(f"[일괄 분석 완료] {len(futures) - n_err}/{len(futures)} | {scheduler.stats()}", file=sys.stderr)
+    return 0 if n_err == 0 else 1
+
+
+# ----------------------------
+# 메인
+# ----------------------------
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--image", help="분석할 이미지 경로", required=False)
+    ap.add_argument("--product_name", help="제품 이름(힌트)", default=None)
+    ap.add_argument("--max_new_tokens", type=int, default=640)
+    ap.add_argument("--temperature", type=float, default=0.7)
+    ap.add_argument("--top_p", type=float, default=0.9)
+    ap.add_argument("--save", help="결과를 저장할 파일 경로(json)", default=None)
+    # (NEW) 옵션: 2패스 배경 프롬프트 생성 on/off
+    ap.add_argument("--bg_prompt", action="store_true", help="배경 프롬프트/소품 계획 생성 활성화")
+    ap.add_argument("--model_id", default=DEFAULT_MODEL_ID, help="모델 id 또는 로컬 체크포인트 경로")
+    # (NEW) 상주 서비스 모드
+    ap.add_argument("--serve", action="store_true", help="모델을 한 번 로드하고 HTTP 서비스로 대기")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--socket", default=None, help="TCP 대신 Unix 소켓 경로로 대기")
+    # (NEW) 동적 배치
+    ap.add_argument("--max_batch", type=int, default=1, help="한 번의 generate로 묶을 최대 이미지 수")
+    ap.add_argument("--max_wait_ms", type=float, default=50, help="배치를 채우기 위해 기다리는 최대 시간(ms)")
+    ap.add_argument("--jobs", default=None, help='JSONL 목록: {"image": ..., "product_name": ..., "save": ...} 줄 단위 일괄 분석')
+    # (NEW) 고정 프롬프트 프리픽스 KV 캐시
+    ap.add_argument("--prefix_cache", action="store_true",
+                    help="SYSTEM+스키마를 system 메시지로 묶고 그 KV 캐시를 재사용(이미지/제품명 부분만 prefill)")
+    # (NEW) 결과 디스크 캐시
+    ap.add_argument("--seed", type=int, default=None,
+                    help="샘플링 seed (캐시 키에 포함). 지정 시 요청별 generator로 샘플링해 배치 구성과 무관하게 재현 가능, "
+                         "생략 시 실행마다 다른 샘플")
+    ap.add_argument("--cache_dir", default=os.path.join("~", ".cache", "generate-to-image", "qwen"),
+                    help="레이아웃 결과 캐시 디렉터리 (--seed를 준 실행만 캐시)")
+    ap.add_argument("--cache_max_mb", type=float, default=256, help="결과 캐시 최대 크기(MB), 넘으면 오래된 것부터 삭제")
+    ap.add_argument("--no_cache", action="store_true", help="결과 캐시 사용 안 함")
+    ap.add_argument("--refresh", action="store_true", help="캐시를 읽지 않고 새로 분석해 덮어쓰기")
+    # (NEW) JSON 인식 조기 종료 / 부분 결과 스트리밍
+    ap.add_argument("--no_early_stop", action="store_true", help="JSON이 닫혀도 EOS/max_new_tokens까지 계속 생성")
+    ap.add_argument("--stream_partial", action="store_true", help="생성 중 부분 레이아웃 JSON을 stderr로 한 줄씩 출력")
+    # (NEW) 스키마 문법 제약 디코딩
+    ap.add_argument("--constrained", action="store_true",
+                    help="스키마 문법으로 토큰을 제한해 항상 파싱 가능한 JSON 생성(구조 토큰 강제)")
+    # (NEW) CPU 양자화 백엔드
+    ap.add_argument("--backend", choices=BACKENDS, default="auto",
+                    help="auto=원본 정밀도(자동 dtype/device), cpu-int8/cpu-int4=weight-only 양자화 CPU 추론 (optimum-quanto 필요)")
+    ap.add_argument("--threads", type=int, default=None, help="torch.set_num_threads 값 (CPU 추론 스레드 수)")
+    ap.add_argument("--quant_dir", default=QUANT_DIR, help="양자화 산출물(safetensors+quantization_map.json) 캐시 위치")
+    ap.add_argument("--convert_only", action="store_true", help="양자화 산출물만 만들고 종료")
+    # (NEW) 다중 샘플 앙상블
+    ap.add_argument("--ensemble", type=int, default=1,
+                    help="1패스 샘플 K개를 한 번의 generate(num_return_sequences=K)로 뽑아 박스 가중 융합")
+    args = ap.parse_args()
+
+    if args.convert_only:
+        if args.backend == "auto":
+            print("[에러] --convert_only는 --backend cpu-int8|cpu-int4와 함께 사용", file=sys.stderr)
+            sys.exit(1)
+        convert_quantized(args.model_id, args.backend, args.quant_dir)
+        return
+
+    defaults = {"max_new_tokens": args.max_new_tokens, "temperature": args.temperature,
+                "top_p": args.top_p, "bg_prompt": args.bg_prompt, "seed": args.seed,
+                "early_stop": not args.no_early_stop, "constrained": args.constrained, "ensemble": args.ensemble}
+    result_cache = None if args.no_cache else disk_cache.DiskCache(
+        args.cache_dir, max_bytes=int(args.cache_max_mb * (1 << 20)), refresh=args.refresh)
+
+    if args.serve:
+        model, processor = load_model(args.model_id, args.backend, args.threads, args.quant_dir)
+        prefix_cache = PrefixKVCache(model, processor) if args.prefix_cache else None
+        service = LayoutService(model, processor, args.model_id, defaults, args.max_batch, args.max_wait_ms,
+                                prefix_cache, result_cache)
+        serve(service, args.host, args.port, args.socket)
+        return
+
+    if args.jobs:
+        model, processor = load_model(args.model_id, args.backend, args.threads, args.quant_dir)
+        prefix_cache = PrefixKVCache(model, processor) if args.prefix_cache else None
+        scheduler = BatchScheduler(model, processor, args.max_batch, args.max_wait_ms, prefix_cache, result_cache)
+        sys.exit(run_jobs(scheduler, args.jobs, defaults))
+
+    product_name = args.product_name or input("제품 이름을 입력하세요: ").strip()
+    image_path = args.image or input("제품 이미지 파일 경로를 입력하세요 (예: './image.jpg'): ").strip()
+    if not os.path.exists(image_path):
+        print(f"[에러] 이미지 경로를 찾을 수 없습니다: {image_path}", file=sys.stderr)
+        sys.exit(1)
 
-    # (NEW) 2패스: 배경 프롬프트/소품 계획 생성
-    if args.bg_prompt:
-        palette = extract_palette_hex(image_path, k=5)
-        bg_plan = generate_bg_plan(model, processor, image_path, product_name, parsed, palette)
-        # background 필드에 결합
-        if "background" not in parsed or not isinstance(parsed["background"], dict):
-            parsed["background"] = {}
-        parsed["background"]["prompt"] = bg_plan.get("background_prompt", "")
-        parsed["background"]["negative_prompt"] = bg_plan.get("negative_prompt", "")
-        parsed["background"]["camera"] = bg_plan.get("camera", {})
-        parsed["background"]["lighting"] = bg_plan.get("lighting", {})
-        parsed["background"]["palette"] = bg_plan.get("palette", palette)
-        # 소품은 레이아웃의 별도 섹션으로도 보존
-        parsed.setdefault("background_objects", bg_plan.get("objects", []))
+    model, processor = load_model(args.model_id, args.backend, args.threads, args.quant_dir)
+    prefix_cache = PrefixKVCache(model, processor) if args.prefix_cache else None
+    on_partial = (lambda obj: print(json.dumps(obj, ensure_ascii=False), file=sys.stderr, flush=True)) \
+        if args.stream_partial else None
+    parsed = analyze_image(model, processor, image_path, product_name, prefix_cache=prefix_cache,
+                           result_cache=result_cache, on_partial=on_partial, **defaults)
+    if result_cache is not None:
+        print(f"[결과 캐시] {result_cache.stats()}", file=sys.stderr)
 
     # 출력/저장
     if args.save:
@@ -537,4 +1398,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -5,6 +5,8 @@ import time
 from google import genai
 from google.genai import types
 
+from share.api_limiter import ApiLimiter
+
 MODEL_NAME = "gemini-2.5-flash-image-preview"
 
 
@@ -36,7 +38,10 @@ def remix_images(
 
     print(f"Remixing with {len(image_paths)} images and prompt: {prompt}")
 
-    stream = client.models.generate_content_stream(
+    # Retries 429/5xx with backoff until the first chunk arrives (requests/min cap only when GEMINI_RPM is set).
+    limiter = ApiLimiter(rpm=float(os.environ.get("GEMINI_RPM", "0")) or None)
+    stream = limiter.stream(
+        "generate_content_stream", client.models.generate_content_stream,
         model=MODEL_NAME,
         contents=contents,
         config=generate_content_config,
@@ -7,6 +7,8 @@ from PIL import Image
 from google import genai
 from google.genai import types
 
+from share.api_limiter import ApiLimiter
+
 MODEL_NAME = "gemini-2.5-flash-image-preview"
 
 def _get_mime_type(file_path: str) -> str:
@@ -112,8 +114,10 @@ def main():
 
     print(f"✨ '{args.image}' 이미지와 다음 프롬프트로 이미지 생성 시작:\n{prompt}")
 
-    # 스트리밍 방식으로 API 호출
-    stream = client.models.generate_content_stream(
+    # 스트리밍 방식으로 API 호출 (첫 청크 전 429/5xx는 백오프 후 재시도, 분당 제한은 GEMINI_RPM 지정 시만)
+    limiter = ApiLimiter(rpm=float(os.environ.get("GEMINI_RPM", "0")) or None)
+    stream = limiter.stream(
+        "generate_content_stream", client.models.generate_content_stream,
         model=MODEL_NAME,
         contents=contents,
         config=types.GenerateContentConfig(response_modalities=["IMAGE", "TEXT"]),